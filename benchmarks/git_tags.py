@@ -0,0 +1,78 @@
+"""
+Benchmark planex.git's in-process repository access against running a
+git command for each query, on a repository with many tags.
+
+Usage: python -m benchmarks.git_tags [NUMBER_OF_TAGS]
+"""
+from __future__ import print_function
+
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import timeit
+
+import planex.git
+
+
+def make_repo(path, ntags):
+    """Create a repository at path with one commit and ntags tags"""
+    subprocess.check_call(["git", "init", "--quiet", path])
+    subprocess.check_call(["git", "-C", path, "-c", "user.name=Bench",
+                           "-c", "user.email=bench@example.com", "commit",
+                           "--quiet", "--allow-empty", "--message", "base"])
+    head = subprocess.check_output(["git", "-C", path, "rev-parse",
+                                    "HEAD"]).strip()
+    update = subprocess.Popen(["git", "-C", path, "update-ref", "--stdin"],
+                              stdin=subprocess.PIPE)
+    update.communicate("".join("create refs/tags/v%d.0.0 %s\n" % (i, head)
+                               for i in range(ntags)))
+    subprocess.check_call(["git", "-C", path, "pack-refs", "--all"])
+    subprocess.check_call(["git", "-C", path, "remote", "add", "origin",
+                           "https://example.com/bench.git"])
+
+
+def subprocess_tag_exists(repo, name):
+    """The previous approach: list every tag with 'git tag'"""
+    return name in subprocess.check_output(["git", "-C", repo,
+                                            "tag"]).split()
+
+
+def subprocess_origin_url(repo):
+    """The previous approach: run 'git remote -v'"""
+    return subprocess.check_output(["git", "-C", repo, "remote", "-v"])
+
+
+def report(label, stmt, number):
+    """Print the mean time per call of stmt"""
+    elapsed = timeit.timeit(stmt, number=number)
+    print("%-40s %8.3f ms" % (label, elapsed / number * 1000))
+
+
+def main(argv):
+    """Entry point"""
+    ntags = int(argv[1]) if len(argv) > 1 else 10000
+    tmpdir = tempfile.mkdtemp(prefix="px-bench-")
+    try:
+        repo = os.path.join(tmpdir, "repo")
+        make_repo(repo, ntags)
+        print("Repository with %d tags" % ntags)
+
+        # Open the cached handle before timing
+        planex.git.handle(repo)
+        tag = "v%d.0.0" % (ntags // 2)
+        report("tag lookup, 'git tag' per call",
+               lambda: subprocess_tag_exists(repo, tag), 20)
+        report("tag lookup, planex.git.tag_exists",
+               lambda: planex.git.tag_exists(repo, tag), 20)
+        report("origin URL, 'git remote -v' per call",
+               lambda: subprocess_origin_url(repo), 20)
+        report("origin URL, planex.git.origin_url",
+               lambda: planex.git.origin_url(repo), 20)
+    finally:
+        shutil.rmtree(tmpdir)
+
+
+if __name__ == "__main__":
+    main(sys.argv)
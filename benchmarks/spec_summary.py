@@ -0,0 +1,114 @@
+"""
+Count the librpm calls made while parsing the test specs and generating
+their dependencies, with the memoised Spec summary and with the
+accessors recomputed on every call as they were before.   Parsing is
+included in both counts, so the cost of computing the summary up front
+is not hidden.
+
+Usage: python -m benchmarks.spec_summary [SPEC...]
+"""
+from __future__ import print_function
+
+import glob
+import sys
+import timeit
+
+import rpm
+
+import planex.graph
+import planex.spec
+
+
+# librpm entry points used by planex.spec after a spec has been parsed
+COUNTED = ["expandMacro", "addMacro", "delMacro"]
+
+
+class Counter(object):
+    """Count calls to the COUNTED functions of the rpm module"""
+
+    def __init__(self):
+        self.calls = 0
+        self.originals = {}
+
+    def __enter__(self):
+        for name in COUNTED:
+            original = getattr(rpm, name)
+            self.originals[name] = original
+            setattr(rpm, name, self.wrap(original))
+        return self
+
+    def __exit__(self, *exc_info):
+        for name, original in self.originals.items():
+            setattr(rpm, name, original)
+
+    def wrap(self, function):
+        """Return function, wrapped to count its calls"""
+        def counted(*args):
+            """Count this call and pass it on"""
+            self.calls += 1
+            return function(*args)
+        return counted
+
+
+class UncachedSummary(object):
+    """
+    A view of a Spec which recomputes each field on every access, as
+    the Spec accessors did before the summary was memoised
+    """
+
+    # pylint: disable=too-few-public-methods,protected-access
+    def __init__(self, spec):
+        self.spec = spec
+
+    def __getattr__(self, name):
+        if name == "rpm_path":
+            return self.spec._binary_package_paths()[-1]
+        if name in ("name", "version", "specpath"):
+            return getattr(self.spec.summary, name)
+        if name in ("file_provides", "dir_provides"):
+            return [path for path, is_dir in self.spec._file_entries()
+                    if is_dir or name == "file_provides"]
+        return getattr(self.spec, "_" + name)()
+
+
+class UncachedSpec(object):
+    """A Spec whose summary is recomputed on every access"""
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self, spec):
+        self.spec = spec
+        self.summary = UncachedSummary(spec)
+
+    def __getattr__(self, name):
+        return getattr(self.spec, name)
+
+
+def generate(paths, wrap):
+    """
+    Parse the specs at paths, wrapping each Spec with wrap, then build
+    the dependency graph and every rule, as planex-depend does
+    """
+    specs = [wrap(planex.spec.Spec(path, check_package_name=False,
+                                   defines=[("dist", ".el6")],
+                                   with_files=True))
+             for path in paths]
+    depgraph = planex.graph.DependencyGraph.from_specs(specs, {})
+    return depgraph.build_order()
+
+
+def main(argv):
+    """Entry point"""
+    paths = argv[1:] or glob.glob("tests/data/*.spec")
+    print("%d specs" % len(paths))
+
+    for label, wrap in [("recomputed accessors", UncachedSpec),
+                        ("memoised summary", lambda spec: spec)]:
+        with Counter() as counter:
+            generate(paths, wrap)
+        elapsed = timeit.timeit(lambda: generate(paths, wrap), number=20)
+        print("%-24s %6d librpm calls %8.3f ms" %
+              (label, counter.calls, elapsed / 20 * 1000))
+
+
+if __name__ == "__main__":
+    main(sys.argv)
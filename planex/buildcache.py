@@ -0,0 +1,324 @@
+"""
+Cache of binary packages built by mock, keyed on the inputs to the build.
+
+A build's key is a hash of the source RPM, the mock configuration, the
+RPM macro definitions passed to mock and the exact local packages which
+would be installed to satisfy its build dependencies.   Packages which
+come from the distribution repositories named in the mock configuration
+are assumed not to change while the configuration is unchanged.
+
+The source RPM and configuration digests are also recorded as a
+snapshot beside each build, together with the package ID of every
+package mock actually installed in the chroot, so that a later build
+can be skipped when none of them have changed.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import shutil
+import tarfile
+import tempfile
+
+import requests
+import rpm
+
+from planex.util import makedirs
+
+
+# Logs of the packages installed in a chroot, written to the result
+# directory by mock's package_state plugin, newest name first
+INSTALLED_LOGS = ["installed_pkgs.log", "installed_pkgs"]
+
+
+def read_header(path):
+    """Return the RPM header of the package at path"""
+    trans = rpm.ts()
+    trans.setVSFlags(rpm._RPMVSF_NOSIGNATURES)  # pylint: disable=W0212
+    with open(path) as rpmfile:
+        return trans.hdrFromFdno(rpmfile.fileno())
+
+
+class LocalPackage(object):
+    """A binary package which has already been built locally"""
+
+    # pylint: disable=R0903
+    def __init__(self, path, hdr):
+        self.path = path
+        self.name = hdr['name']
+        self.pkgid = hdr.sprintf("%{PKGID}")
+        self.nevra = hdr.sprintf(
+            "%{NAME}-%{EPOCHNUM}:%{VERSION}-%{RELEASE}.%{ARCH}")
+        self.digest = hdr['sha1header']
+        self.provides = set(hdr['providename']) | set([hdr['name']])
+        self.requires = set(hdr['requirename'])
+
+
+class LocalPackages(object):
+    """Index of the binary packages found under a directory"""
+
+    def __init__(self, rpmdir):
+        self.providers = {}
+        self.packages = {}
+        for dirpath, _, filenames in os.walk(rpmdir):
+            for filename in filenames:
+                if (not filename.endswith(".rpm") or
+                        filename.endswith(".src.rpm")):
+                    continue
+                path = os.path.join(dirpath, filename)
+                pkg = LocalPackage(path, read_header(path))
+                self.packages.setdefault(pkg.name, []).append(pkg)
+                for provide in pkg.provides:
+                    self.providers.setdefault(provide, []).append(pkg)
+
+    def pkgids(self, name):
+        """Return the set of package IDs of the local packages called name"""
+        return set(pkg.pkgid for pkg in self.packages.get(name, []))
+
+    def resolve(self, requires):
+        """
+        Return the set of local packages which would be installed to
+        satisfy requires, including the local packages they require in
+        turn.   Requirements which no local package provides are assumed
+        to be met by the distribution repositories.
+        """
+        resolved = {}
+        pending = list(requires)
+        while pending:
+            for pkg in self.providers.get(pending.pop(), []):
+                if pkg.path not in resolved:
+                    resolved[pkg.path] = pkg
+                    pending.extend(pkg.requires)
+        return set(resolved.values())
+
+
+def _hash_file(digest, path):
+    """Update digest with the contents of the file at path"""
+    with open(path, "rb") as fileh:
+        for block in iter(lambda: fileh.read(65536), ""):
+            digest.update(block)
+
+
+def file_digest(path):
+    """Return the SHA256 digest of the file at path"""
+    digest = hashlib.sha256()
+    _hash_file(digest, path)
+    return digest.hexdigest()
+
+
+def _hash_config(digest, mock_config_path, defines):
+    """
+    Update digest with the mock configuration at mock_config_path and
+    the RPM macro definitions passed to mock
+    """
+    _hash_file(digest, mock_config_path)
+    for name, value in sorted(defines):
+        # _topdir only affects paths outside the chroot
+        if name != "_topdir":
+            digest.update("%s %s\0" % (name, value))
+
+
+def build_key(srpm, mock_config_path, defines, local_packages):
+    """
+    Return the cache key for building srpm with the mock configuration
+    at mock_config_path and the given RPM macro definitions, using
+    build dependencies resolved from local_packages.
+    """
+    key = hashlib.sha256()
+    _hash_file(key, srpm)
+    _hash_config(key, mock_config_path, defines)
+
+    buildrequires = read_header(srpm)['requirename']
+    resolved = local_packages.resolve(buildrequires)
+    for nevra, digest in sorted((pkg.nevra, pkg.digest) for pkg in resolved):
+        key.update("%s %s\0" % (nevra, digest))
+    return key.hexdigest()
+
+
+def dependency_snapshot(srpm, mock_config_path, defines):
+    """
+    Return a record of the inputs to a build of srpm which are known
+    before it runs: digests of the source package and of the mock
+    configuration.
+    """
+    config = hashlib.sha256()
+    _hash_config(config, mock_config_path, defines)
+    return {
+        "srpm": file_digest(srpm),
+        "config": config.hexdigest()
+    }
+
+
+def installed_packages(resultdir):
+    """
+    Return a dictionary mapping the name of each package installed in
+    the chroot for a build to its package ID, the MD5 digest of its
+    header and payload.   The list is read from the log written to
+    resultdir by mock's package_state plugin.   Returns None if the
+    build left no such log.
+    """
+    for log_name in INSTALLED_LOGS:
+        log_path = os.path.join(resultdir, log_name)
+        if os.path.exists(log_path):
+            break
+    else:
+        return None
+
+    installed = {}
+    with open(log_path) as log:
+        for line in log:
+            # NEVRA, build time, size, package ID and install time
+            fields = line.split()
+            if len(fields) >= 4:
+                installed[fields[0].rsplit("-", 2)[0]] = fields[3]
+    return installed
+
+
+def up_to_date(snapshot_path, snapshot, local_packages):
+    """
+    Return True if the snapshot recorded at snapshot_path matches
+    snapshot, none of the packages installed in the chroot for the
+    recorded build has been replaced by a different local package, and
+    all of the packages built from it still exist.
+    """
+    try:
+        with open(snapshot_path) as snapshot_file:
+            recorded = json.load(snapshot_file)
+    except IOError:
+        return False
+
+    for field in ["srpm", "config"]:
+        if recorded.get(field) != snapshot[field]:
+            logging.debug("%s: %s changed", snapshot_path, field)
+            return False
+
+    installed = recorded.get("installed")
+    if installed is None:
+        return False
+    local = set(recorded.get("local", []))
+    for name, pkgid in sorted(installed.items()):
+        pkgids = local_packages.pkgids(name)
+        if (pkgids or name in local) and pkgid not in pkgids:
+            logging.debug("%s: build dependency %s changed",
+                          snapshot_path, name)
+            return False
+
+    outputs = recorded.get("outputs", [])
+    return bool(outputs) and all(os.path.exists(path) for path in outputs)
+
+
+def save_snapshot(snapshot_path, snapshot, installed, local_packages,
+                  outputs):
+    """
+    Record snapshot, the packages installed in the chroot for the
+    build and which of them were built locally, and the paths of the
+    packages built, at snapshot_path
+    """
+    makedirs(os.path.dirname(snapshot_path))
+    record = dict(snapshot)
+    record["installed"] = installed
+    record["local"] = sorted(name for name, pkgid in installed.items()
+                             if pkgid in local_packages.pkgids(name))
+    record["outputs"] = sorted(outputs)
+    tmp_path = snapshot_path + ".tmp"
+    with open(tmp_path, "w") as snapshot_file:
+        json.dump(record, snapshot_file, indent=2, sort_keys=True)
+    os.rename(tmp_path, snapshot_path)
+
+
+class LocalStore(object):
+    """Build results stored in a local directory, one entry per key"""
+
+    def __init__(self, path):
+        self.path = path
+
+    def _entry(self, key):
+        """Return the directory holding the entry for key"""
+        return os.path.join(self.path, key[:2], key)
+
+    def fetch(self, key, destdir):
+        """
+        Copy the files stored under key to destdir.   Returns True if
+        the key was found, otherwise False.
+        """
+        entry = self._entry(key)
+        if not os.path.isdir(entry):
+            return False
+        for name in os.listdir(entry):
+            shutil.copy(os.path.join(entry, name), destdir)
+        return True
+
+    def store(self, key, srcdir):
+        """Store the files in srcdir under key"""
+        entry = self._entry(key)
+        if os.path.isdir(entry):
+            return
+        makedirs(os.path.dirname(entry))
+        tmpdir = tempfile.mkdtemp(prefix=".tmp-", dir=os.path.dirname(entry))
+        try:
+            for name in os.listdir(srcdir):
+                shutil.copy2(os.path.join(srcdir, name), tmpdir)
+            os.rename(tmpdir, entry)
+        except OSError:
+            # Another build stored the same result first
+            if not os.path.isdir(entry):
+                raise
+        finally:
+            if os.path.isdir(tmpdir):
+                shutil.rmtree(tmpdir)
+
+
+class HTTPStore(object):
+    """
+    Build results stored as tarballs on an HTTP server which supports
+    GET and PUT, such as a WebDAV share or a simple artifact store.
+    """
+
+    def __init__(self, url):
+        self.url = url.rstrip("/")
+        self.session = requests.Session()
+
+    def _entry(self, key):
+        """Return the URL of the entry for key"""
+        return "%s/%s.tar" % (self.url, key)
+
+    def fetch(self, key, destdir):
+        """
+        Download and unpack the files stored under key into destdir.
+        Returns True if the key was found, otherwise False.
+        """
+        response = self.session.get(self._entry(key), stream=True)
+        if response.status_code == 404:
+            return False
+        response.raise_for_status()
+        with tempfile.TemporaryFile() as tmpfile:
+            shutil.copyfileobj(response.raw, tmpfile)
+            tmpfile.seek(0)
+            with tarfile.open(fileobj=tmpfile) as tar:
+                for member in tar.getmembers():
+                    if member.isfile() and "/" not in member.name:
+                        tar.extract(member, destdir)
+        return True
+
+    def store(self, key, srcdir):
+        """Upload the files in srcdir under key"""
+        with tempfile.TemporaryFile() as tmpfile:
+            with tarfile.open(fileobj=tmpfile, mode="w") as tar:
+                for name in sorted(os.listdir(srcdir)):
+                    tar.add(os.path.join(srcdir, name), arcname=name)
+            tmpfile.seek(0)
+            response = self.session.put(self._entry(key), data=tmpfile)
+            response.raise_for_status()
+
+
+def open_store(location):
+    """
+    Return the result store at location, which may be a local
+    directory or an http(s) URL.
+    """
+    if location.startswith("http://") or location.startswith("https://"):
+        logging.debug("Using HTTP build result store at %s", location)
+        return HTTPStore(location)
+    logging.debug("Using local build result store at %s", location)
+    return LocalStore(location)
@@ -5,6 +5,9 @@ Common argparse utilities for planex command line tools
 import argparse
 import pkg_resources
 
+import planex.mirror
+import planex.refcache
+
 
 def common_base_parser():
     """
@@ -61,6 +64,73 @@ def keeptmp_parser():
     return parser
 
 
+def refcache_parser():
+    """
+    Returns a parser which handles the "--ref-cache" and
+    "--ref-cache-ttl" options, which control where listings of the refs
+    of git remotes are cached between invocations, and the "--frozen"
+    and "--write-lock" options, which read and write a lock file
+    recording the SHA1s resolved from remote refs.
+
+    This parser can then be used as a 'parent' to other parsers
+    which will inherit these options.
+
+    See https://docs.python.org/2.7/library/argparse.html#parents
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--ref-cache", metavar="DIR", default=None,
+                        help="Cache listings of remote git refs in DIR")
+    parser.add_argument("--ref-cache-ttl", metavar="SECONDS", type=int,
+                        default=planex.refcache.DEFAULT_TTL,
+                        help="Seconds for which cached listings of remote "
+                             "git refs are used")
+    lock = parser.add_mutually_exclusive_group()
+    lock.add_argument("--frozen", metavar="LOCKFILE", default=None,
+                      help="Resolve remote refs only from LOCKFILE, "
+                           "without using the network")
+    lock.add_argument("--write-lock", metavar="LOCKFILE", default=None,
+                      help="Record the remote refs resolved in LOCKFILE")
+    return parser
+
+
+def mirror_parser():
+    """
+    Returns a parser which handles the "--mirror-cache" and
+    "--mirror-ttl" options, which control where bare mirrors of git
+    remotes are kept and how often they are updated.
+
+    This parser can then be used as a 'parent' to other parsers
+    which will inherit these options.
+
+    See https://docs.python.org/2.7/library/argparse.html#parents
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--mirror-cache", metavar="DIR", default=None,
+                        help="Keep bare mirrors of git remotes in DIR")
+    parser.add_argument("--mirror-ttl", metavar="SECONDS", type=int,
+                        default=planex.mirror.DEFAULT_TTL,
+                        help="Seconds after which mirrors are updated "
+                             "before use")
+    return parser
+
+
+def link_index_parser():
+    """
+    Returns a parser which handles the "--link-index" option, which
+    names the index of link and pin files written by planex-depend.
+
+    This parser can then be used as a 'parent' to other parsers
+    which will inherit these options.
+
+    See https://docs.python.org/2.7/library/argparse.html#parents
+    """
+    parser = argparse.ArgumentParser(add_help=False)
+    parser.add_argument("--link-index", metavar="FILE", default=None,
+                        help="Read unchanged link and pin files from the "
+                             "index in FILE instead of parsing them")
+    return parser
+
+
 def rpm_macro(string):
     """
     Argparse type handler for RPM macro command line arguments of the form:
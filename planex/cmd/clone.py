@@ -5,12 +5,17 @@ from __future__ import print_function
 
 from string import Template
 import argparse
+from multiprocessing.pool import ThreadPool
 from os import symlink
-from os.path import basename, dirname, join, relpath
+from os.path import basename, dirname, isdir, join, relpath
 import subprocess
 
 import git
+from planex.cmd.args import mirror_parser
 from planex.link import Link
+from planex.mirror import open_cache
+import planex.refcache
+from planex.refcache import REF_CACHE
 import planex.util as util
 
 
@@ -18,7 +23,8 @@ def parse_args_or_exit(argv=None):
     """
     Parse command line options
     """
-    parser = argparse.ArgumentParser(description='Clone sources')
+    parser = argparse.ArgumentParser(description='Clone sources',
+                                     parents=[mirror_parser()])
     parser.add_argument("--jenkins", action="store_true",
                         help="Print Jenkinsfile fragment")
     parser.add_argument("--skip-base", dest="clone_base",
@@ -29,6 +35,20 @@ def parse_args_or_exit(argv=None):
     parser.add_argument(
         "-r", "--repos", metavar="DIR", default="repos",
         help='Local path to the repositories')
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=1,
+                        help="Number of pins to clone at once")
+    parser.add_argument("--depth", metavar="DEPTH", type=int, default=None,
+                        help="Clone only the last DEPTH commits of branches "
+                             "and tags")
+    parser.add_argument("--partial", action="store_true",
+                        help="Clone branches and tags without file contents "
+                             "(--filter=blob:none), fetching them on demand")
+    parser.add_argument("--reference", metavar="DIR", default=None,
+                        help="Directory of bare repositories, named "
+                             "<repo>.git, to borrow objects from")
+    parser.add_argument("--dissociate", action="store_true",
+                        help="Copy objects borrowed from mirrors or "
+                             "reference repositories into the clones")
     parser.add_argument("pins", metavar="PINS", nargs="*", help="pin file")
     return parser.parse_args(argv)
 
@@ -60,10 +80,55 @@ def clone_jenkins(url, destination, commitish, credentials):
                                        credentials=credentials))
 
 
-def clone(url, destination, commitish):
-    """Clone repository"""
+def is_branch_or_tag(url, commitish):
+    """Return True if commitish is a branch or tag of the remote at url"""
+    return bool(REF_CACHE.branch_sha1(url, commitish) or
+                REF_CACHE.is_tag(url, commitish))
+
+
+def clone_options(url, commitish, depth=None, partial=False, reference=None,
+                  mirrors=None, dissociate=False):
+    """
+    Return the options to pass to `git clone` for url.   History can
+    only be truncated, or file contents omitted, when commitish names a
+    branch or tag, because an arbitrary commit might not be reachable
+    from the refs fetched.   If mirrors is a MirrorCache, the mirror of
+    url is used as an alternate object store.   Otherwise, if reference
+    is a directory containing a bare repository with the same name as
+    url, that is used instead.   Borrowed objects are only copied into
+    the clone if dissociate is True.
+    """
+    # pylint: disable=too-many-arguments
+    options = {}
+    if (depth or partial) and is_branch_or_tag(url, commitish):
+        options["branch"] = commitish
+        if depth:
+            options["depth"] = depth
+        if partial:
+            options["filter"] = "blob:none"
+    if mirrors is not None:
+        options["reference"] = mirrors.mirror(url)
+    elif reference:
+        mirror = join(reference, repo_name(url) + ".git")
+        if isdir(mirror):
+            options["reference"] = mirror
+    if dissociate and "reference" in options:
+        options["dissociate"] = True
+    return options
+
+
+def clone(url, destination, commitish, **options):
+    """
+    Clone repository.   Options are passed to clone_options() to
+    choose how much of the repository is fetched.   A clone which
+    borrows objects from a mirror is recorded as one of its dependents.
+    """
     destination = join(destination, repo_name(url))
-    repo = git.Repo.clone_from(url, destination)
+    repo = git.Repo.clone_from(url, destination,
+                               **clone_options(url, commitish, **options))
+    mirrors = options.get("mirrors")
+    if mirrors is not None and not options.get("dissociate"):
+        mirrors.add_dependent(url, repo.git_dir)
     if commitish in repo.remotes['origin'].refs:
         branch_name = commitish
         commit = repo.remotes['origin'].refs[commitish]
@@ -112,29 +177,50 @@ def apply_patchqueue(base_repo, pq_repo, pq_dir):
                               cwd=base_repo.working_dir)
 
 
+def clone_pin(args, pinpath):
+    """
+    Clone the repositories referred to by the pin at pinpath and
+    apply its patchqueue
+    """
+    pin = Link(pinpath)
+    options = {"depth": args.depth, "partial": args.partial,
+               "reference": args.reference, "dissociate": args.dissociate,
+               "mirrors": open_cache(args.mirror_cache, args.mirror_ttl)}
+    try:
+        print("Cloning %s" % pin.url)
+        pq_repo = clone(pin.url, args.repos, pin.commitish, **options)
+
+        if args.clone_base and pin.base:
+            print("Cloning %s" % pin.base)
+            base_repo = clone(pin.base, args.repos, pin.base_commitish,
+                              **options)
+            apply_patchqueue(base_repo, pq_repo, pin.patchqueue)
+
+    except git.GitCommandError as gce:
+        print(gce.stderr)
+
+
 def main(argv=None):
     """
     Entry point
     """
     args = parse_args_or_exit(argv)
+    planex.refcache.configure(
+        mirrors=open_cache(args.mirror_cache, args.mirror_ttl))
 
-    for pinpath in args.pins:
-        pin = Link(pinpath)
-
-        if args.jenkins:
+    if args.jenkins:
+        for pinpath in args.pins:
+            pin = Link(pinpath)
             print('echo "Cloning %s"' % pin.url)
             clone_jenkins(pin.url, args.repos, pin.commitish, args.credentials)
-
-        else:
-            try:
-                print("Cloning %s" % pin.url)
-                util.makedirs(args.repos)
-                pq_repo = clone(pin.url, args.repos, pin.commitish)
-
-                if args.clone_base and pin.base:
-                    print("Cloning %s" % pin.base)
-                    base_repo = clone(pin.base, args.repos, pin.base_commitish)
-                    apply_patchqueue(base_repo, pq_repo, pin.patchqueue)
-
-            except git.GitCommandError as gce:
-                print(gce.stderr)
+        return
+
+    util.makedirs(args.repos)
+    if args.jobs > 1:
+        pool = ThreadPool(args.jobs)
+        pool.map(lambda pinpath: clone_pin(args, pinpath), args.pins)
+        pool.close()
+        pool.join()
+    else:
+        for pinpath in args.pins:
+            clone_pin(args, pinpath)
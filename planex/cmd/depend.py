@@ -7,80 +7,45 @@ import argparse
 import os
 import re
 import sys
-import urlparse
 
 import argcomplete
 from planex.cmd.args import common_base_parser, rpm_define_parser
 from planex.util import setup_sigint_handler, dedupe
-from planex.cmd import manifest
-from planex.spec import Spec, SpecNameMismatch
-from planex.link import Link
+import planex.graph as graph
+from planex.graph import package_to_rpm_map  # pylint: disable=W0611
+from planex.spec import SpecNameMismatch, parse_specs
+from planex.link import LinkIndex
 
 
-def create_manifest_deps(spec):
+def print_rules(rules):
     """
-    Create depependencies for package manifest
+    Print rules in Makefile format
     """
-    prereqs = spec.specpath()
-    spec_name = spec.name()
-    lnk_path = 'SPECS/{}.lnk'.format(spec_name)
+    for rule in rules:
+        if rule.note:
+            print('# %s' % rule.note)
+        print('%s: %s' % (rule.target, rule.prereq))
 
-    if os.path.isfile(lnk_path):
-        prereqs += ' ' + lnk_path
 
-    print('{}: {}'.format(manifest.get_path(spec_name), prereqs))
-    print('{}: {}'.format(spec.source_package_path(),
-                          manifest.get_path(spec.name())))
+def create_manifest_deps(spec):
+    """
+    Create depependencies for package manifest
+    """
+    print_rules(graph.manifest_rules(spec))
 
 
 def build_srpm_from_spec(spec, lnk=None):
     """
     Generate rules to build SRPM from spec
     """
-    srpmpath = spec.source_package_path()
-    print('%s: %s' % (srpmpath, spec.specpath()))
-    if lnk:
-        print('%s: %s' % (srpmpath, lnk.linkpath))
-
-    for (path, source) in spec.sources():
-        url = urlparse.urlparse(source)
-        if url.scheme in ["http", "https", "file", "ftp"]:
-            # Source was downloaded to _build/SOURCES
-            print('%s: %s' % (srpmpath, path))
-        elif lnk and (lnk.sources is not None or lnk.has_patches):
-            # Use sources from patchqueue
-            pass
-        else:
-            # Source is local
-            print('%s: %s' % (srpmpath, "/".join(path.split("/")[1:])))
+    print_rules(graph.srpm_rules(spec, lnk))
 
 
 def download_rpm_sources(spec, lnk=None):
     """
     Generate rules to download sources
     """
-    for (path, source) in spec.sources():
-        url = urlparse.urlparse(source)
-        if url.scheme in ["http", "https", "file", "ftp"]:
-            # Source can be fetched by fetch
-            print('%s: %s' % (path, spec.specpath()))
-
-    if lnk:
-        srpmpath = spec.source_package_path()
-        if lnk.schema_version == 1:
-            patch_depends('patches', spec, srpmpath, lnk.linkpath)
-        elif lnk.schema_version >= 2:
-            patches = lnk.patch_sources
-            for patch in patches:
-                patch_url = patches[patch]['URL']
-                print('# %s => %s' % (patch, patch_url))
-                patch_depends(patch, spec, srpmpath, lnk.linkpath)
-
-            patchqueues = lnk.patchqueue_sources
-            for patchqueue in patchqueues:
-                patch_url = patchqueues[patchqueue]['URL']
-                print('# %s => %s' % (patchqueue, patch_url))
-                patch_depends(patchqueue, spec, srpmpath, lnk.linkpath)
+    print_rules(graph.fetch_rules(spec, lnk))
 
 
 def build_rpm_from_srpm(spec):
@@ -88,49 +53,34 @@ def build_rpm_from_srpm(spec):
     Generate rules to build RPMS from SRPMS.
     Extracts binary package names from the spec file.
     """
-    # We only generate a rule for the first binary RPM produced by the
-    # specfile.  If we generate multiple rules (one for the base package,
-    # one for -devel and so on), make will interpret these as completely
-    # separate targets which must be built separately.   At best, this means
-    # that the same package will be built more than once; at worst, in a
-    # concurrent build, there is a risk that the targets might not be rebuilt
-    # correctly.
-    #
-    # Make does understand the concept of multiple targets being built by
-    # a single rule invocation, but only for pattern rules (e.g. %.h %.c: %.y).
-    # It is tricky to generate correct pattern rules for RPM builds.
+    print_rules(graph.rpm_rules(spec))
 
-    rpm_path = spec.binary_package_paths()[-1]
-    srpm_path = spec.source_package_path()
-    print('%s: %s' % (rpm_path, srpm_path))
 
-
-def package_to_rpm_map(specs):
+def buildrequires_for_rpm(spec, provides_to_rpm):
     """
-    Generate a mapping from RPM package names to the RPM files
-    which provide them.
+    Generate build dependency rules between binary RPMs
     """
-    provides_to_rpm = {}
-    for spec in specs:
-        for provided in spec.provides():
-            provides_to_rpm[provided] = spec.binary_package_paths()[-1]
-    return provides_to_rpm
+    print_rules(graph.buildrequires_rules(spec, provides_to_rpm))
 
 
-def buildrequires_for_rpm(spec, provides_to_rpm):
+def build_order(specs, provides_to_rpm):
     """
-    Generate build dependency rules between binary RPMs
+    Return specs sorted so that each package comes after the local
+    packages it BuildRequires or Requires.
+    See planex.graph.DependencyGraph.build_order.
     """
-    rpmpath = spec.binary_package_paths()[-1]
-    # Package's Requires must exist for it to be installed as a
-    # BuildRequire of a later package, so we make it depend on
-    # Requires as well as BuildRequires to ensure they are built.
-    buildreqs = (spec.buildrequires() | spec.requires()) - spec.provides()
-    for buildreq in buildreqs:
-        # Some buildrequires come from the system repository
-        if buildreq in provides_to_rpm:
-            buildreqrpm = provides_to_rpm[buildreq]
-            print("%s: %s" % (rpmpath, buildreqrpm))
+    rpm_to_name = {spec.summary.rpm_path: spec.summary.name
+                   for spec in specs}
+    depgraph = graph.DependencyGraph()
+    for spec in specs:
+        requires = {}
+        for req, rpm_path in graph.local_requires(spec, provides_to_rpm):
+            requires.setdefault(rpm_to_name[rpm_path], []).append(req)
+        summary = spec.summary
+        depgraph.add_package(summary.name, summary.rpm_path,
+                             summary.source_package_path, [], requires)
+    by_name = {spec.summary.name: spec for spec in specs}
+    return [by_name[name] for name in depgraph.build_order()]
 
 
 def parse_args_or_exit(argv=None):
@@ -149,6 +99,26 @@ def parse_args_or_exit(argv=None):
         "--no-buildrequires", dest="buildrequires",
         action="store_false", default=True,
         help="Don't generate dependency rules for BuildRequires")
+    parser.add_argument(
+        "--affected", metavar="FILE", nargs="+", default=None,
+        help="Instead of Makefile rules, print the packages which must be "
+             "rebuilt if any of the given spec, link, pin or source files "
+             "change, in build order")
+    parser.add_argument(
+        "--fail-on-cycles", action="store_true", default=False,
+        help="Exit with an error if packages depend on each other in a "
+             "cycle, instead of only reporting the cycle")
+    parser.add_argument(
+        "-j", "--jobs", metavar="N", type=int, default=1,
+        help="Number of spec files to parse at once")
+    parser.add_argument(
+        "--link-index", metavar="FILE", default=None,
+        help="Write an index of the link and pin files to FILE, for "
+             "other planex tools to read with --link-index")
+    parser.add_argument(
+        "--graph-cache", metavar="FILE", default=None,
+        help="Cache the dependency graph in FILE, and reuse it while the "
+             "input files are unchanged")
     argcomplete.autocomplete(parser)
     return parser.parse_args(argv)
 
@@ -169,65 +139,168 @@ def dedupe_key(path):
     return os.path.basename(re.sub(r"\.pin$", ".lnk", path))
 
 
-def patch_depends(patch_name, spec, srpmpath, linkpath):
-    """Output the dependencies for a patchset"""
-    patchpath = spec.expand_macro('%_sourcedir/{}.tar'.format(patch_name))
-    print('%s: %s' % (srpmpath, patchpath))
-    print('%s: %s' % (patchpath, linkpath))
+def graph_cache_key(args, paths):
+    """
+    Return the key identifying the inputs from which the dependency
+    graph is built: the input files and their modification times and
+    sizes, the link files found beside the specs, and the RPM macro
+    definitions used to parse the specs.
+    """
+    inputs = []
+    for path in paths:
+        info = os.stat(path)
+        inputs.append((path, info.st_mtime, info.st_size))
+        if path.endswith(".spec"):
+            inputs.append(os.path.isfile(
+                'SPECS/{}.lnk'.format(pkgname(path))))
+    return repr((inputs, args.define))
 
 
-def main(argv=None):
+def load_graph(args, paths, index):
     """
-    Entry point
+    Return the dependency graph for the spec and link files in paths,
+    loading it from the graph cache if it is up to date.   Link and pin
+    files are read from the LinkIndex index where it is up to date.
     """
-    setup_sigint_handler()
-    args = parse_args_or_exit(argv)
-    allspecs = dedupe(args.specs, dedupe_key)
-
+    key = None
+    if args.graph_cache:
+        key = graph_cache_key(args, paths)
+        depgraph = graph.DependencyGraph.load(args.graph_cache, key)
+        if depgraph is not None:
+            return depgraph
+
+    # Packages are added to the graph in the order they were given, so
+    # that the rules are written in a stable order
+    spec_paths = [path for path in paths if path.endswith(".spec")]
     try:
-        specs = {pkgname(path): Spec(path, defines=args.define)
-                 for path in allspecs
-                 if path.endswith(".spec")}
+        specs = parse_specs(spec_paths, jobs=args.jobs, defines=args.define,
+                            with_files=True)
     except SpecNameMismatch as exn:
         sys.stderr.write("error: %s\n" % exn.message)
         sys.exit(1)
 
-    links = {pkgname(path): Link(path)
-             for path in allspecs
+    links = {pkgname(path): index.get(path)
+             for path in paths
              if path.endswith(".lnk") or path.endswith(".pin")}
 
-    provides_to_rpm = package_to_rpm_map(specs.values())
+    depgraph = graph.DependencyGraph.from_specs(specs, links)
+    if args.graph_cache:
+        depgraph.save(args.graph_cache, key)
+    return depgraph
 
-    print("# -*- makefile -*-")
-    print("# vim:ft=make:")
-    if args.verbose:
-        print("# inputs: %s" % " ".join(allspecs))
 
-    for spec in specs.itervalues():
-        print('# %s' % (spec.name()))
-
-        build_srpm_from_spec(spec, links.get(spec.name()))
-        # Manifest dependencies must come after spec dependencies
-        # otherwise manifest.json will be the SRPM's first dependency
-        # and will be passed to rpmbuild in the spec position.
-        create_manifest_deps(spec)
-        download_rpm_sources(spec, links.get(spec.name()))
-        build_rpm_from_srpm(spec)
-        if args.buildrequires:
-            buildrequires_for_rpm(spec, provides_to_rpm)
+def write_link_index(index_path, paths, previous):
+    """
+    Write the link index at index_path for the link and pin files in
+    paths.   Files whose entries in previous, the existing index, are
+    up to date are not parsed again, and the index is left untouched if
+    nothing has changed.
+    """
+    index = LinkIndex()
+    for path in paths:
+        if path.endswith(".lnk") or path.endswith(".pin"):
+            index.add(previous.get(path))
+    if index.entries != previous.entries:
+        index.save(index_path)
+
+
+def emit_makefile(depgraph, buildrequires=True):
+    """
+    Print Makefile rules for every package in depgraph
+    """
+    for name in depgraph.packages:
+        print('# %s' % name)
+        print_rules(rule for rule in depgraph.rules[name]
+                    if buildrequires or rule.kind != graph.BUILDREQUIRES)
         print()
 
-    # Generate targets to build all srpms and all rpms
+    # Generate targets to build all srpms and all rpms.  The lists are
+    # in build order, so that all SRPMS can be built in a single mock
+    # chain.
     all_rpms = []
     all_srpms = []
-    for spec in specs.itervalues():
-        rpm_path = spec.binary_package_paths()[-1]
-        all_rpms.append(rpm_path)
-        all_srpms.append(spec.source_package_path())
-        print("%s: %s" % (spec.name(), rpm_path))
-        print("%s.srpm: %s" % (spec.name(), spec.source_package_path()))
+    for name in depgraph.build_order():
+        all_rpms.append(depgraph.rpm[name])
+        all_srpms.append(depgraph.srpm[name])
+        print("%s: %s" % (name, depgraph.rpm[name]))
+        print("%s.srpm: %s" % (name, depgraph.srpm[name]))
     print()
 
     print("RPMS := " + " \\\n\t".join(all_rpms))
     print()
     print("SRPMS := " + " \\\n\t".join(all_srpms))
+
+
+def report_cycles(depgraph, fatal=False):
+    """
+    Report each dependency cycle in depgraph on stderr, with the
+    requirements which form it.   Returns the number of cycles found.
+    """
+    cycles = depgraph.cycles()
+    level = "error" if fatal else "warning"
+    for cycle in cycles:
+        sys.stderr.write("%s: dependency cycle between %s\n"
+                         % (level, ", ".join(cycle)))
+        for name, dep, reqs in depgraph.cycle_edges(cycle):
+            sys.stderr.write("    %s requires %s (%s)\n"
+                             % (name, dep, ", ".join(reqs)))
+    return len(cycles)
+
+
+def changed_packages(depgraph, paths):
+    """
+    Return the names of the packages in depgraph which are built
+    directly from any of the files in paths.   Pin files match the
+    package of the same name.
+    """
+    names = set()
+    for path in paths:
+        owners = depgraph.owners.get(os.path.normpath(path))
+        if owners:
+            names.update(owners)
+        elif pkgname(path) in depgraph.rpm:
+            names.add(pkgname(path))
+        else:
+            sys.stderr.write("warning: %s is not used by any package\n"
+                             % path)
+    return names
+
+
+def affected_packages(depgraph, paths):
+    """
+    Return the names of the packages which must be rebuilt if any of
+    the files in paths change, in build order: those built from the
+    files and, transitively, every package which requires them.
+    """
+    affected = depgraph.closure(changed_packages(depgraph, paths),
+                                reverse=True)
+    return depgraph.build_order(affected)
+
+
+def main(argv=None):
+    """
+    Entry point
+    """
+    setup_sigint_handler()
+    args = parse_args_or_exit(argv)
+    allspecs = dedupe(args.specs, dedupe_key)
+    index = LinkIndex()
+    if args.link_index:
+        index = LinkIndex.load(args.link_index)
+    depgraph = load_graph(args, allspecs, index)
+    if args.link_index:
+        write_link_index(args.link_index, allspecs, index)
+    if report_cycles(depgraph, args.fail_on_cycles) and args.fail_on_cycles:
+        sys.exit(1)
+
+    if args.affected is not None:
+        for name in affected_packages(depgraph, args.affected):
+            print(name)
+        return
+
+    print("# -*- makefile -*-")
+    print("# vim:ft=make:")
+    if args.verbose:
+        print("# inputs: %s" % " ".join(allspecs))
+
+    emit_makefile(depgraph, args.buildrequires)
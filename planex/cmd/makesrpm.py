@@ -110,7 +110,7 @@ def add_gitsha_provides(manifests):
     """
     Add the source line and additional provides to the current location
     """
-    for key in manifests:
+    for key in sorted(manifests):
         print('Provides: gitsha({0}) = {1}'.format(key, manifests[key]))
 
 
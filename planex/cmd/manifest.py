@@ -1,19 +1,31 @@
 """
 planex-manifest: Generate manifest in JSON format from spec/link files.
 
-Every invocation prints the manifest for a single package in stdout.
+By default, every invocation prints the manifest for a single package in
+stdout.   With --all, manifests for every package given are written to
+files in an output directory.   Running with --all and --write-lock
+refreshes a lock file for every package in one concurrent batch; later
+runs with --frozen reproduce the same SHA1s without the network.
 """
 from __future__ import print_function
 
 import argparse
+from collections import OrderedDict
 import json
+import logging
+from multiprocessing.pool import ThreadPool
 import os
+import sys
 
 import argcomplete
 
-from planex.cmd.args import common_base_parser
-from planex.util import setup_logging
-from planex.link import Link
+from planex.cmd.args import (common_base_parser, link_index_parser,
+                              mirror_parser, refcache_parser)
+from planex.fileupdate import FileUpdate
+from planex.mirror import open_cache
+import planex.refcache
+from planex.util import makedirs, setup_logging
+from planex.link import Link, LinkIndex
 from planex.spec import Spec
 from planex.repository import Repository
 
@@ -23,21 +35,16 @@ def parse_args_or_exit(argv=None):
 
     parser = argparse.ArgumentParser(
         description='Generate manifest in JSON format from spec/link files',
-        parents=[common_base_parser()]
+        parents=[common_base_parser(), refcache_parser(),
+                 mirror_parser(), link_index_parser()]
     )
 
     parser.add_argument(
-        'specfile_path',
-        metavar='SPEC',
-        help='path/to/<spec_file>'
-    )
-
-    parser.add_argument(
-        'lnkfile_path',
-        metavar='LNK',
-        nargs='?',
-        default=None,
-        help='path/to/<lnk_file>'
+        'paths',
+        metavar='SPEC [LNK]',
+        nargs='+',
+        help='path/to/<spec_file> and optionally path/to/<lnk_file>. '
+             'With --all, any number of spec and lnk files.'
     )
 
     parser.add_argument(
@@ -47,8 +54,46 @@ def parse_args_or_exit(argv=None):
         help='path/to/pins'
     )
 
+    parser.add_argument(
+        '--all',
+        action='store_true',
+        help='Write a manifest for every spec file given'
+    )
+
+    parser.add_argument(
+        '--output-dir',
+        metavar='DIR',
+        default='_build/MANIFESTS',
+        help='Directory in which --all writes manifests'
+    )
+
+    parser.add_argument(
+        '--jobs', '-j',
+        metavar='N',
+        type=int,
+        default=8,
+        help='Number of remote repositories to query at once'
+    )
+
+    parser.add_argument(
+        '--timeout',
+        metavar='SECONDS',
+        type=float,
+        default=None,
+        help='Maximum time to wait for each remote repository query'
+    )
+
     argcomplete.autocomplete(parser)
-    return parser.parse_args(argv)
+    args = parser.parse_args(argv)
+
+    if not args.all:
+        if len(args.paths) > 2:
+            parser.error('only one spec and one lnk file may be given '
+                         'without --all')
+        args.specfile_path = args.paths[0]
+        args.lnkfile_path = args.paths[1] if len(args.paths) > 1 else None
+
+    return args
 
 
 def get_path(package_name):
@@ -66,12 +111,97 @@ def get_name(spec_path, link_path):
     return name
 
 
-def generate_manifest(spec, link=None, pin=None):
+def remote_source_urls(spec):
+    """Return the URLs of the spec's sources which are remote"""
+    return [url for (_, url) in spec.summary.sources if '://' in url]
+
+
+def resolve_sha1(url):
+    """Return the SHA1 of the commit which url points at"""
+    return Repository(url).sha1
+
+
+def pin_url(pin):
+    """Return the URL in the pin file at path pin"""
+    with open(pin) as pinfile:
+        return json.load(pinfile)['URL']
+
+
+def manifest_urls(spec, link=None, pin=None):
+    """Return the remote URLs whose SHA1s appear in the manifest"""
+    # Sources taken from artifactory do not have SHA1
+    urls = [url for url in remote_source_urls(spec)
+            if 'repo.citrite.net' not in url]
+    if link is not None and link.url:
+        urls.append(link.url)
+    if pin is not None:
+        urls.append(pin_url(pin))
+    return urls
+
+
+class SHA1Resolver(object):
+    """
+    Resolves the SHA1s of remote URLs.   If more than one job is
+    allowed and there is more than one URL, resolution of all the URLs
+    starts immediately in a pool of at most one thread per URL.
+    Results are returned in whichever order they are asked for, so
+    callers can preserve their own ordering.   Use as a context manager
+    to wait for the pool to finish.
+    """
+
+    def __init__(self, urls, jobs=1):
+        self.sha1s = {}
+        self.pending = {}
+        self.pool = None
+        urls = list(OrderedDict.fromkeys(urls))
+        if jobs > 1 and len(urls) > 1:
+            self.pool = ThreadPool(min(jobs, len(urls)))
+            try:
+                for url in urls:
+                    self.pending[url] = self.pool.apply_async(resolve_sha1,
+                                                              (url,))
+            finally:
+                self.pool.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        """
+        Wait for the pool's threads to exit.   Each query is bounded by
+        the timeout configured in planex.refcache, so this cannot hang
+        on an unresponsive remote.
+        """
+        if self.pool is not None:
+            self.pool.join()
+        self.pool = None
+
+    def sha1(self, url):
+        """
+        Return the SHA1 of url, waiting for it to be resolved if it is
+        being resolved concurrently.   Errors raised while resolving
+        url are re-raised.
+        """
+        if url not in self.sha1s:
+            if url in self.pending:
+                self.sha1s[url] = self.pending.pop(url).get()
+            else:
+                self.sha1s[url] = resolve_sha1(url)
+        return self.sha1s[url]
+
+
+def generate_manifest(spec, link=None, pin=None, resolver=None):
     """Record info of all remote sources in the spec/link files.
 
     Args:
         spec (planex.spec.Spec): package's spec file
         link (dict/None): package's link file, if applicable
+        pin (str/None): path to package's pin file, if applicable
+        resolver (SHA1Resolver/None): resolver for remote SHA1s,
+            which may already be resolving them concurrently
 
     Returns:
         (dict): manifest of the remote sources
@@ -98,37 +228,89 @@ def generate_manifest(spec, link=None, pin=None):
         }
     """
 
+    if resolver is None:
+        resolver = SHA1Resolver(manifest_urls(spec, link, pin))
+
     manifest = {'spec': {}}
-    source_urls = [url for (_, url) in spec.sources() if '://' in url]
+    source_urls = remote_source_urls(spec)
 
     for i, url in enumerate(source_urls):
         # Sources taken from artifactory do not have SHA1
         if 'repo.citrite.net' not in url:
-            repo_ref = Repository(url)
-            sha1 = repo_ref.sha1
+            sha1 = resolver.sha1(url)
         else:
             sha1 = None
 
         manifest['spec']['source' + str(i)] = {'url': url, 'sha1': sha1}
 
     if link is not None and link.url:
-        repo_ref = Repository(link.url)
-        sha1 = repo_ref.sha1
+        sha1 = resolver.sha1(link.url)
         manifest['lnk'] = {'url': link.url, 'sha1': sha1}
 
     if pin is not None:
-        with open(pin) as pinfile:
-            pin_dict = json.load(pinfile)
-            url = pin_dict['URL']
+        url = pin_url(pin)
+        # pylint: disable=broad-except
+        try:
+            sha1 = resolver.sha1(url)
+        except Exception:
+            sha1 = None
+        manifest['pin'] = {'url': url, 'sha1': sha1}
+
+    return manifest
+
+
+def pin_path(pinsdir, name):
+    """Return the path to the pin file for package name, if it exists"""
+    pinfile = "{}/{}.pin".format(pinsdir, name)
+    if os.path.exists(pinfile):
+        return pinfile
+    return None
+
+
+def write_manifest(manifest, path):
+    """Write manifest to path, leaving it untouched if unchanged"""
+    with FileUpdate(path) as outfile:
+        outfile.write(json.dumps(manifest, indent=4) + "\n")
+
+
+def generate_all(args):
+    """
+    Write manifests for all the spec files in args.paths to
+    args.output_dir, resolving remote URLs concurrently.   A package
+    whose manifest cannot be generated is reported and skipped, and
+    the run exits with an error once every other manifest is written.
+    """
+    specs = [path for path in args.paths if path.endswith(".spec")]
+    index = LinkIndex.load(args.link_index) if args.link_index else LinkIndex()
+    links = {get_name(None, path): index.get(path)
+             for path in args.paths if path.endswith(".lnk")}
+
+    packages = {}
+    for spec_path in specs:
+        name = get_name(spec_path, None)
+        packages[name] = (Spec(spec_path), links.get(name),
+                          pin_path(args.pinsdir, name))
+
+    urls = []
+    for name in sorted(packages):
+        urls += manifest_urls(*packages[name])
+    makedirs(args.output_dir)
+    failed = []
+    with SHA1Resolver(urls, args.jobs) as resolver:
+        for name in sorted(packages):
+            spec, link, pin = packages[name]
             # pylint: disable=broad-except
             try:
-                repo_ref = Repository(url)
-                sha1 = repo_ref.sha1
-            except Exception:
-                sha1 = None
-            manifest['pin'] = {'url': url, 'sha1': sha1}
+                manifest = generate_manifest(spec, link, pin, resolver)
+            except Exception as exc:
+                logging.error("%s: %s", name, exc)
+                failed.append(name)
+                continue
+            write_manifest(manifest, os.path.join(args.output_dir,
+                                                  name + ".json"))
 
-    return manifest
+    if failed:
+        sys.exit("Failed to generate manifests for: %s" % " ".join(failed))
 
 
 def main(argv=None):
@@ -136,20 +318,28 @@ def main(argv=None):
 
     args = parse_args_or_exit(argv)
     setup_logging(args)
+    planex.refcache.configure(args.ref_cache, args.ref_cache_ttl,
+                              open_cache(args.mirror_cache, args.mirror_ttl),
+                              args.timeout)
+    if args.frozen:
+        planex.refcache.freeze(args.frozen)
+
+    if args.all:
+        generate_all(args)
+    else:
+        spec = Spec(args.specfile_path)
 
-    spec = Spec(args.specfile_path)
+        link = None
+        if args.lnkfile_path is not None:
+            link = Link(args.lnkfile_path)
 
-    link = None
-    if args.lnkfile_path is not None:
-        link = Link(args.lnkfile_path)
+        pin = pin_path(args.pinsdir,
+                       get_name(args.specfile_path, args.lnkfile_path))
 
-    pin = None
-    pinfile = "{}/{}.pin".format(
-        args.pinsdir,
-        get_name(args.specfile_path, args.lnkfile_path)
-        )
-    if os.path.exists(pinfile):
-        pin = pinfile
+        with SHA1Resolver(manifest_urls(spec, link, pin),
+                          args.jobs) as resolver:
+            manifest = generate_manifest(spec, link, pin, resolver)
+        print(json.dumps(manifest, indent=4))
 
-    manifest = generate_manifest(spec, link, pin)
-    print(json.dumps(manifest, indent=4))
+    if args.write_lock:
+        planex.refcache.write_lock(args.write_lock)
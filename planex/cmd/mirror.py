@@ -0,0 +1,51 @@
+"""
+planex-mirror: Create, update and garbage collect bare mirrors of
+git remotes in a mirror cache.
+"""
+from __future__ import print_function
+
+import argparse
+
+import argcomplete
+
+from planex.cmd.args import common_base_parser, mirror_parser
+from planex.mirror import open_cache
+import planex.util as util
+
+
+def parse_args_or_exit(argv=None):
+    """
+    Parse command line options
+    """
+    parser = argparse.ArgumentParser(
+        description='Manage a cache of bare mirrors of git remotes',
+        parents=[common_base_parser(), mirror_parser()])
+    parser.add_argument("urls", metavar="URL", nargs="*",
+                        help="Remote to mirror, or update if stale")
+    parser.add_argument("--gc", action="store_true",
+                        help="Remove mirrors which have not been used "
+                             "recently")
+    parser.add_argument("--max-age", metavar="DAYS", type=float, default=30,
+                        help="Days after which unused mirrors are removed "
+                             "by --gc")
+    argcomplete.autocomplete(parser)
+    args = parser.parse_args(argv)
+    if args.mirror_cache is None:
+        parser.error("--mirror-cache is required")
+    return args
+
+
+def main(argv=None):
+    """
+    Entry point
+    """
+    args = parse_args_or_exit(argv)
+    util.setup_logging(args)
+    mirrors = open_cache(args.mirror_cache, args.mirror_ttl)
+
+    for url in args.urls:
+        print(mirrors.mirror(url))
+
+    if args.gc:
+        for path in mirrors.gc(args.max_age * 24 * 60 * 60):
+            print("Removed %s" % path)
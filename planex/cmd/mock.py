@@ -3,8 +3,10 @@ planex-build-mock: Wrapper around mock
 """
 from __future__ import print_function
 
+from collections import OrderedDict
+import hashlib
+import logging
 import os
-import pty
 import shutil
 import subprocess
 import sys
@@ -13,11 +15,19 @@ from uuid import uuid4
 
 import argparse
 import argcomplete
+import planex.buildcache
 import planex.cmd.args
+import planex.process
 from planex.spec import rpm_macros
+from planex.util import lock_file, makedirs
 import rpm
 
 
+# Stands for the path of each build's loopback repository in cached
+# mock configurations
+LOOPBACK_PLACEHOLDER = "@PLANEX_LOOPBACK_REPO@"
+
+
 def parse_args_or_exit(argv=None):
     """
     Parse command line options
@@ -42,53 +52,59 @@ def parse_args_or_exit(argv=None):
     parser.add_argument(
         "--rebuild", metavar="SRPM", nargs="+", dest="srpms",
         help='rebuild the specified SRPM(s)')
+    parser.add_argument(
+        "--chain", metavar="SRPM", nargs="+", dest="chain",
+        help='rebuild the specified SRPMs in order in a single chroot, '
+             'making the results of each build available to the next')
     parser.add_argument(
         "--loopback-config-extra", action='append', default=[],
         help='add extra lines to the loopback repo stanza')
+    parser.add_argument(
+        "--config-cache", metavar="DIR", default=None,
+        help="Reuse generated mock configurations stored in DIR")
+    parser.add_argument(
+        "--jobs", "-j", metavar="N", type=int, default=1,
+        help="rebuild up to N of the SRPMs given to --rebuild concurrently, "
+             "each in its own chroot")
+    parser.add_argument(
+        "--result-cache", metavar="DIR_OR_URL", default=None,
+        help="restore build results from, and save them to, the cache "
+             "stored in a local directory or at an HTTP URL")
+    parser.add_argument(
+        "--snapshot-dir", metavar="DIR", default=None,
+        help="record the build dependencies installed for each SRPM in "
+             "DIR, and skip rebuilding SRPMs whose dependencies have not "
+             "changed")
+    parser.add_argument(
+        "--logdir", metavar="DIR", default=None,
+        help="write the output of each mock invocation to DIR/<srpm>.log")
     argcomplete.autocomplete(parser)
     return parser.parse_args(argv)
 
 
-def pty_check_call(cmd):
+def pty_check_call(cmd, name=None, logdir=None):
     """
     Runs the given command in a subprocess with I/O redirected through a pty.
     This ensures isatty(3) will return 1.
     An exception is raised if the command exits with non-zero status.
     """
-    # python2.7 doesn't return the exitcode here:
-    pty.spawn(cmd)
-    # get exit status of first child
-    (pid, status) = os.waitpid(-1, 0)
-    returncode = 1
-    if status == 0:
-        returncode = 0
-    elif os.WIFEXITED(status):
-        returncode = os.WEXITSTATUS(status)
-        print("PID %d exited with status %d" % (pid, returncode))
-    elif os.WIFSIGNALED(status):
-        signal = os.WTERMSIG(status)
-        print("PID %d exited with signal %d" % (pid, signal))
-    else:
-        print("PID %d exited with non-zero status 0x%02x" % (pid, status))
-    if returncode > 0:
-        raise subprocess.CalledProcessError(returncode, cmd)
+    planex.process.check_call(cmd, name, logdir)
 
 
-def mock(args, tmp_config_dir, *extra_params):
+def mock_command(args, config_dir, uniqueext, resultdir):
     """
-    Return mock command line and arguments
+    Return the mock command line and common arguments
     """
-    print("Mock args are %s" % args)
     cmd = ['mock']
-    cmd += ["--uniqueext", uuid4().hex]
-    cmd += ['--configdir', tmp_config_dir]
+    cmd += ["--uniqueext", uniqueext]
+    cmd += ['--configdir', config_dir]
 
     if args.quiet:
         cmd += ['--quiet']
     if args.root is not None:
         cmd += ['--root', args.root]
-    if args.resultdir is not None:
-        cmd += ["--resultdir", args.resultdir]
+    if resultdir is not None:
+        cmd += ["--resultdir", resultdir]
 
     for key, value in args.define:
         # _topdir should only be used to figure out the RPM paths outside
@@ -97,18 +113,44 @@ def mock(args, tmp_config_dir, *extra_params):
         if key != "_topdir":
             cmd += ['--define', '%s %s' % (key, value)]
 
+    return cmd
+
+
+def job_name(srpm):
+    """
+    Return the name used to label the output of the mock invocation
+    which rebuilds srpm
+    """
+    name = os.path.basename(srpm)
+    if name.endswith(".src.rpm"):
+        name = name[:-len(".src.rpm")]
+    return name
+
+
+def mock(args, tmp_config_dir, *extra_params):
+    """
+    Run mock in a new chroot with the given extra parameters
+    """
+    print("Mock args are %s" % args)
+    cmd = mock_command(args, tmp_config_dir, uuid4().hex, args.resultdir)
     cmd.extend(extra_params)
+    name = "mock"
+    if args.srpms:
+        name = job_name(args.srpms[0])
     # mock produces more output when stderr isatty, so use a pty to fake that
     # subprocess.check_call(cmd)
-    pty_check_call(cmd)
+    pty_check_call(cmd, name, args.logdir)
 
 
-def createrepo(pkg_dir, metadata_dir, quiet=False):
+def createrepo(pkg_dir, metadata_dir, quiet=False, update=False):
     """
     Run createrepo.   Repository metadata will be created in
-    metadata_dir/repodata.
+    metadata_dir/repodata.   If update is True, existing metadata
+    is reused for packages which have not changed.
     """
     cmd = ['createrepo']
+    if update:
+        cmd += ['--update']
     cmd += ['--baseurl=file://%s' % pkg_dir]
     cmd += ['--outputdir=%s' % metadata_dir]
     cmd += [pkg_dir]
@@ -117,6 +159,22 @@ def createrepo(pkg_dir, metadata_dir, quiet=False):
     subprocess.check_call(cmd)
 
 
+def loopback_stanza(repo_path, extra_conf_list):
+    """
+    Return the lines of a yum repository stanza for the loopback
+    repository at repo_path.
+    """
+    stanza = ["[mock-loopback]",
+              "name=Mock output",
+              "baseurl = file://%s" % repo_path,
+              "gpgcheck=0",
+              "priority=1",
+              "enabled=1",
+              "metadata_expire=0"]
+    stanza += extra_conf_list
+    return [line + "\n" for line in stanza] + ["\n"]
+
+
 def insert_loopback_repo(
         config_in_path,
         config_out_path,
@@ -133,31 +191,391 @@ def insert_loopback_repo(
             for line in config_in:
                 config_out.write(line)
                 if "config_opts['yum.conf']" in line:
-                    config_out.write("[mock-loopback-%d]\n" % os.getpid())
-                    config_out.write("name=Mock output\n")
-                    config_out.write("baseurl = file://%s\n" % repo_path)
-                    config_out.write("gpgcheck=0\n")
-                    config_out.write("priority=1\n")
-                    config_out.write("enabled=1\n")
-                    config_out.write("metadata_expire=0\n")
-                    for conf_line in extra_conf_list:
-                        config_out.write(conf_line + '\n')
-                    config_out.write("\n")
+                    config_out.writelines(
+                        loopback_stanza(repo_path, extra_conf_list))
     shutil.copystat(config_in_path, config_out_path)
 
 
-def clone_mock_config(configdir, tmpdir):
+def materialise_mock_config(configdir, root, repo_path, extra_conf_list,
+                            clonedir):
     """
-    Copy mock configuration files into a temporary directory,
-    retaining modification times to prevent the mock chroot
-    cache from being rebuilt.
-    Returns the path to the temporary configuration.
+    Populate clonedir with a mock configuration based on configdir.
+    Every file other than the root configuration is symlinked rather
+    than copied.   If repo_path is not None, the root configuration is
+    rewritten to include a loopback repository pointing at repo_path,
+    otherwise it is symlinked like the others.
     """
-    clonedir = os.path.join(tmpdir, "mock")
-    shutil.copytree(configdir, clonedir)
+    configdir = os.path.abspath(configdir)
+    root_config = root + ".cfg"
+    makedirs(clonedir)
+    for entry in os.listdir(configdir):
+        if entry == root_config and repo_path is not None:
+            continue
+        os.symlink(os.path.join(configdir, entry),
+                   os.path.join(clonedir, entry))
+
+    if repo_path is not None:
+        insert_loopback_repo(
+            os.path.join(configdir, root_config),
+            os.path.join(clonedir, root_config),
+            repo_path,
+            extra_conf_list)
+    return clonedir
+
+
+def mock_config_key(configdir, root, repo_path, extra_conf_list):
+    """
+    Return a hash identifying the mock configuration which would be
+    generated from these inputs.   The key covers the list of files in
+    configdir and the contents and modification time of the root
+    configuration, so that any change to them produces a new entry.
+    """
+    configdir = os.path.abspath(configdir)
+    config_in_path = os.path.join(configdir, root + ".cfg")
+
+    key = hashlib.sha256()
+    key.update(configdir + "\0" + root + "\0")
+    key.update("\0".join(sorted(os.listdir(configdir))) + "\0")
+    with open(config_in_path, "rb") as config_in:
+        key.update(config_in.read())
+    key.update("\0%d\0" % os.stat(config_in_path).st_mtime)
+    key.update("%s\0" % repo_path)
+    key.update("\0".join(extra_conf_list))
+    return key.hexdigest()
+
+
+def cached_mock_config(cachedir, configdir, root, repo_path,
+                       extra_conf_list):
+    """
+    Return the path to a mock configuration directory in cachedir,
+    generating it if an identical configuration has not been
+    generated before.   New entries are assembled in a temporary
+    directory and renamed into place, so concurrent builds never see
+    a partially-written configuration.
+    """
+    key = mock_config_key(configdir, root, repo_path, extra_conf_list)
+    config_path = os.path.join(cachedir, key)
+    if os.path.isdir(config_path):
+        logging.debug("Reusing cached mock configuration %s", config_path)
+        return config_path
+
+    makedirs(cachedir)
+    tmpdir = tempfile.mkdtemp(prefix=".tmp-", dir=cachedir)
+    materialise_mock_config(configdir, root, repo_path, extra_conf_list,
+                            os.path.join(tmpdir, key))
+    try:
+        os.rename(os.path.join(tmpdir, key), config_path)
+    except OSError:
+        # Another build created the same configuration first
+        if not os.path.isdir(config_path):
+            raise
+    finally:
+        shutil.rmtree(tmpdir)
+    return config_path
+
+
+def render_mock_config(template_dir, root, repo_path, clonedir):
+    """
+    Populate clonedir with a mock configuration based on the cached
+    configuration in template_dir, whose loopback repository stanza
+    refers to LOOPBACK_PLACEHOLDER.   The root configuration is written
+    with the placeholder replaced by repo_path, keeping the template's
+    modification time, and every other file is symlinked.
+    """
+    root_config = root + ".cfg"
+    makedirs(clonedir)
+    for entry in os.listdir(template_dir):
+        if entry != root_config:
+            os.symlink(os.path.join(template_dir, entry),
+                       os.path.join(clonedir, entry))
+
+    template_path = os.path.join(template_dir, root_config)
+    config_path = os.path.join(clonedir, root_config)
+    with open(template_path) as template:
+        with open(config_path, "w") as config:
+            config.write(template.read().replace(LOOPBACK_PLACEHOLDER,
+                                                 repo_path))
+    shutil.copystat(template_path, config_path)
     return clonedir
 
 
+def mock_config(args, tmpdir, repo_path):
+    """
+    Return the path to the mock configuration directory to use for
+    this build, either rendered from the configuration cache or
+    freshly generated in tmpdir.   The cached configuration does not
+    depend on repo_path, so each build can have its own loopback
+    repository.
+    """
+    if args.config_cache is not None:
+        if repo_path is None:
+            return cached_mock_config(args.config_cache, args.configdir,
+                                      args.root, None,
+                                      args.loopback_config_extra)
+        template_dir = cached_mock_config(args.config_cache,
+                                          args.configdir, args.root,
+                                          LOOPBACK_PLACEHOLDER,
+                                          args.loopback_config_extra)
+        return render_mock_config(template_dir, args.root, repo_path,
+                                  os.path.join(tmpdir, "mock"))
+    return materialise_mock_config(args.configdir, args.root, repo_path,
+                                   args.loopback_config_extra,
+                                   os.path.join(tmpdir, "mock"))
+
+
+def update_loopback_repo(args, tmpdir, rpmdir, update=False):
+    """
+    Create or update the loopback repository metadata for rpmdir in a
+    directory private to this build and return the path to it.   When
+    the configuration cache is in use, the metadata is maintained
+    incrementally in a shared directory beside it and copied from
+    there.   The shared metadata is locked only while it is updated
+    and copied, so concurrent builds do not wait for each other's mock
+    runs.   If update is True, existing metadata is reused for packages
+    which have not changed.
+    """
+    repo_path = os.path.join(tmpdir, "loopback")
+    makedirs(repo_path)
+    if args.config_cache is None:
+        createrepo(rpmdir, repo_path, args.quiet, update)
+        return repo_path
+
+    shared_path = os.path.join(
+        os.path.abspath(args.config_cache),
+        "loopback-" + hashlib.sha256(rpmdir).hexdigest()[:16])
+    makedirs(shared_path)
+    repodata = os.path.join(repo_path, "repodata")
+    with lock_file(shared_path + ".lock"):
+        # The shared metadata outlives this build, so it is always updated
+        createrepo(rpmdir, shared_path, args.quiet, True)
+        if os.path.isdir(repodata):
+            shutil.rmtree(repodata)
+        shutil.copytree(os.path.join(shared_path, "repodata"), repodata)
+    return repo_path
+
+
+def binary_package_path(rpmdir, rpm_path, defines):
+    """
+    Return the path under rpmdir at which the binary package rpm_path
+    would have been written by rpmbuild with the given macro definitions.
+    """
+    trans = rpm.ts()
+    trans.setVSFlags(rpm._RPMVSF_NOSIGNATURES)  # pylint: disable=W0212
+    with open(rpm_path) as rpmfile:
+        hdr = trans.hdrFromFdno(rpmfile.fileno())
+    with rpm_macros(dict(defines)):
+        name_fmt = rpm.expandMacro("%{_build_name_fmt}")
+    return os.path.join(rpmdir, hdr.sprintf(name_fmt))
+
+
+def collect_results(resultdir, rpmdir, defines, outputdir=None):
+    """
+    Move the binary packages built into resultdir to their usual
+    locations in rpmdir.   Logs and the rebuilt source package are
+    moved alongside the last binary package, as they would be when
+    building a single package with --resultdir.   If outputdir is
+    given, everything is moved there instead, as mock does with
+    --resultdir.   Returns the paths of the binary packages.
+    """
+    if outputdir is not None:
+        makedirs(outputdir)
+        packages = []
+        for name in sorted(os.listdir(resultdir)):
+            path = os.path.join(outputdir, name)
+            shutil.move(os.path.join(resultdir, name), path)
+            if name.endswith(".rpm") and not name.endswith(".src.rpm"):
+                packages.append(path)
+        return packages
+
+    results = sorted(os.listdir(resultdir))
+    destdir = None
+    packages = []
+    for name in results:
+        if name.endswith(".rpm") and not name.endswith(".src.rpm"):
+            path = binary_package_path(rpmdir, os.path.join(resultdir, name),
+                                       defines)
+            destdir = os.path.dirname(path)
+            makedirs(destdir)
+            shutil.move(os.path.join(resultdir, name), path)
+            packages.append(path)
+
+    if destdir is not None:
+        for name in os.listdir(resultdir):
+            shutil.move(os.path.join(resultdir, name),
+                        os.path.join(destdir, name))
+    return packages
+
+
+def chain_build(args, config, tmpdir, rpmdir):
+    """
+    Rebuild the SRPMs listed in args.chain, in order, in a single
+    chroot.   After each build the results are moved into rpmdir and
+    the loopback repository is updated, so later packages in the chain
+    can install earlier ones as build dependencies without waiting for
+    a new chroot to be initialised.
+    """
+    uniqueext = uuid4().hex
+    session = mock_command(args, config, uniqueext, None)
+    pty_check_call(session + ["--init"])
+
+    try:
+        for srpm in args.chain:
+            print("Building %s" % srpm)
+            resultdir = tempfile.mkdtemp(prefix="result-", dir=tmpdir)
+            pty_check_call(
+                mock_command(args, config, uniqueext, resultdir) +
+                ["--no-clean", "--no-cleanup-after", "--rebuild", srpm],
+                job_name(srpm), args.logdir)
+            collect_results(resultdir, rpmdir, args.define)
+            update_loopback_repo(args, tmpdir, rpmdir, update=True)
+
+    finally:
+        subprocess.call(session + ["--clean"])
+
+
+def job_labels(srpms):
+    """
+    Return an ordered dictionary mapping each distinct SRPM in srpms
+    to a label for its job, log file and snapshot.   SRPMs with the
+    same name in different directories are given distinct labels.
+    """
+    labels = OrderedDict()
+    used = set()
+    for srpm in srpms:
+        if srpm in labels:
+            continue
+        label = job_name(srpm)
+        count = 1
+        while label in used:
+            count += 1
+            label = "%s-%d" % (job_name(srpm), count)
+        labels[srpm] = label
+        used.add(label)
+    return labels
+
+
+def snapshot_path(args, label):
+    """Return the path of the snapshot of the build labelled label"""
+    return os.path.join(args.snapshot_dir, label + ".json")
+
+
+def outdated_srpms(args, srpms, labels, local_packages):
+    """
+    Return the SRPMs in srpms which must be rebuilt because their
+    recorded snapshots do not match, and a dictionary of their new
+    snapshots.   The packages built from the others are left untouched,
+    modification times included, so that make does not rebuild the
+    packages which depend on them.
+    """
+    config_path = os.path.join(args.configdir, args.root + ".cfg")
+    outdated = []
+    snapshots = {}
+    for srpm in srpms:
+        snapshot = planex.buildcache.dependency_snapshot(
+            srpm, config_path, args.define)
+        if planex.buildcache.up_to_date(snapshot_path(args, labels[srpm]),
+                                        snapshot, local_packages):
+            print("%s is up to date" % labels[srpm])
+            continue
+        outdated.append(srpm)
+        snapshots[srpm] = snapshot
+    return outdated, snapshots
+
+
+# pylint: disable=too-many-arguments
+def parallel_build(args, config, tmpdir, rpmdir, labels, snapshots=None,
+                   local_packages=None):
+    """
+    Rebuild each of the SRPMs in labels, an ordered dictionary mapping
+    them to the labels of their jobs, in its own chroot, running up to
+    args.jobs mock processes at once.   Their output is multiplexed
+    onto the console with each line labelled by package.
+
+    If snapshots maps an SRPM to a snapshot of its inputs, the snapshot
+    is saved with the list of packages mock installed for the build.
+    If a build result cache is in use, SRPMs whose results are already
+    cached are restored instead of being rebuilt, and new results are
+    added to the cache.   Results are moved to args.resultdir if it is
+    given, and otherwise to their usual locations in rpmdir.
+    """
+    snapshots = snapshots or {}
+    srpms = list(labels)
+    store = None
+    if args.result_cache is not None:
+        store = planex.buildcache.open_store(args.result_cache)
+        config_path = os.path.join(args.configdir, args.root + ".cfg")
+
+    keys = {}
+
+    def finish(srpm, resultdir):
+        """Move results into place and record the build's inputs"""
+        installed = planex.buildcache.installed_packages(resultdir)
+        packages = collect_results(resultdir, rpmdir, args.define,
+                                   args.resultdir)
+        if srpm not in snapshots:
+            return
+        if installed is None:
+            logging.warning("%s: mock did not list the installed packages; "
+                            "enable its package_state plugin to record "
+                            "snapshots", labels[srpm])
+            return
+        planex.buildcache.save_snapshot(
+            snapshot_path(args, labels[srpm]), snapshots[srpm], installed,
+            local_packages, packages)
+
+    jobs = []
+    resultdirs = {}
+    for srpm in srpms:
+        resultdirs[srpm] = tempfile.mkdtemp(prefix="result-", dir=tmpdir)
+        if store is not None:
+            keys[srpm] = planex.buildcache.build_key(
+                srpm, config_path, args.define, local_packages)
+            if store.fetch(keys[srpm], resultdirs[srpm]):
+                print("Restored %s from build result cache" % labels[srpm])
+                finish(srpm, resultdirs[srpm])
+                continue
+        cmd = mock_command(args, config, uuid4().hex, resultdirs[srpm])
+        jobs.append((labels[srpm], cmd + ["--rebuild", srpm]))
+
+    results = planex.process.run_multiplexed(jobs, args.jobs,
+                                              logdir=args.logdir)
+    for srpm in srpms:
+        if results.get(labels[srpm]) == 0:
+            if store is not None:
+                store.store(keys[srpm], resultdirs[srpm])
+            finish(srpm, resultdirs[srpm])
+
+    failed = sorted(name for name, rc in results.items() if rc != 0)
+    if failed:
+        print("Failed to build: %s" % " ".join(failed))
+        sys.exit(1)
+
+
+def build_outdated(args, tmpdir, rpmdir):
+    """
+    Rebuild the distinct SRPMs in args.srpms with parallel_build,
+    skipping those whose snapshots are up to date.   The loopback
+    repository is only updated if something must be built.
+    """
+    labels = job_labels(args.srpms)
+    srpms = list(labels)
+    local_packages = None
+    snapshots = None
+    if args.result_cache is not None or args.snapshot_dir is not None:
+        local_packages = planex.buildcache.LocalPackages(rpmdir)
+    if args.snapshot_dir is not None:
+        srpms, snapshots = outdated_srpms(args, srpms, labels,
+                                          local_packages)
+    if not srpms:
+        return
+
+    repo_path = update_loopback_repo(args, tmpdir, rpmdir)
+    config = mock_config(args, tmpdir, repo_path)
+    parallel_build(args, config, tmpdir, rpmdir,
+                   OrderedDict((srpm, labels[srpm]) for srpm in srpms),
+                   snapshots, local_packages)
+
+
 def main(argv=None):
     """
     Entry point
@@ -166,24 +584,29 @@ def main(argv=None):
     args = parse_args_or_exit(argv)
 
     tmpdir = tempfile.mkdtemp(prefix="px-mock-")
-    config = clone_mock_config(args.configdir, tmpdir)
+    if args.logdir is not None:
+        makedirs(args.logdir)
 
     try:
         if args.init:
+            config = mock_config(args, tmpdir, None)
             mock(args, config, "--init")
 
         else:
-            config_in_path = os.path.join(args.configdir, args.root + ".cfg")
-            config_out_path = os.path.join(config, args.root + ".cfg")
-            insert_loopback_repo(
-                config_in_path,
-                config_out_path,
-                tmpdir,
-                args.loopback_config_extra)
             with rpm_macros(dict(args.define)):
                 rpmdir = os.path.abspath(rpm.expandMacro("%_rpmdir"))
-                createrepo(rpmdir, tmpdir, args.quiet)
-            mock(args, config, "--rebuild", *args.srpms)
+
+            if args.chain:
+                repo_path = update_loopback_repo(args, tmpdir, rpmdir)
+                config = mock_config(args, tmpdir, repo_path)
+                chain_build(args, config, tmpdir, rpmdir)
+            elif (args.jobs > 1 or args.result_cache is not None or
+                  args.snapshot_dir is not None):
+                build_outdated(args, tmpdir, rpmdir)
+            else:
+                repo_path = update_loopback_repo(args, tmpdir, rpmdir)
+                config = mock_config(args, tmpdir, repo_path)
+                mock(args, config, "--rebuild", *args.srpms)
 
     except subprocess.CalledProcessError as cpe:
         sys.exit(cpe.returncode)
@@ -5,6 +5,9 @@ the tag pointed to by a spec file and a Git repository.
 from __future__ import print_function
 
 import argparse
+import hashlib
+import json
+import logging
 import os
 import shutil
 import sys
@@ -15,11 +18,13 @@ import argcomplete
 
 from planex.fileupdate import FileUpdate
 from planex.link import Link
+from planex.mirror import open_cache
 from planex.spec import Spec
 import planex.git as git
 import planex.tarball as tarball
 import planex.util as util
-from planex.cmd.args import common_base_parser, keeptmp_parser
+from planex.cmd.args import (common_base_parser, keeptmp_parser,
+                              mirror_parser)
 
 
 def parse_args_or_exit(argv=None):
@@ -28,11 +33,14 @@ def parse_args_or_exit(argv=None):
     """
     parser = argparse.ArgumentParser(
         description='Create a patchqueue from a linked Git repository',
-        parents=[common_base_parser(), keeptmp_parser()])
+        parents=[common_base_parser(), keeptmp_parser(), mirror_parser()])
     parser.add_argument("link", metavar="LINK", help="link file")
     parser.add_argument("tarball", metavar="TARBALL", help="tarball")
     parser.add_argument("--repos", default="repos",
                         help="Local repository directory")
+    parser.add_argument("--cache", metavar="DIR", default=None,
+                        help="Reuse patches formatted by previous runs, "
+                             "kept in DIR")
     argcomplete.autocomplete(parser)
     return parser.parse_args(argv)
 
@@ -58,6 +66,70 @@ def assemble_patchqueue(tmpdir, link, repo, start_tag, end_tag):
             series.write(os.path.basename(patch) + "\n")
 
 
+def patchqueue_key(repo, start_sha, link):
+    """
+    Return the key under which the patchqueue formatted from start_sha
+    in repo, with the layout described by link, is cached.
+    """
+    key = hashlib.sha256()
+    for field in [os.path.abspath(repo), start_sha, link.patchqueue,
+                  link.sources, link.patches]:
+        key.update("%s\0" % field)
+    return key.hexdigest()
+
+
+def update_cached_patchqueue(cachedir, link, repo, start_sha, end_sha):
+    """
+    Bring the patchqueue formatted by a previous run, cached in
+    cachedir, up to date with the range start_sha..end_sha.
+    If the range is unchanged the cached patches are used as they are.
+    If commits have only been added since, just the new commits are
+    formatted and appended to the series.   Otherwise the whole range
+    is formatted again.   The series is recorded in the state before
+    the series file is written from it, so an interrupted update
+    never leaves duplicate entries behind.
+    """
+    state_path = os.path.join(cachedir, "state.json")
+    patchqueue = os.path.join(cachedir, "tree", link.patchqueue)
+    try:
+        with open(state_path) as state_file:
+            state = json.load(state_file)
+    except (IOError, ValueError):
+        state = None
+    if state is not None and ("series" not in state or
+                              state["start"] != start_sha):
+        state = None
+
+    if state is not None and state["end"] == end_sha:
+        logging.debug("Patchqueue for %s is up to date", repo)
+        series = state["series"]
+    elif state is not None and git.is_ancestor(repo, state["end"], end_sha):
+        logging.debug("Appending patches from %s..%s", state["end"], end_sha)
+        patches = git.format_patch(repo, state["end"], end_sha, patchqueue,
+                                   start_number=len(state["series"]) + 1)
+        series = state["series"] + [os.path.basename(patch)
+                                    for patch in patches]
+    else:
+        logging.debug("Formatting patches from %s..%s", start_sha, end_sha)
+        if os.path.exists(state_path):
+            os.unlink(state_path)
+        shutil.rmtree(os.path.join(cachedir, "tree"), ignore_errors=True)
+        os.makedirs(patchqueue)
+        patches = git.format_patch(repo, start_sha, end_sha, patchqueue)
+        series = [os.path.basename(patch) for patch in patches]
+
+    if state is None or state["end"] != end_sha:
+        tmp_path = state_path + ".tmp"
+        with open(tmp_path, "w") as state_file:
+            json.dump({"start": start_sha, "end": end_sha, "series": series},
+                      state_file)
+        os.rename(tmp_path, state_path)
+
+    with FileUpdate(os.path.join(patchqueue, "series")) as series_file:
+        for patch in series:
+            series_file.write(patch + "\n")
+
+
 def assemble_extra_sources(tmpdir, repo, spec, link):
     """
     Assemble the non-patchqueue sources in the working directory.
@@ -90,11 +162,16 @@ def main(argv=None):
         end_tag = "HEAD"
 
     # If the repository URL in the link is remote, look for a
-    # local clone in repos (without a .git suffix)
+    # local clone in repos (without a .git suffix).   If there is
+    # none and a mirror cache is in use, clone it from the mirror.
     url = urlparse(repo)
     if url.scheme:
         reponame = os.path.basename(url.path).rsplit(".git")[0]
         repo = os.path.join(args.repos, reponame)
+        mirrors = open_cache(args.mirror_cache, args.mirror_ttl)
+        if mirrors is not None and not os.path.exists(repo):
+            util.makedirs(args.repos)
+            mirrors.checkout(link.url, repo)
 
     util.makedirs(os.path.dirname(args.tarball))
     with open('{0}.origin'.format(args.tarball), 'w') as origin_file:
@@ -115,13 +192,25 @@ def main(argv=None):
 
     start_tag = link.base_commitish
     if start_tag is None:
-        start_tag = spec.version()
-        if start_tag not in git.tags(repo):
+        start_tag = spec.summary.version
+        if not git.tag_exists(repo, start_tag):
             start_tag = "v%s" % start_tag
 
     try:
         tmpdir = tempfile.mkdtemp(prefix="px-pq-")
-        assemble_patchqueue(tmpdir, link, repo, start_tag, end_tag)
+        if args.cache is not None:
+            start_sha = git.rev_parse(repo, start_tag)
+            cachedir = os.path.join(args.cache,
+                                    patchqueue_key(repo, start_sha, link))
+            util.makedirs(cachedir)
+            with util.lock_file(cachedir + ".lock"):
+                update_cached_patchqueue(cachedir, link, repo, start_sha,
+                                         git.rev_parse(repo, end_tag))
+                shutil.copytree(
+                    os.path.join(cachedir, "tree", link.patchqueue),
+                    os.path.join(tmpdir, link.patchqueue))
+        else:
+            assemble_patchqueue(tmpdir, link, repo, start_tag, end_tag)
         assemble_extra_sources(tmpdir, repo, spec, link)
         with FileUpdate(args.tarball) as outfile:
             tarball.make(tmpdir, outfile)
@@ -1,23 +1,32 @@
 """
 planex-pin: generate pin files pointing at local repos
 in xenserver-specs/repos/ to override the spec/lnk
+
+With --output-dir, many packages are pinned concurrently and their pin
+files are written together.
 """
 from __future__ import print_function
 
 import argparse
+import fnmatch
 import json
+from multiprocessing.pool import ThreadPool
 import os
 import sys
+import tempfile
 
-from planex.cmd.args import common_base_parser
+from planex.cmd.args import (common_base_parser, mirror_parser,
+                              refcache_parser)
+from planex.mirror import open_cache
+import planex.refcache
 from planex.link import Link
 from planex.repository import Repository
-from planex.spec import Spec
+from planex.spec import SpecMetadata, spec_metadata
 
 
 def spec_and_lnk(repo_path, package_name):
     """
-    Return the Spec and Link object for
+    Return the SpecMetadata and Link object for
     repo_path/SPECS/package_name.
     Link can be None if not present.
     Exception("package not present") otherwise
@@ -30,7 +39,7 @@ def spec_and_lnk(repo_path, package_name):
             "Spec file for {} not present in {}/SPECS".format(
                 package_name, repo_path))
 
-    spec = Spec(specname)
+    spec = spec_metadata(specname)
 
     linkname = "%s.lnk" % partial_file_path
     link = Link(linkname) if os.path.isfile(linkname) else None
@@ -39,27 +48,44 @@ def spec_and_lnk(repo_path, package_name):
 
 
 def repository_of(spec_or_link):
-    """Return the Repository of the provided Spec source url or Link url.
-       None if spec_or_link is None"""
-    if isinstance(spec_or_link, Spec):
-        return Repository(spec_or_link.sources()[0][1])
+    """Return the Repository of the provided SpecMetadata source url or
+       Link url.   None if spec_or_link is None"""
+    if isinstance(spec_or_link, SpecMetadata):
+        return Repository(spec_or_link.urls()[0])
     if isinstance(spec_or_link, Link):
         return Repository(spec_or_link.url)
     if spec_or_link is None:
         return None
     else:
-        sys.exit(
+        raise ValueError(
             "repository_of: got unexpected object {}".format(
                 spec_or_link))
 
 
+class LazyRepository(object):
+    """
+    The Repository of a Spec or Link, which is only constructed, and
+    its remote only queried, when one of its attributes is first used.
+    """
+
+    # pylint: disable=too-few-public-methods
+    def __init__(self, spec_or_link):
+        self.spec_or_link = spec_or_link
+        self.repository = None
+
+    def __getattr__(self, name):
+        if self.repository is None:
+            self.repository = repository_of(self.spec_or_link)
+        return getattr(self.repository, name)
+
+
 # pylint: disable=too-many-branches
 def get_pin_content(args, pq_name, spec, link):
     """
     Generate the pinfile content for a Spec.
     """
-    base_repo = repository_of(spec)
-    pq_repo = repository_of(link)
+    base_repo = LazyRepository(spec)
+    pq_repo = LazyRepository(link)
 
     url = args.url
     if url is None:
@@ -117,6 +143,104 @@ def make_pin(args, xs_path, package_name):
     return get_pin_content(args, args.patchqueue, spec, link)
 
 
+def expand_packages(xs_path, patterns):
+    """
+    Return the names of the packages matching patterns, which may be
+    package names or shell-style globs matched against the spec files
+    in xs_path/SPECS.   Exits if a name or glob matches no spec file.
+    """
+    specs = sorted(os.path.splitext(name)[0]
+                   for name in os.listdir(os.path.join(xs_path, "SPECS"))
+                   if name.endswith(".spec"))
+    packages = []
+    for pattern in patterns:
+        if any(char in pattern for char in "*?["):
+            matches = fnmatch.filter(specs, pattern)
+            if not matches:
+                sys.exit("Error: no packages match {}".format(pattern))
+            packages.extend(matches)
+        elif pattern in specs:
+            packages.append(pattern)
+        else:
+            sys.exit("Spec file for {} not present in {}/SPECS".format(
+                pattern, xs_path))
+    return sorted(set(packages))
+
+
+def write_pins(pins, output_dir):
+    """
+    Write the pin files for all packages in pins to output_dir.
+    Every pin file is written to a temporary file first, and they are
+    only renamed into place once all have been written, so either all
+    of the pin files are updated or none are.   Returns the names of
+    the packages whose pin files changed.
+    """
+    changed = []
+    pending = []
+    complete = False
+    try:
+        for name in sorted(pins):
+            path = os.path.join(output_dir, "%s.pin" % name)
+            try:
+                with open(path) as current:
+                    if json.load(current) == pins[name]:
+                        continue
+            except (IOError, ValueError):
+                pass
+            fd, tmp_path = tempfile.mkstemp(dir=output_dir,
+                                            prefix=".%s.pin." % name)
+            pending.append((tmp_path, path))
+            with os.fdopen(fd, "w") as out:
+                json.dump(pins[name], out, indent=2)
+            changed.append(name)
+        complete = True
+    finally:
+        if not complete:
+            for tmp_path, _ in pending:
+                os.unlink(tmp_path)
+
+    for tmp_path, path in pending:
+        os.chmod(tmp_path, 0o644)
+        os.rename(tmp_path, path)
+    return changed
+
+
+def pin_many(args, xs_path):
+    """
+    Pin every package named in args.packages concurrently, writing
+    their pin files to args.output_dir, and print a summary.
+    Every package is checked before any repository is queried, and
+    errors raised while querying are reported here, since exiting
+    from a worker thread would leave the pool waiting forever.
+    """
+    packages = expand_packages(xs_path, args.packages)
+    if not os.path.isdir(args.output_dir):
+        sys.exit("Error: path {} does not exist.".format(args.output_dir))
+    sources = {name: spec_and_lnk(xs_path, name) for name in packages}
+
+    pool = ThreadPool(max(min(args.jobs, len(packages)), 1))
+    try:
+        contents = pool.map(
+            lambda name: get_pin_content(args, args.patchqueue,
+                                         *sources[name]),
+            packages)
+    except Exception as exn:  # pylint: disable=broad-except
+        sys.exit("Error: {}".format(exn))
+    finally:
+        pool.close()
+        pool.join()
+
+    pins = dict(zip(packages, contents))
+    changed = write_pins(pins, args.output_dir)
+
+    for name in packages:
+        print("{:<32} {}#{}{}".format(
+            name, pins[name]['URL'], pins[name]['commitish'],
+            " (updated)" if name in changed else ""))
+    print("Pinned {} packages, {} updated".format(len(packages),
+                                                 len(changed)))
+
+
 def parse_args_or_exit(argv=None):
     """
     Parse command line options
@@ -126,8 +250,11 @@ def parse_args_or_exit(argv=None):
         description="Create a .pin file pointing to a repository "
                     "in $CWD/repos. You must run "
                     "this tool from the root of a spec repository.",
-        parents=[common_base_parser()])
-    parser.add_argument("package", help="package name")
+        parents=[common_base_parser(), refcache_parser(),
+                 mirror_parser()])
+    parser.add_argument("packages", metavar="PACKAGE", nargs="+",
+                        help="package name.   With --output-dir, any number "
+                             "of package names or shell-style globs")
     parser.add_argument("--url", metavar="URL", default=None,
                         help="Source repository URL."
                              "It can be local e.g. repos/package.")
@@ -151,7 +278,24 @@ def parse_args_or_exit(argv=None):
                         help="Path of the pinfile to write. "
                              "When used, it overwrites the file "
                              "if present.")
-    return parser.parse_args(argv)
+    parser.add_argument("--output-dir", metavar="DIR", default=None,
+                        help="Write <package>.pin files for all packages "
+                             "to DIR")
+    parser.add_argument("-j", "--jobs", metavar="N", type=int, default=8,
+                        help="Number of packages to pin at once with "
+                             "--output-dir")
+    args = parser.parse_args(argv)
+
+    if args.output_dir is None:
+        if len(args.packages) > 1:
+            parser.error("--output-dir is required to pin more than one "
+                         "package")
+        args.package = args.packages[0]
+    elif (args.url or args.commitish or args.base or args.base_commitish or
+          args.output):
+        parser.error("--url, --commitish, --base, --base_commitish and "
+                     "--output cannot be used with --output-dir")
+    return args
 
 
 def main(argv=None):
@@ -160,20 +304,29 @@ def main(argv=None):
     """
 
     args = parse_args_or_exit(argv)
+    planex.refcache.configure(args.ref_cache, args.ref_cache_ttl,
+                              open_cache(args.mirror_cache, args.mirror_ttl))
+    if args.frozen:
+        planex.refcache.freeze(args.frozen)
 
     if args.base is not None and args.base_commitish is None:
         sys.exit("Error: --base_commitish is required if --base is used.")
 
-    package_name = args.package
     xs_path = os.getcwd()
-    pin = make_pin(args, xs_path, package_name)
+    if args.output_dir is not None:
+        pin_many(args, xs_path)
+    else:
+        pin = make_pin(args, xs_path, args.package)
 
-    print(json.dumps(pin, indent=2))
+        print(json.dumps(pin, indent=2))
 
-    if args.output:
-        path = os.path.dirname(args.output)
-        if os.path.exists(path):
-            with open(args.output, "w") as out:
-                json.dump(pin, out, indent=2)
-        else:
-            sys.exit("Error: path {} does not exist.".format(path))
+        if args.output:
+            path = os.path.dirname(args.output)
+            if os.path.exists(path):
+                with open(args.output, "w") as out:
+                    json.dump(pin, out, indent=2)
+            else:
+                sys.exit("Error: path {} does not exist.".format(path))
+
+    if args.write_lock:
+        planex.refcache.write_lock(args.write_lock)
@@ -1,14 +1,28 @@
 """
 Wrappers and utility functions for dealing with git repositories
+
+Local repositories are read through GitPython, using one handle per
+repository for the life of the process, so that refs, tags and
+configuration are looked up in-process rather than by running a git
+command for each query.   Commands with no in-process equivalent, such
+as format-patch and operations on remotes, still run git.
 """
 
+from __future__ import absolute_import
+
 import os
-import re
 import subprocess
+import threading
+
+import git
 
 from planex.util import run
 
 
+_HANDLES = {}
+_HANDLES_LOCK = threading.Lock()
+
+
 def dotgitdir_of_path(repo):
     """
     Return the path to the dotgitdir of the repository.
@@ -33,71 +47,140 @@ def dotgitdir_of_path(repo):
         raise Exception("Not a git repository: '%s'" % repo)
 
 
+def handle(repo):
+    """
+    Return a GitPython handle for repo.   Handles are cached, so each
+    repository is only opened once.
+    """
+    dotgitdir = os.path.abspath(dotgitdir_of_path(repo))
+    with _HANDLES_LOCK:
+        if dotgitdir not in _HANDLES:
+            _HANDLES[dotgitdir] = git.Repo(dotgitdir)
+        return _HANDLES[dotgitdir]
+
+
 def archive(repo, commit_hash, output, prefix=None):
     """
     Archive a git repo at a given commit with a specified version prefix.
     Returns the path to an archive to be used as a source for building an RPM.
+    The archive is streamed to output as git produces it.
     """
-    dotgitdir = dotgitdir_of_path(repo)
-
-    cmd = ["git", "--git-dir=%s" % dotgitdir, "archive", commit_hash]
-
+    kwargs = {}
     if prefix is not None:
-        cmd += ["--prefix=%s-%s/" % (os.path.basename(repo), prefix)]
-    subprocess.check_call(cmd, stdout=output)
+        kwargs["prefix"] = "%s-%s/" % (os.path.basename(repo), prefix)
+    handle(repo).archive(output, commit_hash, **kwargs)
 
 
 def tags(repo):
     """
     Return a list of all tags defined on repo.
     """
-    dotgitdir = dotgitdir_of_path(repo)
-    return run(["git", "--git-dir=%s" % dotgitdir, "tag"])['stdout'].split()
+    return [tag.name for tag in handle(repo).tags]
+
+
+def tag_exists(repo, name):
+    """
+    Return True if name is a tag defined on repo.   Only the one ref
+    is looked up, rather than listing every tag.
+    """
+    return git.TagReference(handle(repo), "refs/tags/" + name).is_valid()
 
 
-def format_patch(repo, startref, endref, target_dir):
+def format_patch(repo, startref, endref, target_dir, start_number=None):
     """
     Write patches from ref to HEAD out to target_dir.
     Returns a list of patch filenames which can be used to create a
-    series file.
+    series file.   If start_number is given, patches are numbered
+    from start_number rather than from 1.   Subjects are not numbered
+    ('[PATCH n/m]'), so a patch is the same whichever range it was
+    formatted as part of.
     """
     dotgitdir = dotgitdir_of_path(repo)
 
     commit_range = "%s..%s" % (startref, endref)
-    res = run(["git", "--git-dir=%s" % dotgitdir, "format-patch",
-               "--no-renames", commit_range, "--output-directory", target_dir])
+    cmd = ["git", "--git-dir=%s" % dotgitdir, "format-patch", "--no-renames",
+           "--no-numbered"]
+    if start_number is not None:
+        cmd += ["--start-number", str(start_number)]
+    res = run(cmd + [commit_range, "--output-directory", target_dir])
     return res['stdout'].split()
 
 
-def origin_url(repo):
+def rev_parse(repo, ref):
     """
-    Return the remote url for origin
+    Return the SHA1 of the commit which ref points to in repo.
     """
-    dotgitdir = dotgitdir_of_path(repo)
+    return handle(repo).commit(ref).hexsha
 
-    res = run(['git', '--git-dir=%s' % dotgitdir, 'remote', '-v'])
-    remotes = res['stdout'].strip()
-    match = re.search(r'origin\s*(\S*)\s*\(fetch\)', remotes)
 
-    return match.group(1).strip()
+def is_ancestor(repo, ancestor, descendant):
+    """
+    Return True if commit ancestor is an ancestor of commit descendant
+    in repo.
+    """
+    try:
+        return handle(repo).is_ancestor(ancestor, descendant)
+    except git.GitCommandError:
+        # One of the commits does not exist in the repository
+        return False
 
 
-def ls_remote(url, ref=None, *options):
+def origin_url(repo):
     """
-    Run 'git ls-remote' command.
+    Return the remote url for origin
     """
-    cmd = ['git', 'ls-remote'] + list(options) + [url]
+    try:
+        return handle(repo).remotes['origin'].url
+    except IndexError:
+        raise Exception("No remote named 'origin' in git repository: '%s'"
+                        % repo)
 
-    if ref is not None:
-        cmd.append(ref)
 
+def communicate(cmd, timeout=None):
+    """
+    Run cmd and return its standard output and error.   If timeout is
+    given and cmd runs for longer than timeout seconds, it is killed
+    and RuntimeError is raised.
+    """
     proc = subprocess.Popen(
         cmd,
         stdout=subprocess.PIPE,
         stderr=subprocess.PIPE
     )
 
-    stdout, stderr = proc.communicate()
+    if timeout is None:
+        return proc.communicate()
+
+    expired = threading.Event()
+
+    def kill():
+        """Kill the command once the timeout has expired"""
+        expired.set()
+        proc.kill()
+
+    timer = threading.Timer(timeout, kill)
+    timer.start()
+    try:
+        stdout, stderr = proc.communicate()
+    finally:
+        timer.cancel()
+    if expired.is_set():
+        raise RuntimeError("Timed out after %s seconds running %s"
+                           % (timeout, " ".join(cmd)))
+    return stdout, stderr
+
+
+def ls_remote(url, ref=None, *options, **kwargs):
+    """
+    Run 'git ls-remote' command.   If a timeout in seconds is given as
+    a keyword argument, the command is killed if it runs for longer.
+    """
+    cmd = ['git', 'ls-remote'] + list(options) + [url]
+
+    if ref is not None:
+        cmd.append(ref)
+
+    stdout, stderr = communicate(cmd, kwargs.get("timeout"))
 
     if stderr:
         raise RuntimeError(stderr)
@@ -0,0 +1,458 @@
+"""
+In-memory dependency graph of a set of spec and link files.
+
+The graph is built once from the specs and links and records every
+build rule between files (spec files, link files, sources,
+patchqueues, manifests, source RPMs and binary RPMs) as well as the
+dependencies between packages which arise from BuildRequires and
+Requires on packages built locally.   Reverse dependencies are indexed
+as the graph is built, so queries do not need to scan every package.
+
+A graph can be saved to and loaded from a compact cache file, so tools
+which only need to query it do not have to parse the spec files again.
+"""
+
+from collections import namedtuple
+import heapq
+import marshal
+import os
+import urlparse
+
+from planex.provides import ARCH_SUFFIX, ProvidesIndex
+
+
+# Kinds of edge between files
+SPEC = "spec"
+LINK = "link"
+SOURCE = "source"
+MANIFEST = "manifest"
+FETCH = "fetch"
+PATCHQUEUE = "patchqueue"
+RPM = "rpm"
+BUILDREQUIRES = "buildrequires"
+
+# URL schemes of sources which are downloaded to _build/SOURCES
+FETCHED_SCHEMES = ["http", "https", "file", "ftp"]
+
+# Version of the cache file format
+CACHE_VERSION = 1
+
+
+class Rule(namedtuple("Rule", "target prereq kind note")):
+    """
+    A build rule: target depends on prereq.   Note is an optional
+    comment describing the rule.
+    """
+    pass
+
+
+def manifest_path(package_name):
+    """Return the relative path to the manifest file for package."""
+    return '_build/MANIFESTS/{}.json'.format(package_name)
+
+
+def srpm_rules(spec, lnk=None):
+    """
+    Return the rules to build the SRPM from the spec file, link file
+    and sources
+    """
+    srpmpath = spec.summary.source_package_path
+    rules = [Rule(srpmpath, spec.summary.specpath, SPEC, None)]
+    if lnk:
+        rules.append(Rule(srpmpath, lnk.linkpath, LINK, None))
+
+    for (path, source) in spec.summary.sources:
+        url = urlparse.urlparse(source)
+        if url.scheme in FETCHED_SCHEMES:
+            # Source was downloaded to _build/SOURCES
+            rules.append(Rule(srpmpath, path, SOURCE, None))
+        elif lnk and (lnk.sources is not None or lnk.has_patches):
+            # Use sources from patchqueue
+            pass
+        else:
+            # Source is local
+            rules.append(Rule(srpmpath, "/".join(path.split("/")[1:]),
+                              SOURCE, None))
+    return rules
+
+
+def manifest_rules(spec):
+    """
+    Return the rules to create the package manifest
+    """
+    spec_name = spec.summary.name
+    manifest = manifest_path(spec_name)
+    rules = [Rule(manifest, spec.summary.specpath, MANIFEST, None)]
+    lnk_path = 'SPECS/{}.lnk'.format(spec_name)
+    if os.path.isfile(lnk_path):
+        rules.append(Rule(manifest, lnk_path, MANIFEST, None))
+    rules.append(Rule(spec.summary.source_package_path, manifest, MANIFEST,
+                      None))
+    return rules
+
+
+def patch_rules(patch_name, spec, srpmpath, linkpath, note=None):
+    """Return the rules for a patchset"""
+    patchpath = spec.expand_macro('%_sourcedir/{}.tar'.format(patch_name))
+    return [Rule(srpmpath, patchpath, PATCHQUEUE, note),
+            Rule(patchpath, linkpath, PATCHQUEUE, None)]
+
+
+def fetch_rules(spec, lnk=None):
+    """
+    Return the rules to download sources and create patchqueues
+    """
+    rules = []
+    for (path, source) in spec.summary.sources:
+        url = urlparse.urlparse(source)
+        if url.scheme in FETCHED_SCHEMES:
+            # Source can be fetched by fetch
+            rules.append(Rule(path, spec.summary.specpath, FETCH, None))
+
+    if lnk:
+        srpmpath = spec.summary.source_package_path
+        if lnk.schema_version == 1:
+            rules += patch_rules('patches', spec, srpmpath, lnk.linkpath)
+        elif lnk.schema_version >= 2:
+            patches = lnk.patch_sources
+            for patch in patches:
+                note = '%s => %s' % (patch, patches[patch]['URL'])
+                rules += patch_rules(patch, spec, srpmpath, lnk.linkpath,
+                                     note)
+
+            patchqueues = lnk.patchqueue_sources
+            for patchqueue in patchqueues:
+                note = '%s => %s' % (patchqueue,
+                                     patchqueues[patchqueue]['URL'])
+                rules += patch_rules(patchqueue, spec, srpmpath,
+                                     lnk.linkpath, note)
+    return rules
+
+
+def rpm_rules(spec):
+    """
+    Return the rule to build RPMS from the SRPM.
+    """
+    # We only generate a rule for the first binary RPM produced by the
+    # specfile.  If we generate multiple rules (one for the base package,
+    # one for -devel and so on), make will interpret these as completely
+    # separate targets which must be built separately.   At best, this means
+    # that the same package will be built more than once; at worst, in a
+    # concurrent build, there is a risk that the targets might not be rebuilt
+    # correctly.
+    #
+    # Make does understand the concept of multiple targets being built by
+    # a single rule invocation, but only for pattern rules (e.g. %.h %.c: %.y).
+    # It is tricky to generate correct pattern rules for RPM builds.
+    return [Rule(spec.summary.rpm_path,
+                 spec.summary.source_package_path, RPM, None)]
+
+
+def package_to_rpm_map(specs):
+    """
+    Return a ProvidesIndex mapping the capabilities and files provided
+    by specs to the RPM files which provide them.
+    """
+    provides_to_rpm = ProvidesIndex()
+    for spec in specs:
+        provides_to_rpm.add_spec(spec, spec.summary.rpm_path)
+    return provides_to_rpm
+
+
+def local_requires(spec, provides_to_rpm):
+    """
+    Return a list of (requirement, rpm path) pairs for each of the
+    BuildRequires and Requires of spec which is provided by a local
+    package.   Other requirements come from the system repository.
+    Versioned requirements are only satisfied by a local package whose
+    provide matches the required version.
+    """
+    # Package's Requires must exist for it to be installed as a
+    # BuildRequire of a later package, so we make it depend on
+    # Requires as well as BuildRequires to ensure they are built.
+    # Requirements are considered in the order they appear in the spec,
+    # so that the rules generated from them are stable.
+    summary = spec.summary
+    names = []
+    versions = {}
+    for name, flags, evr in summary.buildrequires_evr + summary.requires_evr:
+        if name not in versions:
+            names.append(name)
+        versions.setdefault(name, []).append((flags, evr))
+
+    local = []
+    for buildreq in names:
+        if ARCH_SUFFIX.sub('', buildreq) in summary.provides:
+            continue
+        for flags, evr in versions[buildreq]:
+            rpm_path = provides_to_rpm.resolve(buildreq, flags, evr)
+            if rpm_path is not None and rpm_path != summary.rpm_path:
+                local.append((buildreq, rpm_path))
+                break
+    return local
+
+
+def buildrequires_rules(spec, provides_to_rpm):
+    """
+    Return the build dependency rules between binary RPMs
+    """
+    rpmpath = spec.summary.rpm_path
+    return [Rule(rpmpath, buildreqrpm, BUILDREQUIRES, None)
+            for _, buildreqrpm in local_requires(spec, provides_to_rpm)]
+
+
+class DependencyGraph(object):
+    """
+    Build rules and package dependencies for a set of packages
+    """
+
+    def __init__(self):
+        # Package names, in the order in which they were added
+        self.packages = []
+        # Package name -> list of Rules, in the order they were added
+        self.rules = {}
+        # Package name -> path of its binary and source RPMs
+        self.rpm = {}
+        self.srpm = {}
+        # Package name -> {required package name -> [requirements]}
+        self.depends = {}
+        # Package name -> set of names of packages which require it
+        self.rdepends = {}
+        # File path -> set of names of packages whose rules mention it
+        self.owners = {}
+
+    @classmethod
+    def from_specs(cls, specs, links):
+        """
+        Build the graph for the Spec objects in specs.   Links is a
+        dictionary mapping package names to their Link objects, if any.
+        """
+        graph = cls()
+        provides_to_rpm = package_to_rpm_map(specs)
+        rpm_to_name = {spec.summary.rpm_path: spec.summary.name
+                       for spec in specs}
+
+        for spec in specs:
+            name = spec.summary.name
+            lnk = links.get(name)
+            # Manifest dependencies must come after spec dependencies
+            # otherwise manifest.json will be the SRPM's first dependency
+            # and will be passed to rpmbuild in the spec position.
+            rules = (srpm_rules(spec, lnk) + manifest_rules(spec) +
+                     fetch_rules(spec, lnk) + rpm_rules(spec) +
+                     buildrequires_rules(spec, provides_to_rpm))
+            requires = {}
+            for req, rpm_path in local_requires(spec, provides_to_rpm):
+                requires.setdefault(rpm_to_name[rpm_path], []).append(req)
+            graph.add_package(name, spec.summary.rpm_path,
+                              spec.summary.source_package_path, rules,
+                              requires)
+        return graph
+
+    def add_package(self, name, rpm, srpm, rules, requires):
+        """
+        Add package name, which is built as rpm from srpm using rules.
+        Requires maps the names of the packages it requires to the
+        requirements they satisfy.
+        """
+        self.packages.append(name)
+        self.rpm[name] = rpm
+        self.srpm[name] = srpm
+        self.rules[name] = rules
+        self.depends[name] = {dep: sorted(reqs)
+                              for dep, reqs in requires.items()}
+        self.rdepends.setdefault(name, set())
+        for dep in requires:
+            self.rdepends.setdefault(dep, set()).add(name)
+        for rule in rules:
+            if rule.kind != BUILDREQUIRES:
+                for path in [rule.target, rule.prereq]:
+                    self.owners.setdefault(os.path.normpath(path),
+                                           set()).add(name)
+
+    def dependencies(self, name):
+        """Return the names of the local packages which name requires"""
+        return set(self.depends[name])
+
+    def dependents(self, name):
+        """Return the names of the local packages which require name"""
+        return set(self.rdepends.get(name, ()))
+
+    def closure(self, names, reverse=False):
+        """
+        Return the names of all packages which the packages in names
+        require, directly or indirectly, including names themselves.
+        If reverse is True, return all packages which require them
+        instead.
+        """
+        edges = self.rdepends if reverse else self.depends
+        seen = set()
+        pending = list(names)
+        while pending:
+            name = pending.pop()
+            if name not in seen:
+                seen.add(name)
+                pending.extend(edges.get(name, ()))
+        return seen
+
+    def build_order(self, names=None):
+        """
+        Return the packages in names, or all packages, sorted so that
+        each package comes after the local packages it requires.
+        Packages which are ready to build at the same time are ordered
+        by name so that the order is stable.   Packages involved in
+        dependency cycles are appended in name order.
+        """
+        names = set(self.packages if names is None else names)
+        depends = {name: set(self.depends[name]) & names for name in names}
+        ready = [name for name, deps in depends.items() if not deps]
+        heapq.heapify(ready)
+        order = []
+        while ready:
+            name = heapq.heappop(ready)
+            order.append(name)
+            for rdep in self.rdepends.get(name, ()):
+                if rdep in depends:
+                    depends[rdep].discard(name)
+                    if not depends[rdep]:
+                        heapq.heappush(ready, rdep)
+
+        cyclic = sorted(name for name, deps in depends.items() if deps)
+        return order + cyclic
+
+    def cycles(self):
+        """
+        Return the strongly connected components of the graph which
+        form dependency cycles, found with Tarjan's algorithm.   Each
+        cycle is a sorted list of package names, and the cycles are
+        sorted by their first name.
+        """
+        index = {}
+        lowlink = {}
+        stack = []
+        on_stack = set()
+        components = []
+
+        for root in sorted(self.packages):
+            if root in index:
+                continue
+            # Iterative depth-first search, so that long dependency
+            # chains do not exhaust Python's recursion limit
+            work = [(root, iter(sorted(self.depends[root])))]
+            index[root] = lowlink[root] = len(index)
+            stack.append(root)
+            on_stack.add(root)
+            while work:
+                name, deps = work[-1]
+                for dep in deps:
+                    if dep not in self.depends:
+                        continue
+                    if dep not in index:
+                        index[dep] = lowlink[dep] = len(index)
+                        stack.append(dep)
+                        on_stack.add(dep)
+                        work.append((dep, iter(sorted(self.depends[dep]))))
+                        break
+                    elif dep in on_stack:
+                        lowlink[name] = min(lowlink[name], index[dep])
+                else:
+                    work.pop()
+                    if work:
+                        parent = work[-1][0]
+                        lowlink[parent] = min(lowlink[parent], lowlink[name])
+                    if lowlink[name] == index[name]:
+                        component = []
+                        while True:
+                            member = stack.pop()
+                            on_stack.discard(member)
+                            component.append(member)
+                            if member == name:
+                                break
+                        if len(component) > 1 or name in self.depends[name]:
+                            components.append(sorted(component))
+        return sorted(components)
+
+    def cycle_edges(self, cycle):
+        """
+        Return a list of (package, required package, requirements)
+        tuples for the dependencies between the packages in cycle.
+        """
+        members = set(cycle)
+        return [(name, dep, self.depends[name][dep])
+                for name in cycle
+                for dep in sorted(self.depends[name])
+                if dep in members]
+
+    def levels(self):
+        """
+        Return the packages grouped into topological levels: the
+        first level contains packages with no local requirements, and
+        each later level contains packages whose requirements are all
+        in earlier levels.   Packages in each level can be built
+        concurrently.   Packages involved in dependency cycles are not
+        included.
+        """
+        depends = {name: set(deps) for name, deps in self.depends.items()}
+        level = sorted(name for name, deps in depends.items() if not deps)
+        levels = []
+        while level:
+            levels.append(level)
+            following = set()
+            for name in level:
+                del depends[name]
+                for rdep in self.rdepends.get(name, ()):
+                    depends[rdep].discard(name)
+                    if not depends[rdep]:
+                        following.add(rdep)
+            level = sorted(following)
+        return levels
+
+    def to_dict(self):
+        """Return the graph as a dictionary of plain values"""
+        return {
+            "version": CACHE_VERSION,
+            "packages": [
+                (name, self.rpm[name], self.srpm[name],
+                 [tuple(rule) for rule in self.rules[name]],
+                 self.depends[name])
+                for name in self.packages]
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        """Return the graph described by a dictionary from to_dict()"""
+        if data.get("version") != CACHE_VERSION:
+            raise ValueError("Unsupported graph cache version")
+        graph = cls()
+        for name, rpm, srpm, rules, requires in data["packages"]:
+            graph.add_package(name, rpm, srpm,
+                              [Rule(*rule) for rule in rules], requires)
+        return graph
+
+    def save(self, path, key):
+        """
+        Save the graph to a cache file at path.   The graph is only
+        loaded from the file if the same key is given to load().
+        """
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as cache:
+            marshal.dump((key, self.to_dict()), cache, 2)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path, key):
+        """
+        Load a graph saved at path with key.   Returns None if there is
+        no such file, or if it was saved with a different key.
+        """
+        try:
+            with open(path, "rb") as cache:
+                saved_key, data = marshal.load(cache)
+        except (IOError, EOFError, ValueError, TypeError):
+            return None
+        if saved_key != key:
+            return None
+        try:
+            return cls.from_dict(data)
+        except ValueError:
+            return None
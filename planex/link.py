@@ -2,10 +2,21 @@
 Classes for dealing with pin and link files
 """
 
+from collections import OrderedDict
 import json
+import marshal
+import os
 import re
 
 
+# Keys of patch and patchqueue definitions in schema version 2
+PATCH_SOURCE = re.compile(r'patch(\d+)', re.IGNORECASE)
+PATCHQUEUE_SOURCE = re.compile(r'patchqueue(\d+)', re.IGNORECASE)
+
+# Version of the link index file format
+INDEX_VERSION = 1
+
+
 class UnsupportedProperty(RuntimeError):
     """ Error to be raised if we're asked for properties not present in this
     schema version
@@ -13,13 +24,34 @@ class UnsupportedProperty(RuntimeError):
     pass
 
 
+def numbered_sources(link, matcher):
+    """
+    Return an OrderedDict of the definitions in link whose keys match
+    matcher, ordered by the number in the key
+    """
+    numbered = []
+    for key in link:
+        match = matcher.match(key)
+        if match:
+            numbered.append((int(match.group(1)), key))
+    return OrderedDict((key, link[key]) for _, key in sorted(numbered))
+
+
 class Link(object):
     """Represents pinned or linked repository"""
 
-    def __init__(self, path):
+    def __init__(self, path, link=None):
+        """
+        Read the link or pin file at path.   If link is given, it is used
+        as the already parsed content of the file instead.
+        """
         self.path = path
-        with open(path) as fileh:
-            self.link = json.load(fileh)
+        if link is None:
+            with open(path) as fileh:
+                link = json.load(fileh)
+        self.link = link
+        self._patch_sources = numbered_sources(link, PATCH_SOURCE)
+        self._patchqueue_sources = numbered_sources(link, PATCHQUEUE_SOURCE)
 
     @property
     def schema_version(self):
@@ -78,10 +110,7 @@ class Link(object):
             raise UnsupportedProperty('patch_sources requries at least'
                                       'schema version 2')
 
-        patch_matcher = re.compile(r'patch\d+', re.IGNORECASE)
-        return {k: v for k, v
-                in self.link.iteritems()
-                if patch_matcher.match(k)}
+        return self._patch_sources
 
     @property
     def patchqueue_sources(self):
@@ -90,10 +119,7 @@ class Link(object):
             raise UnsupportedProperty('patchqueue_sources requries at least'
                                       'schema version 2')
 
-        patch_matcher = re.compile(r'patchqueue\d+', re.IGNORECASE)
-        return {k: v for k, v
-                in self.link.iteritems()
-                if patch_matcher.match(k)}
+        return self._patchqueue_sources
 
     @property
     def has_patches(self):
@@ -101,3 +127,60 @@ class Link(object):
         return ((self.schema_version == 1 and self.patches is not None) or
                 (self.schema_version >= 2 and
                  (self.patch_sources or self.patchqueue_sources)))
+
+
+class LinkIndex(object):
+    """
+    The parsed contents of a set of link and pin files, which can be
+    saved to a compact binary index so that tools do not have to read
+    and parse every file again.   An entry is only used while the size
+    and modification time of its file are unchanged.
+    """
+
+    def __init__(self):
+        # Normalised path -> (modification time, size, parsed content)
+        self.entries = {}
+
+    def add(self, link):
+        """Add link to the index"""
+        info = os.stat(link.path)
+        self.entries[os.path.normpath(link.path)] = (
+            info.st_mtime, info.st_size, link.link)
+
+    def get(self, path):
+        """
+        Return the Link for the file at path, from the index if its entry
+        is up to date, otherwise by reading the file
+        """
+        entry = self.entries.get(os.path.normpath(path))
+        if entry is not None:
+            try:
+                info = os.stat(path)
+            except OSError:
+                info = None
+            if info and (info.st_mtime, info.st_size) == entry[:2]:
+                return Link(path, entry[2])
+        return Link(path)
+
+    def save(self, path):
+        """Save the index to path"""
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as index:
+            marshal.dump((INDEX_VERSION, self.entries), index, 2)
+        os.rename(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        Load the index saved at path.   Returns an empty index if there
+        is no such file or it cannot be read.
+        """
+        index = cls()
+        try:
+            with open(path, "rb") as saved:
+                version, entries = marshal.load(saved)
+        except (IOError, EOFError, ValueError, TypeError):
+            return index
+        if version == INDEX_VERSION:
+            index.entries = entries
+        return index
@@ -0,0 +1,231 @@
+"""
+Cache of bare mirrors of git remotes.
+
+Each remote is mirrored once with 'git clone --mirror' into a directory
+named after its URL, and brought up to date with a single 'git fetch'
+when the mirror is older than a configurable lifetime.   Updates hold
+an advisory lock beside the mirror, so concurrent make jobs can share a
+cache safely.
+
+Clones made from a mirror borrow its objects through git's alternates
+mechanism rather than copying them, and are recorded in the mirror as
+its dependents.   A mirror with dependents never prunes unreachable
+objects, since a dependent may still need them.   Before garbage
+collection removes an unused mirror, each of its dependents copies
+the objects it borrows with 'git repack -a -d' and stops referring to
+the mirror, so it keeps working.
+"""
+
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import tempfile
+import time
+
+import planex.git as git
+from planex.util import lock_file, makedirs
+
+
+# Seconds after which a mirror is fetched again before use
+DEFAULT_TTL = 300
+
+# Files in each mirror recording when it was last fetched and used
+FETCHED_STAMP = "planex-fetched"
+USED_STAMP = "planex-used"
+
+# File in each mirror listing the object directories of its dependents
+DEPENDENTS = "planex-dependents"
+
+
+def _touch(path):
+    """Create path if necessary and set its modification time to now"""
+    with open(path, "a"):
+        os.utime(path, None)
+
+
+def _age(path):
+    """Return the number of seconds since path was modified"""
+    try:
+        return time.time() - os.stat(path).st_mtime
+    except OSError:
+        return float("inf")
+
+
+def _alternates_path(objects):
+    """Return the path of the alternates file in objects"""
+    return os.path.join(objects, "info", "alternates")
+
+
+def _read_lines(path):
+    """Return the lines of the file at path, or [] if it does not exist"""
+    try:
+        with open(path) as fileh:
+            return fileh.read().splitlines()
+    except IOError:
+        return []
+
+
+def _dissociate(objects, borrowed):
+    """
+    Copy the objects which the object directory objects borrows from
+    the object directory borrowed, and stop borrowing from it.   Does
+    nothing if objects no longer borrows from borrowed.
+    """
+    alternates = _alternates_path(objects)
+    lines = _read_lines(alternates)
+    if borrowed not in [os.path.realpath(os.path.join(objects, line))
+                        for line in lines]:
+        return
+    logging.debug("Copying objects from %s to %s", borrowed, objects)
+    subprocess.check_call(["git", "--git-dir=%s" % os.path.dirname(objects),
+                           "repack", "--quiet", "-a", "-d"])
+    lines = [line for line in lines
+             if os.path.realpath(os.path.join(objects, line)) != borrowed]
+    if lines:
+        with open(alternates, "w") as fileh:
+            fileh.write("".join(line + "\n" for line in lines))
+    else:
+        os.unlink(alternates)
+
+
+class MirrorCache(object):
+    """Bare mirrors of git remotes under a cache directory"""
+
+    def __init__(self, cachedir, ttl=DEFAULT_TTL):
+        self.cachedir = cachedir
+        self.ttl = ttl
+
+    def path(self, url):
+        """Return the path of the mirror of url"""
+        name = os.path.basename(url.rstrip("/")).rsplit(".git")[0]
+        return os.path.join(self.cachedir, "%s-%s.git" %
+                            (name, hashlib.sha1(url).hexdigest()[:12]))
+
+    def _lock_path(self, url):
+        """Return the path of the lock file for the mirror of url"""
+        return self.path(url) + ".lock"
+
+    def _clone(self, url, mirror):
+        """Create a new mirror of url at mirror"""
+        logging.debug("Mirroring %s to %s", url, mirror)
+        tmpdir = tempfile.mkdtemp(prefix=".tmp-", dir=self.cachedir)
+        try:
+            subprocess.check_call(["git", "clone", "--quiet", "--mirror",
+                                   url, tmpdir])
+            os.rename(tmpdir, mirror)
+        finally:
+            if os.path.isdir(tmpdir):
+                shutil.rmtree(tmpdir)
+
+    def _fetch(self, url, mirror):
+        """Bring the mirror of url at mirror up to date"""
+        logging.debug("Updating mirror of %s", url)
+        subprocess.check_call(["git", "--git-dir=%s" % mirror, "fetch",
+                               "--quiet", "--prune", "origin"])
+
+    def mirror(self, url, create=True):
+        """
+        Return the path of an up-to-date mirror of url, creating it
+        if necessary and create is True.   Returns None if there is no
+        mirror and create is False.
+        """
+        makedirs(self.cachedir)
+        mirror = self.path(url)
+        with lock_file(self._lock_path(url)):
+            if not os.path.isdir(mirror):
+                if not create:
+                    return None
+                self._clone(url, mirror)
+            elif _age(os.path.join(mirror, FETCHED_STAMP)) > self.ttl:
+                self._fetch(url, mirror)
+            else:
+                _touch(os.path.join(mirror, USED_STAMP))
+                return mirror
+            _touch(os.path.join(mirror, FETCHED_STAMP))
+            _touch(os.path.join(mirror, USED_STAMP))
+        return mirror
+
+    def ls_remote(self, url, timeout=None):
+        """
+        Return the output of 'git ls-remote' for url, listing the refs
+        of its mirror if there is one.   Mirrors are not created just
+        to list refs, since cloning costs far more than listing.
+        If the remote itself is listed, the command is killed after
+        timeout seconds.
+        """
+        mirror = self.mirror(url, create=False)
+        if mirror is None:
+            return git.ls_remote(url, timeout=timeout)
+        return git.ls_remote(mirror)
+
+    def add_dependent(self, url, gitdir):
+        """
+        Record that the repository at gitdir borrows objects from the
+        mirror of url, so that the mirror keeps every object and the
+        repository is dissociated before the mirror is removed.
+        """
+        mirror = self.path(url)
+        objects = os.path.abspath(os.path.join(gitdir, "objects"))
+        with lock_file(self._lock_path(url)):
+            dependents = os.path.join(mirror, DEPENDENTS)
+            if objects in _read_lines(dependents):
+                return
+            subprocess.check_call(["git", "--git-dir=%s" % mirror, "config",
+                                   "gc.pruneExpire", "never"])
+            with open(dependents, "a") as fileh:
+                fileh.write(objects + "\n")
+
+    def checkout(self, url, destination, dissociate=False):
+        """
+        Clone url to destination, borrowing objects from its mirror so
+        that little or nothing is fetched from the remote.   If
+        dissociate is True, the borrowed objects are copied and the
+        clone does not depend on the mirror afterwards.
+        """
+        mirror = self.mirror(url)
+        cmd = ["git", "clone", "--quiet", "--reference", mirror]
+        if dissociate:
+            cmd.append("--dissociate")
+        subprocess.check_call(cmd + [url, destination])
+        if not dissociate:
+            self.add_dependent(url, os.path.join(destination, ".git"))
+
+    def gc(self, max_age):
+        """
+        Remove mirrors which have not been used for max_age seconds,
+        and return the paths of the mirrors removed.   Recorded
+        dependents of a mirror are dissociated from it first, but any
+        clone made outside planex with 'git clone --reference' and no
+        '--dissociate' will be broken.   Lock files are left in place,
+        as another process may be waiting on them.
+        """
+        removed = []
+        if not os.path.isdir(self.cachedir):
+            return removed
+        for name in sorted(os.listdir(self.cachedir)):
+            mirror = os.path.join(self.cachedir, name)
+            if not name.endswith(".git") or not os.path.isdir(mirror):
+                continue
+            with lock_file(mirror + ".lock"):
+                if _age(os.path.join(mirror, USED_STAMP)) > max_age:
+                    objects = os.path.realpath(os.path.join(mirror,
+                                                            "objects"))
+                    for dependent in _read_lines(os.path.join(mirror,
+                                                              DEPENDENTS)):
+                        if os.path.isdir(dependent):
+                            _dissociate(dependent, objects)
+                    logging.debug("Removing unused mirror %s", mirror)
+                    shutil.rmtree(mirror)
+                    removed.append(mirror)
+        return removed
+
+
+def open_cache(cachedir, ttl=DEFAULT_TTL):
+    """
+    Return the mirror cache in cachedir, or None if cachedir is None
+    """
+    if cachedir is None:
+        return None
+    return MirrorCache(cachedir, ttl)
@@ -0,0 +1,204 @@
+"""
+Run commands with their output read through a pty, streaming it to
+per-command log files and multiplexing it onto the console.
+"""
+
+import collections
+import errno
+import os
+import pty
+import select
+import subprocess
+import sys
+
+
+# Seconds to wait for output before checking whether children have exited
+POLL_INTERVAL = 0.5
+
+
+class PtyProcess(object):
+    """
+    A child process whose standard input, output and error are connected
+    to a new pty, so that isatty(3) returns 1 in the child.   Output is
+    copied to an optional log file and the most recent lines are kept
+    in a bounded in-memory tail.
+    """
+
+    def __init__(self, cmd, name=None, logfile=None, tail_lines=50):
+        self.cmd = cmd
+        self.name = name or os.path.basename(cmd[0])
+        self.tail = collections.deque(maxlen=tail_lines)
+        self._partial = ""
+        self._log = open(logfile, "ab") if logfile else None
+
+        master = slave = None
+        started = False
+        try:
+            master, slave = pty.openpty()
+            self.proc = subprocess.Popen(cmd, stdin=slave, stdout=slave,
+                                         stderr=slave, close_fds=True)
+            started = True
+        finally:
+            if slave is not None:
+                os.close(slave)
+            if not started:
+                if master is not None:
+                    os.close(master)
+                if self._log is not None:
+                    self._log.close()
+        self.master = master
+
+    @property
+    def pid(self):
+        """Return the process ID of the child"""
+        return self.proc.pid
+
+    def fileno(self):
+        """Return the pty master, so the process can be passed to select"""
+        return self.master
+
+    def read(self):
+        """
+        Read the output which is available from the child.   Returns
+        a tuple of the raw data read and the list of lines completed by
+        it.   The data is empty once the child has closed the pty.
+        """
+        try:
+            data = os.read(self.master, 4096)
+        except OSError as exn:
+            # Linux reports EIO on the master once the slave is closed
+            if exn.errno != errno.EIO:
+                raise
+            data = ""
+
+        if not data:
+            return "", self._flush()
+
+        if self._log is not None:
+            self._log.write(data)
+        lines = (self._partial + data).split("\n")
+        self._partial = lines.pop()
+        lines = [line + "\n" for line in lines]
+        self.tail.extend(lines)
+        return data, lines
+
+    def _flush(self):
+        """Return any incomplete final line of output"""
+        if not self._partial:
+            return []
+        lines = [self._partial + "\n"]
+        self.tail.extend(lines)
+        self._partial = ""
+        return lines
+
+    def close(self):
+        """
+        Close the pty and log file and wait for the child to exit.
+        Returns the child's exit status.
+        """
+        os.close(self.master)
+        if self._log is not None:
+            self._log.close()
+        return self.proc.wait()
+
+    def kill(self):
+        """Kill the child if it is still running"""
+        if self.proc.poll() is None:
+            self.proc.kill()
+
+
+def describe_exit(pid, returncode):
+    """Return a message describing a non-zero exit status"""
+    if returncode < 0:
+        return "PID %d exited with signal %d" % (pid, -returncode)
+    return "PID %d exited with status %d" % (pid, returncode)
+
+
+def _select(procs, timeout=POLL_INTERVAL):
+    """Wait for output from any of procs, ignoring interrupted calls"""
+    try:
+        readable, _, _ = select.select(procs, [], [], timeout)
+    except select.error as exn:
+        if exn.args[0] != errno.EINTR:
+            raise
+        readable = []
+    return readable
+
+
+def run_multiplexed(jobs, max_jobs=1, output=None, logdir=None):
+    """
+    Run jobs, a list of (name, cmd) pairs, with at most max_jobs running
+    at a time.   Output from each job is written to logdir/<name>.log
+    if logdir is given, and to output (stdout by default).   When more
+    than one job can run at once, each line written to output is
+    prefixed with the name of the job which produced it and the tail of
+    the output of any job which fails is repeated when it exits.
+    Returns a dictionary mapping job names to exit statuses.   If an
+    exception escapes, any jobs which are still running are killed.
+    """
+    if output is None:
+        output = sys.stdout
+    prefix = max_jobs > 1 and len(jobs) > 1
+    pending = list(jobs)
+    running = []
+    results = {}
+
+    try:
+        while pending or running:
+            while pending and len(running) < max_jobs:
+                name, cmd = pending.pop(0)
+                logfile = None
+                if logdir is not None:
+                    logfile = os.path.join(logdir, name + ".log")
+                running.append(PtyProcess(cmd, name, logfile))
+
+            readable = _select(running)
+            finished = []
+            for proc in readable:
+                data, lines = proc.read()
+                if prefix:
+                    output.writelines("[%s] %s" % (proc.name, line)
+                                      for line in lines)
+                else:
+                    output.write(data)
+                if not data:
+                    finished.append(proc)
+
+            # A child may exit while a grandchild still holds the pty open.
+            # Only treat it as finished once all of its output has been read.
+            exited = [proc for proc in running
+                      if proc not in readable and proc.proc.poll() is not None]
+            if exited:
+                unread = _select(exited, 0)
+                finished += [proc for proc in exited if proc not in unread]
+
+            for proc in finished:
+                running.remove(proc)
+                returncode = proc.close()
+                results[proc.name] = returncode
+                if returncode != 0:
+                    if prefix:
+                        output.write("[%s] last %d lines of output:\n" %
+                                     (proc.name, len(proc.tail)))
+                        output.writelines(proc.tail)
+                    output.write(describe_exit(proc.pid, returncode) + "\n")
+            output.flush()
+    finally:
+        for proc in running:
+            proc.kill()
+            proc.close()
+
+    return results
+
+
+def check_call(cmd, name=None, logdir=None):
+    """
+    Run cmd with its output read through a pty.   An exception is
+    raised if the command exits with non-zero status.
+    """
+    if name is None:
+        name = os.path.basename(cmd[0])
+    returncode = run_multiplexed([(name, cmd)], logdir=logdir)[name]
+    if returncode != 0:
+        # Report death by signal as a general failure
+        raise subprocess.CalledProcessError(max(returncode, 1), cmd)
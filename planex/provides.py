@@ -0,0 +1,180 @@
+"""
+Index of the capabilities provided by a set of packages.
+
+Each provided capability is stored with its version, so that versioned
+requirements such as 'foo >= 1.2' are resolved with RPM's version
+comparison rules rather than by matching strings.   Files packaged by
+each spec are indexed as well, so that file requirements such as
+'/usr/bin/foo' resolve to the package which installs the file.   A
+directory listed in %files without %dir owns everything beneath it.
+Lookups are dictionary accesses, one per parent directory of a file,
+so their cost does not depend on the number of packages in the index.
+Wildcard patterns are indexed by the directory before their first
+wildcard, and only the patterns of a file's parent directories are
+matched against it.
+"""
+
+import fnmatch
+import os
+import re
+
+import rpm
+
+
+# Architecture suffix which RPM 4.6 adds to dependencies
+ARCH_SUFFIX = re.compile(r'\(x86-64\)$')
+
+
+def split_evr(evr):
+    """
+    Split an [epoch:]version[-release] string into an (epoch, version,
+    release) tuple.   A missing epoch is 0 and a missing release is None.
+    """
+    epoch = "0"
+    if ":" in evr:
+        epoch, evr = evr.split(":", 1)
+    release = None
+    if "-" in evr:
+        evr, release = evr.rsplit("-", 1)
+    return (epoch or "0", evr, release)
+
+
+def compare_evr(evr1, evr2):
+    """
+    Compare two (epoch, version, release) tuples as RPM does, returning
+    -1, 0 or 1.   If either release is None, releases are ignored.
+    """
+    if evr1[2] is None or evr2[2] is None:
+        evr1 = (evr1[0], evr1[1], None)
+        evr2 = (evr2[0], evr2[1], None)
+    return rpm.labelCompare(evr1, evr2)
+
+
+def overlaps(provide_flags, provide_evr, require_flags, require_evr):
+    """
+    Return True if a capability provided with provide_flags and
+    provide_evr satisfies a requirement for it with require_flags and
+    require_evr.   This follows RPM's rpmdsCompare.
+    """
+    sense_mask = rpm.RPMSENSE_LESS | rpm.RPMSENSE_GREATER | rpm.RPMSENSE_EQUAL
+    provide_sense = provide_flags & sense_mask
+    require_sense = require_flags & sense_mask
+    # Unversioned provides and requirements match any version
+    if not (provide_sense and provide_evr and require_sense and require_evr):
+        return True
+
+    sense = compare_evr(split_evr(provide_evr), split_evr(require_evr))
+    if sense < 0:
+        return bool(provide_sense & rpm.RPMSENSE_GREATER or
+                    require_sense & rpm.RPMSENSE_LESS)
+    if sense > 0:
+        return bool(provide_sense & rpm.RPMSENSE_LESS or
+                    require_sense & rpm.RPMSENSE_GREATER)
+    return bool(provide_sense & require_sense &
+                (rpm.RPMSENSE_EQUAL | rpm.RPMSENSE_LESS |
+                 rpm.RPMSENSE_GREATER))
+
+
+class ProvidesIndex(object):
+    """
+    Capabilities and files provided by packages, each mapped to an
+    owner such as the path of the package's RPM
+    """
+
+    def __init__(self):
+        # Capability name -> list of (flags, evr, owner)
+        self.names = {}
+        # Absolute file path -> owner
+        self.files = {}
+        # Absolute directory path -> owner of everything beneath it
+        self.trees = {}
+        # Directory before the first wildcard -> list of (glob pattern,
+        # owner) for file paths containing wildcards
+        self.file_patterns = {}
+
+    def add(self, name, flags, evr, owner):
+        """Record that owner provides capability name at evr"""
+        entry = (flags, evr, owner)
+        self.names.setdefault(name, []).append(entry)
+        stripped = ARCH_SUFFIX.sub('', name)
+        if stripped != name:
+            self.names.setdefault(stripped, []).append(entry)
+
+    def add_file(self, path, owner, contents=True):
+        """
+        Record that owner provides the file at path.   If path is a
+        directory and contents is True, owner also provides everything
+        beneath it.
+        """
+        wildcard = min([path.find(char) for char in "*?[" if char in path]
+                       or [-1])
+        if wildcard >= 0:
+            prefix = os.path.dirname(path[:wildcard + 1])
+            self.file_patterns.setdefault(prefix, []).append((path, owner))
+            return
+        path = path.rstrip("/") or "/"
+        self.files[path] = owner
+        if contents:
+            self.trees[path] = owner
+
+    def add_spec(self, spec, owner):
+        """
+        Record everything which spec provides as provided by owner.
+        spec must have been parsed with with_files=True.
+        """
+        if spec.summary.file_provides is None:
+            raise ValueError("%s was parsed without its %%files sections"
+                             % spec.summary.specpath)
+        for name, flags, evr in spec.summary.provides_evr:
+            self.add(name, flags, evr, owner)
+        dirs = set(spec.summary.dir_provides)
+        for path in spec.summary.file_provides:
+            self.add_file(path, owner, contents=path not in dirs)
+
+    def resolve_file(self, path):
+        """
+        Return the owner of the file at path, or None if nothing in the
+        index provides it.   The file itself is looked up first, then
+        each of its parent directories in turn, nearest first.
+        """
+        if path in self.files:
+            return self.files[path]
+        directory = os.path.dirname(path)
+        while True:
+            for pattern, owner in self.file_patterns.get(directory, []):
+                if fnmatch.fnmatch(path, pattern):
+                    return owner
+            if directory in self.trees:
+                return self.trees[directory]
+            parent = os.path.dirname(directory)
+            if parent == directory:
+                return None
+            directory = parent
+
+    def resolve(self, name, flags=0, evr=""):
+        """
+        Return the owner of a provide which satisfies the requirement
+        for name with flags and evr, or None if nothing in the index
+        satisfies it.
+        """
+        if name.startswith("/"):
+            owner = self.resolve_file(name)
+            if owner is not None:
+                return owner
+
+        candidates = self.names.get(name)
+        if candidates is None:
+            candidates = self.names.get(ARCH_SUFFIX.sub('', name), [])
+        for provide_flags, provide_evr, owner in candidates:
+            if overlaps(provide_flags, provide_evr, flags, evr):
+                return owner
+        return None
+
+    def __contains__(self, name):
+        return self.resolve(name) is not None
+
+    def __getitem__(self, name):
+        owner = self.resolve(name)
+        if owner is None:
+            raise KeyError(name)
+        return owner
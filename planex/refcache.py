@@ -0,0 +1,304 @@
+"""
+Cache of the refs advertised by git remotes.
+
+Every ref of a remote is listed with a single 'git ls-remote' and the
+result is shared by all lookups of tags and branches on that remote.
+The full SHA1s of commits named by commitish through the BitBucket API
+are cached in the same way.   Values are kept in memory for the life of
+the process and, if a cache directory is configured, on disk so that
+separate planex processes can share them.
+
+The lookups made during a run can be written to a lock file.   A later
+run which is frozen to that lock file answers the same lookups from it
+without touching the network.   Refs which were looked up but did not
+exist are recorded as null, so a frozen run can tell them apart from
+refs which were never looked up.
+"""
+
+import hashlib
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+
+import requests
+
+from planex.fileupdate import FileUpdate
+import planex.git as git
+from planex.util import makedirs
+
+
+# Seconds for which an expiring entry on disk is considered fresh
+DEFAULT_TTL = 300
+
+FULL_SHA1 = re.compile("^[0-9a-f]{40}$")
+
+
+class FrozenError(RuntimeError):
+    """A frozen cache was asked for a value which is not in its lock file"""
+    pass
+
+
+def parse_ls_remote(output):
+    """
+    Parse the output of 'git ls-remote' into a dictionary mapping
+    ref names to SHA1s.
+    """
+    # Example output:
+    # db8d9edd203460adba4b9175971c2cfc14ac0f64  refs/tags/v3.3.0
+    # ddb48b561342d7742ec1dbd6c4987c1f4add9387  refs/tags/v3.3.0^{}
+    refs = {}
+    for line in output.splitlines():
+        fields = line.split()
+        if len(fields) == 2:
+            sha1, ref = fields
+            refs[ref] = sha1
+    return refs
+
+
+class _DiskCache(object):
+    """
+    Values fetched from remote services, held in memory and optionally
+    on disk, indexed by the URL they were fetched from
+    """
+
+    def __init__(self, cachedir=None, ttl=DEFAULT_TTL):
+        self.cachedir = cachedir
+        self.ttl = ttl
+        self.timeout = None
+        self.frozen = None
+        self._values = {}
+        self._locks = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        """Forget all values held in memory"""
+        with self._lock:
+            self._values = {}
+            self._locks = {}
+
+    def _url_lock(self, url):
+        """Return the lock serialising lookups of url"""
+        with self._lock:
+            return self._locks.setdefault(url, threading.Lock())
+
+    def _disk_path(self, url):
+        """Return the path of the on-disk entry for url"""
+        return os.path.join(self.cachedir,
+                            hashlib.sha1(url).hexdigest() + ".json")
+
+    def _load(self, url):
+        """Return the value for url from disk, if it is fresh"""
+        if self.cachedir is None:
+            return None
+        try:
+            with open(self._disk_path(url)) as cachefile:
+                entry = json.load(cachefile)
+        except (IOError, ValueError):
+            return None
+        if entry.get("url") != url:
+            return None
+        if (entry["time"] is not None and
+                time.time() - entry["time"] > self.ttl):
+            return None
+        logging.debug("Using cached response for %s", url)
+        return entry["value"]
+
+    def _save(self, url, value, expires=True):
+        """
+        Write the value for url to disk.   If expires is False, the
+        entry remains valid indefinitely.
+        """
+        if self.cachedir is None:
+            return
+        makedirs(self.cachedir)
+        fd, tmp_path = tempfile.mkstemp(dir=self.cachedir)
+        with os.fdopen(fd, "w") as cachefile:
+            json.dump({"url": url, "time": time.time() if expires else None,
+                       "value": value}, cachefile)
+        os.rename(tmp_path, self._disk_path(url))
+
+    def _lookup(self, url, fetch, expires=True):
+        """
+        Return the value for url, calling fetch to obtain it if it is
+        not already cached.   Each URL is fetched at most once.
+        If the cache is frozen, only values from its lock file are
+        returned and nothing is fetched.
+        """
+        if self.frozen is not None:
+            if url not in self.frozen:
+                raise FrozenError("%s is not in the lock file" % url)
+            return self.frozen[url]
+        with self._url_lock(url):
+            if url not in self._values:
+                value = self._load(url)
+                if value is None:
+                    value = fetch()
+                    self._save(url, value, expires)
+                self._values[url] = value
+            return self._values[url]
+
+
+class RefCache(_DiskCache):
+    """Listings of the refs of git remotes, indexed by remote URL"""
+
+    def __init__(self, cachedir=None, ttl=DEFAULT_TTL):
+        super(RefCache, self).__init__(cachedir, ttl)
+        self.mirrors = None
+        self._used = {}
+
+    def clear(self):
+        """Forget all listings held in memory"""
+        super(RefCache, self).clear()
+        with self._lock:
+            self._used = {}
+
+    def _ref(self, url, ref):
+        """
+        Return the SHA1 of ref on the remote at url, or None if there
+        is no such ref, and record that ref was looked up.   If the
+        cache is frozen and ref was not looked up when the lock file
+        was written, FrozenError is raised.
+        """
+        refs = self.refs(url)
+        if self.frozen is not None and ref not in refs:
+            raise FrozenError("%s on %s is not in the lock file" % (ref, url))
+        with self._lock:
+            self._used.setdefault(url, set()).add(ref)
+        return refs.get(ref)
+
+    def locked(self):
+        """
+        Return the refs looked up so far, and their SHA1s, in the form
+        used for the lock file: a dictionary mapping each remote URL to
+        a partial listing.   Refs which do not exist map to None, so
+        lookups of the same refs in the partial listings give the same
+        answers as in the full listings.
+        """
+        with self._lock:
+            used = dict(self._used)
+        locked = {}
+        for url, names in used.items():
+            refs = self.refs(url)
+            locked[url] = {ref: refs.get(ref) for ref in names}
+        return locked
+
+    def refs(self, url):
+        """
+        Return a dictionary mapping every ref advertised by the remote
+        at url to its SHA1.   The remote is queried at most once.
+        """
+        ls_remote = git.ls_remote
+        if self.mirrors is not None:
+            ls_remote = self.mirrors.ls_remote
+        return self._lookup(url, lambda: parse_ls_remote(
+            ls_remote(url, timeout=self.timeout)))
+
+    def is_tag(self, url, name):
+        """Return True if name is a tag on the remote at url"""
+        return self._ref(url, "refs/tags/" + name) is not None
+
+    def tag_sha1(self, url, name):
+        """
+        Return the SHA1 of the commit which tag name points to on the
+        remote at url, or '' if there is no such tag.
+        """
+        # The SHA1 of a peeled annotated tag ('^{}') is that of the commit
+        # rather than that of the tag object.
+        return (self._ref(url, "refs/tags/%s^{}" % name) or
+                self._ref(url, "refs/tags/" + name) or "")
+
+    def branch_sha1(self, url, name):
+        """
+        Return the SHA1 of the head of branch name on the remote at url,
+        or '' if there is no such branch.
+        """
+        return self._ref(url, "refs/heads/" + name) or ""
+
+
+class CommitCache(_DiskCache):
+    """
+    SHA1s of commits named by commitish, as returned by a web API.
+    Requests share a single HTTP session, so connections to the API
+    server are kept alive between lookups.
+    """
+
+    def __init__(self, cachedir=None, ttl=DEFAULT_TTL):
+        super(CommitCache, self).__init__(cachedir, ttl)
+        self.session = requests.Session()
+
+    def _fetch(self, api_url):
+        """Fetch the commit at api_url and return its full SHA1"""
+        logging.debug("Fetching SHA1 using %s", api_url)
+        response = self.session.get(api_url, timeout=self.timeout)
+        response.raise_for_status()
+        return response.json()['id']
+
+    def sha1(self, api_url, commitish):
+        """
+        Return the full SHA1 of commitish, which is described by the
+        API resource at api_url.   A full SHA1 always names the same
+        commit, so its entry never expires; abbreviated SHA1s may
+        become ambiguous and are looked up again after the TTL.
+        """
+        return self._lookup(api_url, lambda: self._fetch(api_url),
+                            expires=not FULL_SHA1.match(commitish))
+
+    def locked(self):
+        """
+        Return the commitishes resolved so far in the form used for the
+        lock file: a dictionary mapping API URLs to full SHA1s.
+        """
+        with self._lock:
+            return dict(self._values)
+
+
+REF_CACHE = RefCache()
+COMMIT_CACHE = CommitCache()
+
+
+def configure(cachedir=None, ttl=DEFAULT_TTL, mirrors=None, timeout=None):
+    """
+    Configure the on-disk location and lifetime of the shared caches.
+    If mirrors is a planex.mirror.MirrorCache, refs are listed from
+    existing mirrors rather than from the remotes.   If timeout is
+    given, each query of a remote is abandoned after timeout seconds.
+    """
+    for cache in [REF_CACHE, COMMIT_CACHE]:
+        cache.cachedir = cachedir
+        cache.ttl = ttl
+        cache.timeout = timeout
+        cache.frozen = None
+    REF_CACHE.mirrors = mirrors
+
+
+def freeze(lock_path):
+    """
+    Serve all lookups by the shared caches from the lock file at
+    lock_path, written by a previous run, without using the network.
+    Lookups which are not in the lock file raise FrozenError.
+    """
+    with open(lock_path) as lock_file:
+        lock = json.load(lock_file)
+    REF_CACHE.frozen = lock.get("refs", {})
+    COMMIT_CACHE.frozen = lock.get("commits", {})
+
+
+def write_lock(lock_path):
+    """
+    Write every lookup made by the shared caches so far to a lock file
+    at lock_path, which can later be used by freeze().   The file is
+    left untouched if its contents have not changed.
+    """
+    lock = {"refs": REF_CACHE.locked(), "commits": COMMIT_CACHE.locked()}
+    with FileUpdate(lock_path) as lock_file:
+        lock_file.write(json.dumps(lock, indent=2, sort_keys=True) + "\n")
+
+
+def clear():
+    """Forget all values held in memory by the shared caches"""
+    REF_CACHE.clear()
+    COMMIT_CACHE.clear()
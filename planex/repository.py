@@ -5,10 +5,8 @@ import logging
 import os.path
 import subprocess
 import urlparse
-import re
-import requests
 
-import planex.git as git
+from planex.refcache import COMMIT_CACHE, REF_CACHE
 
 
 class Repository(object):
@@ -69,50 +67,12 @@ class Repository(object):
         SHA1 of the commit tag is pointing to.
         """
         if self.tag:
-            option = '-t'
-            ref = self.tag
+            self.sha1 = REF_CACHE.tag_sha1(self._query_url, self.tag)
         elif self.branch:
-            option = '-h'
-            ref = self.branch
+            self.sha1 = REF_CACHE.branch_sha1(self._query_url, self.branch)
         elif self.commitish and self.url.netloc in self.commitish_to_sha1s:
             commitish_to_sha1 = self.commitish_to_sha1s[self.url.netloc]
             self.sha1 = commitish_to_sha1(self, self.commitish)
-            return
-        else:
-            self.sha1 = ''
-            return
-
-        # Example command:
-        # git ls-remote -t \
-        #     git://hg.uk.xensource.com/carbon/trunk/blktap.git v3.3.0*
-        remote_refs = git.ls_remote(self._query_url, ref + '*', option)
-
-        # Example output of above command:
-        # db8d9edd203460adba4b9175971c2cfc14ac0f64  refs/tags/v3.3.0
-        # ddb48b561342d7742ec1dbd6c4987c1f4add9387  refs/tags/v3.3.0^{}
-        regex = (
-            r'(^[\da-f]{{40}})'     # 40 char hex SHA1 (group(1))
-            r'\trefs\/'             # <tab>refs/
-            r'(?:tags|heads)\/'     # {'tags' or 'heads'}/
-            '({}(\\^{{}})*)$'       # <ref>{0 or more of '^{}'} (group(2))
-        ).format(re.escape(ref))
-
-        # list of (<ref_name>, <sha1>) tuples
-        ref_sha1_list = []
-
-        for line in remote_refs.split('\n'):
-            match = re.match(regex, line)
-
-            if match is not None:
-                ref_sha1_list.append((match.group(2), match.group(1)))
-
-        if ref_sha1_list:
-            # Sort in descending order by <ref_name> length;
-            # This way, names with '^{}' will come to the beginning
-            # of the list. Their SHA1 points to the actual commit
-            # instead of the tag object.
-            ref_sha1_list.sort(key=lambda tup: len(tup[0]), reverse=True)
-            self.sha1 = ref_sha1_list[0][1]
         else:
             self.sha1 = ''
 
@@ -130,9 +90,9 @@ class Repository(object):
             path[2]
         )
 
-        remote_ref = git.ls_remote(self._query_url, path[4])
-
-        if remote_ref and remote_ref.split('/', 2)[1] == 'tags':
+        # A branch takes precedence over a tag with the same name
+        if (REF_CACHE.is_tag(self._query_url, path[4]) and
+                not REF_CACHE.branch_sha1(self._query_url, path[4])):
             self.tag = path[4]
         else:
             self.branch = path[4]
@@ -170,13 +130,10 @@ class Repository(object):
     def commitish_to_sha1_bitbucket(self, commitish):
         """Convert a commitish to a full SHA1 using the BitBucket API"""
         path = self.url.path.split('/')
-        url = "https://%s/rest/api/1.0/projects/%s/repos/%s/commits/%s" % \
-            (self.url.netloc, path[5], path[7], commitish)
-        logging.debug("Fetching SHA1 using " + url)
-        api_response = requests.get(url)
-        api_response.raise_for_status()
-        data = api_response.json()
-        return data['id']
+        url = "%s/rest/api/1.0/projects/%s/repos/%s/commits/%s" % \
+            (self.bitbucket_api.format(netloc=self.url.netloc), path[5],
+             path[7], commitish)
+        return COMMIT_CACHE.sha1(url, commitish)
 
     def parse_gitweb(self):
         """Parse GitWeb source URL"""
@@ -197,6 +154,9 @@ class Repository(object):
         'code.citrite.net': parse_bitbucket,
         'hg.uk.xensource.com': parse_gitweb,
         }
+    # Base URL of the BitBucket REST API for a given server
+    bitbucket_api = "https://{netloc}"
+
     commitish_to_sha1s = {
         'code.citrite.net': commitish_to_sha1_bitbucket
     }
@@ -3,30 +3,105 @@
    the rpm library does not currently provide."""
 from __future__ import print_function
 
+from collections import namedtuple
 import contextlib
+from multiprocessing.pool import ThreadPool
 import os
 import re
 import urlparse
 import sys
 import tempfile
+import threading
 
 import rpm
 
 
+# librpm keeps a single, process-wide macro table.   Every use of it
+# from planex happens while holding this lock.   It is re-entrant because
+# macro environments are nested, for instance when a Spec expands a
+# macro while it is being parsed.
+MACRO_LOCK = threading.RLock()
+
+# (name, value) of each macro added by the active rpm_macros() contexts,
+# in the order they were added, so that the macro table can be rebuilt
+# after librpm has been reconfigured.
+MACRO_STACK = []
+
+# librpm's log level, restored after parsing a spec quietly.   librpm
+# cannot report its current level, so it must be changed through
+# set_verbosity for the new level to be restored.
+RPM_VERBOSITY = rpm.RPMLOG_NOTICE
+
+
+def set_verbosity(level):
+    """Set librpm's log level to level, an rpm.RPMLOG_* constant"""
+    global RPM_VERBOSITY  # pylint: disable=global-statement
+    with MACRO_LOCK:
+        RPM_VERBOSITY = level
+        rpm.setVerbosity(level)
+
+
 @contextlib.contextmanager
 def rpm_macros(*macros):
     """
     Context manager to add and remove stacked RPM macro 'environments'.
     Macro definitions which occur later in 'macros' override definitions
-    made earlier.
+    made earlier.   librpm stacks definitions of the same macro, so
+    removing a definition restores the one it hid.   The macros which
+    were added are removed even if the body raises an exception, and
+    other threads cannot use the macro table until they are removed.
+    """
+    with MACRO_LOCK:
+        added = []
+        try:
+            for macro in macros:
+                for key, value in macro.items():
+                    rpm.addMacro(key, value)
+                    MACRO_STACK.append((key, value))
+                    added.append(key)
+            yield
+        finally:
+            for key in reversed(added):
+                rpm.delMacro(key)
+                MACRO_STACK.pop()
+
+
+def reset_macros():
     """
-    for macro in macros:
-        for key, value in macro.items():
+    Discard every macro which has been defined in librpm's macro table
+    other than by rpm_macros(), such as the %define and %global macros
+    of a parsed spec, and restore the macros of the active rpm_macros()
+    contexts.   librpm cannot remove a spec's macros individually, so
+    its configuration is reloaded from scratch.
+    """
+    with MACRO_LOCK:
+        rpm.reloadConfig()
+        for key, value in MACRO_STACK:
             rpm.addMacro(key, value)
-    yield
-    for macro in reversed(macros):
-        for key in macro.keys():
-            rpm.delMacro(key)
+
+
+# Spec file section headers
+SECTIONS = re.compile(
+    r'^%(package|description|prep|build|install|check|clean|files|'
+    r'changelog|pre|post|preun|postun|pretrans|posttrans|verifyscript|'
+    r'trigger\w*|filetrigger\w*|transfiletrigger\w*)\b')
+
+# File list directives which qualify the path which follows them
+FILE_DIRECTIVES = re.compile(
+    r'%(attr|config|verify|lang|caps)\([^)]*\)|'
+    r'%(config|doc|docdir|license|readme|dir|ghost|artifact)\b')
+
+# File list directive for a directory which is owned without its contents
+DIR_DIRECTIVE = re.compile(r'%dir\b')
+
+
+def dependencies(header, tag):
+    """
+    Return a list of (name, flags, evr) tuples for the dependencies of
+    type tag ('provide' or 'require') recorded in header.
+    """
+    return list(zip(header[tag + 'name'], header[tag + 'flags'],
+                    header[tag + 'version']))
 
 
 def nevra(package):
@@ -50,11 +125,19 @@ class SpecNameMismatch(Exception):
     pass
 
 
-def parse_spec_quietly(path):
+class SpecScanUnsupported(Exception):
+    """Exception raised when scan_spec finds a construct which only
+       librpm can evaluate"""
+    pass
+
+
+def parse_spec_capturing_errors(path):
     """
     Parse spec file at 'path' and return an rpm.spec object.
-    This function suppresses any errors about missing sources which
-    librpm writes to stderr.
+    Everything which librpm writes to stderr while parsing is collected,
+    and if parsing fails it is printed, except for errors about missing
+    sources.   This redirects the whole process's stderr, so it must
+    only be used while holding MACRO_LOCK.
     """
     with tempfile.TemporaryFile() as nullfh:
         try:
@@ -80,18 +163,70 @@ def parse_spec_quietly(path):
             raise
 
 
+def parse_spec_quietly(path):
+    """
+    Parse spec file at 'path' and return an rpm.spec object.
+    This function suppresses any errors about missing sources which
+    librpm writes to stderr.   A spec which cannot be parsed is parsed
+    a second time to capture its errors, so any shell commands it runs
+    with %(...) are run twice.
+    """
+    # librpm's log level, like its macro table, is global.   Raising it
+    # silences the parse without redirecting stderr or creating a file.
+    # If the spec cannot be parsed, it is parsed again with its errors
+    # captured so that they can be filtered and reported.
+    with MACRO_LOCK:
+        rpm.setVerbosity(rpm.RPMLOG_EMERG)
+        try:
+            return rpm.ts().parseSpec(path)
+        except ValueError:
+            pass
+        finally:
+            rpm.setVerbosity(RPM_VERBOSITY)
+        return parse_spec_capturing_errors(path)
+
+
+class SpecSummary(object):
+    """
+    Immutable summary of the metadata of a parsed spec file.   It is
+    computed once when the spec is parsed, so querying it does not call
+    into librpm or expand macros again.   Reading the %files sections
+    expands a macro for every line, so file_provides and dir_provides
+    are None unless the spec was parsed with with_files=True.
+    """
+
+    __slots__ = ('name', 'version', 'specpath', 'source_package_path',
+                 'binary_package_paths', 'sources', 'provides', 'requires',
+                 'buildrequires', 'provides_evr', 'requires_evr',
+                 'buildrequires_evr', 'file_provides', 'dir_provides')
+
+    def __init__(self, **fields):
+        for slot in self.__slots__:
+            object.__setattr__(self, slot, fields[slot])
+
+    def __setattr__(self, name, value):
+        raise AttributeError("SpecSummary is immutable")
+
+    def __delattr__(self, name):
+        raise AttributeError("SpecSummary is immutable")
+
+    @property
+    def rpm_path(self):
+        """
+        Path of the last binary package built by the spec, which stands
+        for all of its binary packages in build rules
+        """
+        return self.binary_package_paths[-1]
+
+
 class Spec(object):
     """Represents an RPM spec file"""
 
-    def __init__(self, path, check_package_name=True, defines=None):
+    def __init__(self, path, check_package_name=True, defines=None,
+                 with_files=False):
 
         self.macros = dict(defines) if defines else {}
 
-        # _topdir defaults to $HOME/rpmbuild
-        # If present, it needs to be applied once at the beginning
-        if '_topdir' in self.macros:
-            rpm.addMacro('_topdir', self.macros['_topdir'])
-
         # '%dist' in the host (where we build the source package)
         # might not match '%dist' in the chroot (where we build
         # the binary package).   We must override it on the host,
@@ -100,24 +235,135 @@ class Spec(object):
         if 'dist' not in self.macros:
             self.macros['dist'] = ""
 
+        self.path = path
+        with open(path) as spec:
+            self.spectext = spec.readlines()
+
         with rpm_macros(self.macros):
-            self.path = path
-            with open(path) as spec:
-                self.spectext = spec.readlines()
-            self.spec = parse_spec_quietly(path)
-
-            if check_package_name:
-                file_basename = os.path.basename(path).split(".")[0]
-                if file_basename != self.name():
-                    raise SpecNameMismatch(
-                        "spec file name '%s' does not match package name '%s'"
-                        % (path, self.name()))
+            try:
+                self.spec = parse_spec_quietly(path)
+
+                name = self.spec.sourceHeader['name']
+                if check_package_name:
+                    file_basename = os.path.basename(path).split(".")[0]
+                    if file_basename != name:
+                        raise SpecNameMismatch(
+                            "spec file name '%s' does not match package "
+                            "name '%s'" % (path, name))
+
+                # _topdir defaults to $HOME/rpmbuild, so the paths of the
+                # packages must be computed while the defines are in effect
+                self.summary = self._summarise(name, with_files)
+            finally:
+                # Parsing leaves the spec's %define and %global macros
+                # in librpm's table, where the next spec would see them
+                reset_macros()
+
+    def _summarise(self, name, with_files):
+        """
+        Return the SpecSummary of the parsed spec, including the paths
+        listed in its %files sections if with_files is True
+        """
+        file_provides = dir_provides = None
+        if with_files:
+            file_entries = self._file_entries()
+            file_provides = tuple(path for path, _ in file_entries)
+            dir_provides = tuple(path for path, is_dir in file_entries
+                                 if is_dir)
+        return SpecSummary(
+            name=name,
+            version=self.spec.sourceHeader['version'],
+            specpath=self.path,
+            source_package_path=self._source_package_path(),
+            binary_package_paths=tuple(self._binary_package_paths()),
+            sources=tuple(self._sources()),
+            provides=frozenset(self._provides()),
+            requires=frozenset(self._requires()),
+            buildrequires=frozenset(self._buildrequires()),
+            provides_evr=tuple(self._provides_evr()),
+            requires_evr=tuple(self._requires_evr()),
+            buildrequires_evr=tuple(self._buildrequires_evr()),
+            file_provides=file_provides,
+            dir_provides=dir_provides)
 
     def specpath(self):
         """Return the path to the spec file"""
         return self.path
 
+    def name(self):
+        """Return the package name"""
+        return self.summary.name
+
+    def version(self):
+        """Return the package version"""
+        return self.summary.version
+
     def provides(self):
+        """Return a list of package names provided by this spec"""
+        return set(self.summary.provides)
+
+    def provides_evr(self):
+        """
+        Return a list of (name, flags, evr) tuples for the capabilities
+        provided by this spec
+        """
+        return list(self.summary.provides_evr)
+
+    def file_provides(self):
+        """
+        Return the list of paths listed in the %files sections.   The
+        spec must have been parsed with with_files=True.
+        """
+        return list(self.summary.file_provides)
+
+    def dir_provides(self):
+        """
+        Return the list of paths listed with %dir in the %files
+        sections, which own the directory but not its contents.   The
+        spec must have been parsed with with_files=True.
+        """
+        return list(self.summary.dir_provides)
+
+    def requires(self):
+        """Return the set of packages needed by this package at runtime
+           (Requires)"""
+        return set(self.summary.requires)
+
+    def requires_evr(self):
+        """
+        Return a list of (name, flags, evr) tuples for the runtime
+        requirements of this package (Requires)
+        """
+        return list(self.summary.requires_evr)
+
+    def buildrequires(self):
+        """Return the set of packages needed to build this spec
+           (BuildRequires)"""
+        return set(self.summary.buildrequires)
+
+    def buildrequires_evr(self):
+        """
+        Return a list of (name, flags, evr) tuples for the build-time
+        requirements of this package (BuildRequires)
+        """
+        return list(self.summary.buildrequires_evr)
+
+    def source_package_path(self):
+        """
+        Return the path of the source package which building this spec
+        will produce
+        """
+        return self.summary.source_package_path
+
+    def sources(self):
+        """List all sources defined in the spec file"""
+        return list(self.summary.sources)
+
+    def binary_package_paths(self):
+        """Return a list of binary packages built by this spec"""
+        return list(self.summary.binary_package_paths)
+
+    def _provides(self):
         """Return a list of package names provided by this spec"""
         provides = sum([pkg.header['provides'] + [pkg.header['name']]
                         for pkg in self.spec.packages], [])
@@ -126,13 +372,49 @@ class Spec(object):
         provides = [re.sub(r'\(x86-64\)$', '', pkg) for pkg in provides]
         return set(provides)
 
-    def name(self):
-        """Return the package name"""
-        return self.spec.sourceHeader['name']
-
-    def version(self):
-        """Return the package version"""
-        return self.spec.sourceHeader['version']
+    def _provides_evr(self):
+        """
+        Return a list of (name, flags, evr) tuples for the capabilities
+        provided by this spec, including the implicit 'name = evr'
+        provide of each package
+        """
+        provides = []
+        for pkg in self.spec.packages:
+            hdr = pkg.header
+            provides.extend(dependencies(hdr, 'provide'))
+            evr = "%s-%s" % (hdr['version'], hdr['release'])
+            if hdr['epoch'] is not None:
+                evr = "%s:%s" % (hdr['epoch'], evr)
+            provides.append((hdr['name'], rpm.RPMSENSE_EQUAL, evr))
+        return provides
+
+    def _file_entries(self):
+        """
+        Return a list of (path, is_dir) tuples for the absolute paths,
+        which may contain shell-style wildcards, listed in the %files
+        sections of this spec.   is_dir is True for paths listed with
+        %dir.   librpm does not evaluate %files when parsing a spec, so
+        the sections are read from the spec text.
+        """
+        entries = []
+        in_files = False
+        for line in self.spectext:
+            line = line.strip()
+            section = SECTIONS.match(line)
+            if section:
+                in_files = section.group(1) == 'files'
+                continue
+            if not in_files or not line or line.startswith('#'):
+                continue
+            if line.startswith('%exclude') or line.startswith('%defattr'):
+                continue
+            path = FILE_DIRECTIVES.sub('', line).strip().strip('"')
+            if not path:
+                continue
+            path = self.expand_macro(path)
+            if path.startswith('/'):
+                entries.append((path, DIR_DIRECTIVE.search(line) is not None))
+        return entries
 
     def expand_macro(self, macro):
         """Return the value of macro, expanded in the package's context"""
@@ -142,20 +424,35 @@ class Spec(object):
     # RPM runtime dependencies.   These are not required to build this
     # package, but will need to be installed when building any other
     # package which BuildRequires this one.
-    def requires(self):
+    def _requires(self):
         """Return the set of packages needed by this package at runtime
            (Requires)"""
         return set.union(*[set(p.header['REQUIRES'])
                            for p in self.spec.packages])
 
+    def _requires_evr(self):
+        """
+        Return a list of (name, flags, evr) tuples for the runtime
+        requirements of this package (Requires)
+        """
+        return sum([dependencies(p.header, 'require')
+                    for p in self.spec.packages], [])
+
     # RPM build dependencies.   The 'requires' key for the *source* RPM is
     # actually the 'buildrequires' key from the spec
-    def buildrequires(self):
+    def _buildrequires(self):
         """Return the set of packages needed to build this spec
            (BuildRequires)"""
         return set(self.spec.sourceHeader['requires'])
 
-    def source_package_path(self):
+    def _buildrequires_evr(self):
+        """
+        Return a list of (name, flags, evr) tuples for the build-time
+        requirements of this package (BuildRequires)
+        """
+        return dependencies(self.spec.sourceHeader, 'require')
+
+    def _source_package_path(self):
         """
         Return the path of the source package which building this spec
         will produce
@@ -168,7 +465,7 @@ class Spec(object):
         srpmname = self.spec.sourceHeader['nvr'] + ".src.rpm"
         return rpm.expandMacro(os.path.join('%_srcrpmdir', srpmname))
 
-    def sources(self):
+    def _sources(self):
         """List all sources defined in the spec file"""
 
         # RPM only looks at the basename part of the Source URL - the
@@ -194,7 +491,7 @@ class Spec(object):
 
         raise KeyError(target_basename)
 
-    def binary_package_paths(self):
+    def _binary_package_paths(self):
         """Return a list of binary packages built by this spec"""
 
         def rpm_name_from_header(hdr):
@@ -226,3 +523,213 @@ class Spec(object):
         patch_urls = [urlparse.urlparse(url) for (url, _, sourcetype)
                       in self.spec.sources if sourcetype == 2]
         return [url.path for url in patch_urls if url.netloc == '']
+
+
+def parse_specs(paths, jobs=1, **kwargs):
+    """
+    Return a list of Spec objects for the spec files at paths, in the
+    same order, reading up to jobs of them concurrently.   Keyword
+    arguments are passed to each Spec.   Parsing a spec and summarising
+    it use librpm's macro table throughout, so they are serialised by
+    MACRO_LOCK and concurrent parses do not see each other's
+    definitions.   Only reading the spec files overlaps, so jobs > 1
+    helps little unless the files are slow to read.
+    """
+    if jobs <= 1 or len(paths) <= 1:
+        return [Spec(path, **kwargs) for path in paths]
+
+    pool = ThreadPool(min(jobs, len(paths)))
+    try:
+        return pool.map(lambda path: Spec(path, **kwargs), paths)
+    finally:
+        pool.close()
+        pool.join()
+
+
+class SpecMetadata(namedtuple("SpecMetadata",
+                              "path name version sources autosetup")):
+    """
+    Metadata of a spec file which can be read without building it.
+    Sources is a list of (url, number, type) tuples in the order in
+    which they are declared, where type is 1 for sources and 2 for
+    patches, as in rpm.spec.sources.   Autosetup is True if the spec
+    applies its patches with %autosetup or %autopatch.
+    """
+
+    def urls(self):
+        """Return the URLs of all sources and patches"""
+        return [url for (url, _, _) in self.sources]
+
+
+# Preamble tags read by scan_spec
+SCAN_TAG = re.compile(r'^(name|version|release|epoch|source|patch)(\d*)\s*:'
+                      r'\s*(.*?)\s*$', re.IGNORECASE)
+SCAN_DEFINE = re.compile(r'^%(define|global)\s+(\w+)\s+(.*?)\s*$')
+SCAN_MACRO = re.compile(r'^(\?!|!\?|\?)?([A-Za-z_]\w*)(?::(.*))?$',
+                        re.DOTALL)
+SCAN_NAME = re.compile(r'[A-Za-z_]\w*')
+# Constructs which scan_spec cannot evaluate: conditionals, includes,
+# undefines, shell and expression expansion and lua
+SCAN_UNSUPPORTED = re.compile(
+    r'^%(if|el|endif|include|undefine|define\s+\w+\(|global\s+\w+\()|'
+    r'%\(|%\[|%\{lua:|\\$')
+
+# Maximum depth of nested macro expansion in scan_spec
+SCAN_MAX_DEPTH = 32
+
+
+def _scan_lookup(name, macros, depth):
+    """Return the expansion of the macro called name"""
+    if name not in macros:
+        raise SpecScanUnsupported("undefined macro %%%s" % name)
+    return _scan_expand(macros[name], macros, depth + 1)
+
+
+def _scan_macro(body, macros, depth):
+    """Return the expansion of the braced macro %{body}"""
+    match = SCAN_MACRO.match(body)
+    if not match:
+        raise SpecScanUnsupported("macro %%{%s}" % body)
+    condition, name, value = match.groups()
+    if condition is None:
+        if value is not None:
+            # Built-in macros such as %{expand:...}
+            raise SpecScanUnsupported("macro %%{%s}" % body)
+        return _scan_lookup(name, macros, depth)
+
+    defined = name in macros
+    if condition != "?":
+        defined = not defined
+    if not defined:
+        return ""
+    if value is not None:
+        return _scan_expand(value, macros, depth + 1)
+    if condition == "?":
+        return _scan_lookup(name, macros, depth)
+    return ""
+
+
+def _scan_expand(text, macros, depth=0):
+    """
+    Return text with the macros in it expanded, for the simple subset of
+    macro syntax which scan_spec supports
+    """
+    if depth > SCAN_MAX_DEPTH:
+        raise SpecScanUnsupported("macro expansion too deep")
+    expanded = []
+    i = 0
+    while i < len(text):
+        start = text.find("%", i)
+        if start < 0:
+            expanded.append(text[i:])
+            break
+        expanded.append(text[i:start])
+        following = text[start + 1:start + 2]
+        if following == "%":
+            expanded.append("%")
+            i = start + 2
+        elif following == "{":
+            nesting = 0
+            for end in range(start + 1, len(text)):
+                if text[end] == "{":
+                    nesting += 1
+                elif text[end] == "}":
+                    nesting -= 1
+                    if nesting == 0:
+                        break
+            else:
+                raise SpecScanUnsupported("unterminated macro")
+            expanded.append(_scan_macro(text[start + 2:end], macros, depth))
+            i = end + 1
+        else:
+            match = SCAN_NAME.match(text, start + 1)
+            if not match:
+                raise SpecScanUnsupported("macro in %s" % text)
+            expanded.append(_scan_lookup(match.group(0), macros, depth))
+            i = match.end()
+    return "".join(expanded)
+
+
+def scan_spec(path, check_package_name=True, defines=None):
+    """
+    Return the SpecMetadata of the spec file at path, reading the spec
+    text directly rather than parsing it with librpm.   Only tags,
+    simple %define and %global macros and conditional macros such as
+    %{?dist} are understood: SpecScanUnsupported is raised if the
+    preamble uses anything else.
+    """
+    macros = {"nil": "", "dist": ""}
+    macros.update(dict(defines) if defines else {})
+
+    with open(path) as spec:
+        spectext = spec.readlines()
+
+    tags = {}
+    sources = []
+    section = None
+    for line in spectext:
+        line = line.rstrip("\n")
+        header = SECTIONS.match(line)
+        if header:
+            section = header.group(1)
+        if section not in (None, "package") or line.startswith("#"):
+            continue
+        if SCAN_UNSUPPORTED.search(line.strip()):
+            raise SpecScanUnsupported("%s: %s" % (path, line))
+        if header or section is not None:
+            continue
+
+        define = SCAN_DEFINE.match(line)
+        if define:
+            kind, name, value = define.groups()
+            if kind == "global":
+                value = _scan_expand(value, macros).replace("%", "%%")
+            macros[name] = value
+            continue
+
+        tag = SCAN_TAG.match(line)
+        if tag:
+            name, number, value = tag.groups()
+            name = name.lower()
+            value = _scan_expand(value, macros)
+            if name in ("source", "patch"):
+                sources.append((value, int(number or 0),
+                                1 if name == "source" else 2))
+            elif not number:
+                tags[name] = value
+                macros[name] = value.replace("%", "%%")
+
+    if "name" not in tags or "version" not in tags:
+        raise SpecScanUnsupported("%s: no Name or Version" % path)
+
+    if check_package_name:
+        file_basename = os.path.basename(path).split(".")[0]
+        if file_basename != tags["name"]:
+            raise SpecNameMismatch(
+                "spec file name '%s' does not match package name '%s'"
+                % (path, tags["name"]))
+
+    return SpecMetadata(path, tags["name"], tags["version"], sources,
+                        has_autosetup(spectext))
+
+
+def has_autosetup(spectext):
+    """Return True if spectext applies patches with %autosetup or
+       %autopatch"""
+    return any(line.startswith("%autosetup") or line.startswith("%autopatch")
+               for line in spectext)
+
+
+def spec_metadata(path, check_package_name=True, defines=None):
+    """
+    Return the SpecMetadata of the spec file at path.   The spec is read
+    with scan_spec if possible, falling back to parsing it with librpm
+    if it uses constructs which scan_spec does not understand.
+    """
+    try:
+        return scan_spec(path, check_package_name, defines)
+    except SpecScanUnsupported:
+        spec = Spec(path, check_package_name, defines)
+        return SpecMetadata(path, spec.name(), spec.version(),
+                            list(reversed(spec.spec.sources)),
+                            has_autosetup(spec.spectext))
@@ -2,7 +2,9 @@
 Library of generic functions used by other planex components
 """
 
+import contextlib
 import errno
+import fcntl
 import logging
 import os
 import pipes
@@ -107,3 +109,17 @@ def dedupe(items, key):
             seen.add(_key)
             ret.append(item)
     return ret
+
+
+@contextlib.contextmanager
+def lock_file(path):
+    """
+    Hold an exclusive advisory lock on path for the duration of the
+    context.   The lock file is created if it does not already exist.
+    """
+    with open(path, "a") as lockfh:
+        fcntl.flock(lockfh.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(lockfh.fileno(), fcntl.LOCK_UN)
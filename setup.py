@@ -18,6 +18,7 @@ setup(name='planex',
               'planex-init = planex.cmd.init:main',
               'planex-make-srpm = planex.cmd.makesrpm:main',
               'planex-manifest = planex.cmd.manifest:main',
+              'planex-mirror = planex.cmd.mirror:main',
               'planex-patchqueue = planex.cmd.patchqueue:main',
               'planex-pin = planex.cmd.pin:main'
           ]
@@ -0,0 +1,66 @@
+"""
+A local stand-in HTTP server for tests which talk to web services.
+"""
+
+import BaseHTTPServer
+import threading
+
+
+class StubRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """Serve GET and PUT requests from the server's dictionary of paths"""
+
+    def do_GET(self):  # pylint: disable=C0103
+        """Return the body stored at the requested path"""
+        self.server.requests.append(("GET", self.path))
+        if self.path not in self.server.responses:
+            self.send_error(404)
+            return
+        body = self.server.responses[self.path]
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_PUT(self):  # pylint: disable=C0103
+        """Store the request body at the requested path"""
+        self.server.requests.append(("PUT", self.path))
+        length = int(self.headers.getheader("Content-Length", 0))
+        self.server.responses[self.path] = self.rfile.read(length)
+        self.send_response(201)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *_):
+        """Do not log requests to stderr"""
+        pass
+
+
+class StubHTTPServer(BaseHTTPServer.HTTPServer):
+    """
+    HTTP server listening on a free port on localhost, serving bodies
+    from the responses dictionary and recording each request made.
+    Use as a context manager to run it in a background thread.
+    """
+
+    def __init__(self, responses=None):
+        BaseHTTPServer.HTTPServer.__init__(self, ("127.0.0.1", 0),
+                                           StubRequestHandler)
+        self.responses = dict(responses or {})
+        self.requests = []
+        self.thread = None
+
+    @property
+    def url(self):
+        """Return the base URL of the server"""
+        return "http://%s:%d" % self.server_address
+
+    def __enter__(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
@@ -0,0 +1,181 @@
+"""Tests for the binary build result cache"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import planex.buildcache
+from tests.httpstub import StubHTTPServer
+
+
+class FakePackage(object):
+    """Stand-in for a LocalPackage, without reading an RPM header"""
+
+    # pylint: disable=R0903
+    def __init__(self, name, provides=(), requires=()):
+        self.path = "RPMS/x86_64/%s.rpm" % name
+        self.nevra = "%s-0:1.0-1.x86_64" % name
+        self.digest = name
+        self.provides = set(provides) | set([name])
+        self.requires = set(requires)
+
+
+class ResolveTests(unittest.TestCase):
+    """Resolution of build requirements against local packages"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.index = planex.buildcache.LocalPackages(self.tmpdir)
+        for pkg in [FakePackage("ocaml-uri-devel", requires=["ocaml-re"]),
+                    FakePackage("ocaml-re", provides=["ocaml(Re)"]),
+                    FakePackage("unrelated")]:
+            for provide in pkg.provides:
+                self.index.providers.setdefault(provide, []).append(pkg)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_resolve_transitive(self):
+        """Local packages required by build requirements are included"""
+        resolved = self.index.resolve(["ocaml-uri-devel", "ocaml"])
+        self.assertItemsEqual([pkg.nevra for pkg in resolved],
+                              ["ocaml-uri-devel-0:1.0-1.x86_64",
+                               "ocaml-re-0:1.0-1.x86_64"])
+
+    def test_resolve_system(self):
+        """Requirements met by the distribution resolve to nothing"""
+        self.assertEqual(self.index.resolve(["gcc", "make"]), set())
+
+
+class StoreTests(unittest.TestCase):
+    """Storing and restoring build results"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.resultdir = os.path.join(self.tmpdir, "result")
+        self.restoredir = os.path.join(self.tmpdir, "restored")
+        os.makedirs(self.resultdir)
+        os.makedirs(self.restoredir)
+        for name in ["foo-1.0-1.x86_64.rpm", "build.log"]:
+            with open(os.path.join(self.resultdir, name), "w") as result:
+                result.write("contents of %s\n" % name)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def check_round_trip(self, store):
+        """Results stored under a key are restored intact"""
+        self.assertFalse(store.fetch("abcdef", self.restoredir))
+        store.store("abcdef", self.resultdir)
+        self.assertTrue(store.fetch("abcdef", self.restoredir))
+        self.assertItemsEqual(os.listdir(self.restoredir),
+                              ["foo-1.0-1.x86_64.rpm", "build.log"])
+        with open(os.path.join(self.restoredir, "build.log")) as result:
+            self.assertEqual(result.read(), "contents of build.log\n")
+
+    def test_local_store(self):
+        """Results can be stored in a local directory"""
+        store = planex.buildcache.open_store(
+            os.path.join(self.tmpdir, "cache"))
+        self.check_round_trip(store)
+
+    def test_http_store(self):
+        """Results can be stored on an HTTP server"""
+        with StubHTTPServer() as server:
+            store = planex.buildcache.open_store(server.url + "/cache")
+            self.check_round_trip(store)
+            self.assertIn(("PUT", "/cache/abcdef.tar"), server.requests)
+
+
+class FakeLocalPackages(object):
+    """Stand-in for LocalPackages, mapping names to package IDs"""
+
+    # pylint: disable=R0903
+    def __init__(self, pkgids):
+        self.packages = pkgids
+
+    def pkgids(self, name):
+        """Return the package IDs of the local packages called name"""
+        return set(self.packages.get(name, []))
+
+
+class SnapshotTests(unittest.TestCase):
+    """Recording and comparing build dependency snapshots"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.snapshot_path = os.path.join(self.tmpdir, "snap", "foo.json")
+        self.output = os.path.join(self.tmpdir, "foo-1.0-1.x86_64.rpm")
+        open(self.output, "w").close()
+        self.snapshot = {"srpm": "aaaa", "config": "bbbb"}
+        self.installed = {"bar": "cccc", "glibc": "ffff"}
+        self.local = FakeLocalPackages({"bar": ["cccc"]})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def save(self):
+        """Record the snapshot of a build of foo"""
+        planex.buildcache.save_snapshot(self.snapshot_path, self.snapshot,
+                                        self.installed, self.local,
+                                        [self.output])
+
+    def up_to_date(self, local_packages):
+        """Return whether foo is up to date with local_packages"""
+        return planex.buildcache.up_to_date(self.snapshot_path,
+                                            self.snapshot, local_packages)
+
+    def test_no_snapshot(self):
+        """A package with no recorded snapshot must be built"""
+        self.assertFalse(self.up_to_date(self.local))
+
+    def test_unchanged(self):
+        """A package whose inputs are unchanged is up to date"""
+        self.save()
+        self.assertTrue(self.up_to_date(self.local))
+
+    def test_source_changed(self):
+        """A package whose source RPM changed must be rebuilt"""
+        self.save()
+        self.snapshot["srpm"] = "abab"
+        self.assertFalse(self.up_to_date(self.local))
+
+    def test_dependency_changed(self):
+        """A package whose local dependency was rebuilt must be rebuilt"""
+        self.save()
+        self.assertFalse(self.up_to_date(FakeLocalPackages({"bar": ["dddd"]})))
+
+    def test_dependency_removed(self):
+        """A package whose local dependency was removed must be rebuilt"""
+        self.save()
+        self.assertFalse(self.up_to_date(FakeLocalPackages({})))
+
+    def test_dependency_now_local(self):
+        """A package whose dependency is now built locally is rebuilt"""
+        self.save()
+        self.assertFalse(self.up_to_date(
+            FakeLocalPackages({"bar": ["cccc"], "glibc": ["eeee"]})))
+
+    def test_unrelated_package(self):
+        """Local packages which were not installed do not matter"""
+        self.save()
+        self.assertTrue(self.up_to_date(
+            FakeLocalPackages({"bar": ["cccc"], "xen": ["eeee"]})))
+
+    def test_output_missing(self):
+        """A package whose outputs have been deleted must be rebuilt"""
+        self.save()
+        os.unlink(self.output)
+        self.assertFalse(self.up_to_date(self.local))
+
+    def test_installed_packages(self):
+        """The packages mock installed are read from its result log"""
+        self.assertIsNone(planex.buildcache.installed_packages(self.tmpdir))
+        with open(os.path.join(self.tmpdir, "installed_pkgs.log"),
+                  "w") as log:
+            log.write("bar-1.0-1.x86_64 1500000000 1024 cccc installed\n"
+                      "perl-Carp-1:1.26-244.el7.noarch 1400000000 2048 "
+                      "abcd installed\n")
+        self.assertEqual(planex.buildcache.installed_packages(self.tmpdir),
+                         {"bar": "cccc", "perl-Carp": "abcd"})
@@ -0,0 +1,69 @@
+"""Tests for planex-clone"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import planex.cmd.clone
+import planex.refcache
+
+
+LS_REMOTE_OUT = (
+    "ac9032660c02be11afdb7cc8ad23be2f1aa9b7ce\tHEAD\n"
+    "ac9032660c02be11afdb7cc8ad23be2f1aa9b7ce\trefs/heads/master\n"
+    "db8d9edd203460adba4b9175971c2cfc14ac0f64\trefs/tags/v3.3.0\n"
+)
+URL = "ssh://git@example.com/xs/blktap.git"
+
+
+class CloneOptionsTests(unittest.TestCase):
+    """Choice of git clone options for a pin"""
+
+    def setUp(self):
+        planex.refcache.clear()
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('planex.git.ls_remote')
+    def test_shallow_branch_and_tag(self, mock_git_ls_remote):
+        """Branches and tags can be cloned shallow and partial"""
+        mock_git_ls_remote.return_value = LS_REMOTE_OUT
+        for commitish in ["master", "v3.3.0"]:
+            self.assertEqual(
+                planex.cmd.clone.clone_options(URL, commitish, depth=1,
+                                               partial=True),
+                {"branch": commitish, "depth": 1, "filter": "blob:none"})
+
+    @mock.patch('planex.git.ls_remote')
+    def test_full_commit(self, mock_git_ls_remote):
+        """Repositories pinned to a commit are cloned in full"""
+        mock_git_ls_remote.return_value = LS_REMOTE_OUT
+        self.assertEqual(
+            planex.cmd.clone.clone_options(URL, "ac903266", depth=1,
+                                           partial=True),
+            {})
+
+    @mock.patch('planex.git.ls_remote')
+    def test_reference(self, mock_git_ls_remote):
+        """Bare repositories in the reference directory are borrowed from"""
+        os.mkdir(os.path.join(self.tmpdir, "blktap.git"))
+        self.assertEqual(
+            planex.cmd.clone.clone_options(URL, "master",
+                                           reference=self.tmpdir),
+            {"reference": os.path.join(self.tmpdir, "blktap.git")})
+        self.assertEqual(
+            planex.cmd.clone.clone_options(URL, "master",
+                                           reference=self.tmpdir,
+                                           dissociate=True),
+            {"reference": os.path.join(self.tmpdir, "blktap.git"),
+             "dissociate": True})
+        self.assertEqual(
+            planex.cmd.clone.clone_options("ssh://example.com/xen.git",
+                                           "master", reference=self.tmpdir),
+            {})
+        self.assertFalse(mock_git_ls_remote.called)
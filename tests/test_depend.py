@@ -1,10 +1,18 @@
 """Tests for dependency generation"""
 
 import glob
+import json
 import os
+import re
+import shutil
+import subprocess
 import sys
+import tempfile
 import unittest
 
+from nose.plugins.skip import SkipTest
+
+import planex.graph
 import planex.spec
 import planex.cmd.depend
 
@@ -69,7 +77,8 @@ class BasicTests(unittest.TestCase):
         # other packages, the test data directory contains only ocaml-uri and
         # ocaml-cstruct.
         spec_paths = glob.glob(os.path.join("tests/data", "ocaml-*.spec"))
-        specs = [planex.spec.Spec(spec_path, defines=[('dist', '.el6')])
+        specs = [planex.spec.Spec(spec_path, defines=[('dist', '.el6')],
+                                  with_files=True)
                  for spec_path in spec_paths]
 
         # This should be a library method which doesn't write to stdout
@@ -83,3 +92,78 @@ class BasicTests(unittest.TestCase):
             "_build/RPMS/x86_64/ocaml-uri-devel-1.6.0-1.el6.x86_64.rpm\n"
             "_build/RPMS/x86_64/ocaml-cohttp-devel-0.9.8-1.el6.x86_64.rpm: "
             "_build/RPMS/x86_64/ocaml-cstruct-devel-1.4.0-1.el6.x86_64.rpm\n")
+
+    def test_build_order(self):
+        """Packages are ordered after their local build dependencies"""
+        spec_paths = glob.glob(os.path.join("tests/data", "ocaml-*.spec"))
+        specs = [planex.spec.Spec(spec_path, defines=[('dist', '.el6')],
+                                  with_files=True)
+                 for spec_path in spec_paths]
+
+        order = planex.cmd.depend.build_order(
+            specs, planex.cmd.depend.package_to_rpm_map(specs))
+
+        self.assertEqual([spec.name() for spec in order],
+                         ["ocaml-cstruct", "ocaml-uri", "ocaml-cohttp"])
+
+    def test_affected_packages(self):
+        """Changes affect the changed package and all which require it"""
+        spec_paths = glob.glob(os.path.join("tests/data", "ocaml-*.spec"))
+        specs = [planex.spec.Spec(spec_path, defines=[('dist', '.el6')],
+                                  with_files=True)
+                 for spec_path in spec_paths]
+        depgraph = planex.graph.DependencyGraph.from_specs(specs, {})
+
+        self.assertEqual(
+            planex.cmd.depend.affected_packages(
+                depgraph, ["./tests/data/ocaml-uri.spec"]),
+            ["ocaml-uri", "ocaml-cohttp"])
+        self.assertEqual(
+            planex.cmd.depend.affected_packages(
+                depgraph, ["PINS/ocaml-cohttp.pin"]),
+            ["ocaml-cohttp"])
+
+
+class StableOutputTests(unittest.TestCase):
+    """Dependencies are identical whatever the hash seed"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        link = {"SchemaVersion": "2"}
+        for num in range(12):
+            link["Patch%d" % num] = {"URL": "https://example.com/p%d" % num,
+                                     "patches": "SOURCES"}
+        for num in range(3):
+            link["PatchQueue%d" % num] = {
+                "URL": "https://example.com/pq%d" % num,
+                "patchqueue": "master"}
+        self.link_path = os.path.join(self.tmpdir, "ocaml-uri.lnk")
+        with open(self.link_path, "w") as link_file:
+            json.dump(link, link_file)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_hash_seeds(self):
+        """planex-depend output does not vary with PYTHONHASHSEED"""
+        if sys.version_info < (2, 7):
+            raise SkipTest("hash randomisation needs Python 2.7")
+        argv = sorted(glob.glob("tests/data/ocaml-*.spec")) + [
+            self.link_path, "--define", "dist .el6"]
+        script = ("import sys, planex.cmd.depend; "
+                  "planex.cmd.depend.main(sys.argv[1:])")
+        outputs = set()
+        for seed in ["0", "1", "42", "12345"]:
+            env = dict(os.environ, PYTHONHASHSEED=seed)
+            outputs.add(subprocess.check_output(
+                [sys.executable, "-c", script] + argv, env=env))
+        self.assertEqual(len(outputs), 1)
+
+        # Patches are emitted in numerical order, so Patch2 comes
+        # before Patch10 however the link's keys are hashed
+        patches = []
+        for patch in re.findall(r"Patch\d+\.tar", outputs.pop()):
+            if patch not in patches:
+                patches.append(patch)
+        self.assertEqual(patches,
+                         ["Patch%d.tar" % num for num in range(12)])
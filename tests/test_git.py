@@ -0,0 +1,80 @@
+"""Tests for access to local git repositories"""
+
+import os
+import shutil
+import subprocess
+import tarfile
+import tempfile
+import unittest
+
+import planex.git
+
+
+class LocalRepositoryTests(unittest.TestCase):
+    """Queries answered from a local repository"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.tmpdir, "repo")
+        subprocess.check_call(["git", "init", "--quiet", self.repo])
+        with open(os.path.join(self.repo, "README"), "w") as readme:
+            readme.write("hello\n")
+        self.git("add", "README")
+        self.git("commit", "--quiet", "--message", "base")
+        self.git("tag", "--annotate", "--message", "v1.0", "v1.0")
+        self.git("remote", "add", "origin", "https://example.com/repo.git")
+        self.head = subprocess.check_output(
+            ["git", "-C", self.repo, "rev-parse", "HEAD"]).strip()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def git(self, *args):
+        """Run a git command in the test repository"""
+        subprocess.check_call(["git", "-C", self.repo, "-c", "user.name=Test",
+                               "-c", "user.email=test@example.com"] +
+                              list(args))
+
+    def test_tag_exists(self):
+        """Single tags are looked up"""
+        self.assertTrue(planex.git.tag_exists(self.repo, "v1.0"))
+        self.assertFalse(planex.git.tag_exists(self.repo, "v2.0"))
+
+    def test_rev_parse_tag(self):
+        """Annotated tags resolve to the commit they point to"""
+        self.assertEqual(planex.git.rev_parse(self.repo, "v1.0"), self.head)
+
+    def test_origin_url(self):
+        """The URL of origin is read from the repository configuration"""
+        self.assertEqual(planex.git.origin_url(self.repo),
+                         "https://example.com/repo.git")
+
+    def test_origin_url_missing(self):
+        """A repository without an origin is reported by name"""
+        self.git("remote", "remove", "origin")
+        with self.assertRaises(Exception) as ctx:
+            planex.git.origin_url(self.repo)
+        self.assertIn(self.repo, str(ctx.exception))
+
+    def test_archive(self):
+        """Archives are streamed to the output file"""
+        path = os.path.join(self.tmpdir, "repo.tar")
+        with open(path, "w") as output:
+            planex.git.archive(self.repo, "v1.0", output, prefix="1.0")
+        with tarfile.open(path) as tar:
+            self.assertIn("repo-1.0/README", tar.getnames())
+
+
+class CommunicateTests(unittest.TestCase):
+    """Running git commands with a timeout"""
+
+    def test_output(self):
+        """A command which finishes in time returns its output"""
+        self.assertEqual(planex.git.communicate(["echo", "hello"], 10),
+                         ("hello\n", ""))
+
+    def test_timeout(self):
+        """A command which runs for too long is killed"""
+        with self.assertRaises(RuntimeError) as ctx:
+            planex.git.communicate(["sleep", "10"], 0.1)
+        self.assertIn("Timed out", str(ctx.exception))
@@ -0,0 +1,77 @@
+"""Tests for the in-memory dependency graph"""
+
+import glob
+import os
+import shutil
+import tempfile
+import unittest
+
+import planex.graph
+import planex.spec
+
+
+class GraphTests(unittest.TestCase):
+    """Queries over the dependency graph of the test specs"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        spec_paths = glob.glob(os.path.join("tests/data", "ocaml-*.spec"))
+        specs = [planex.spec.Spec(spec_path, defines=[('dist', '.el6')],
+                                  with_files=True)
+                 for spec_path in spec_paths]
+        self.graph = planex.graph.DependencyGraph.from_specs(specs, {})
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_dependents(self):
+        """Reverse dependencies are indexed"""
+        self.assertEqual(self.graph.dependents("ocaml-uri"),
+                         set(["ocaml-cohttp"]))
+        self.assertEqual(self.graph.dependents("ocaml-cohttp"), set())
+
+    def test_closure(self):
+        """Transitive closures include the starting packages"""
+        self.assertEqual(self.graph.closure(["ocaml-cohttp"]),
+                         set(["ocaml-cohttp", "ocaml-uri", "ocaml-cstruct"]))
+        self.assertEqual(self.graph.closure(["ocaml-uri"], reverse=True),
+                         set(["ocaml-uri", "ocaml-cohttp"]))
+
+    def test_levels(self):
+        """Packages are grouped into levels which can be built together"""
+        self.assertEqual(self.graph.levels(),
+                         [["ocaml-cstruct", "ocaml-uri"], ["ocaml-cohttp"]])
+
+    def test_owners(self):
+        """Files are mapped to the packages whose rules mention them"""
+        self.assertEqual(self.graph.owners["tests/data/ocaml-uri.spec"],
+                         set(["ocaml-uri"]))
+
+    def test_cache(self):
+        """Graphs are reloaded from the cache only with the same key"""
+        path = os.path.join(self.tmpdir, "deps.graph")
+        self.graph.save(path, "key")
+        loaded = planex.graph.DependencyGraph.load(path, "key")
+        self.assertEqual(loaded.to_dict(), self.graph.to_dict())
+        self.assertEqual(loaded.build_order(), self.graph.build_order())
+        self.assertIsNone(planex.graph.DependencyGraph.load(path, "other"))
+
+    def test_no_cycles(self):
+        """The test specs do not depend on each other in a cycle"""
+        self.assertEqual(self.graph.cycles(), [])
+
+    def test_cycles(self):
+        """Strongly connected components are reported as cycles"""
+        depgraph = planex.graph.DependencyGraph()
+        for name, requires in [("a", {"b": ["b-devel"]}),
+                               ("b", {"c": ["c-devel"]}),
+                               ("c", {"a": ["a-devel"], "d": ["d"]}),
+                               ("d", {}),
+                               ("e", {"e": ["e-devel"]})]:
+            depgraph.add_package(name, name + ".rpm", name + ".src.rpm",
+                                 [], requires)
+
+        self.assertEqual(depgraph.cycles(), [["a", "b", "c"], ["e"]])
+        self.assertEqual(depgraph.cycle_edges(["a", "b", "c"]),
+                         [("a", "b", ["b-devel"]), ("b", "c", ["c-devel"]),
+                          ("c", "a", ["a-devel"])])
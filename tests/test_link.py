@@ -1,6 +1,9 @@
 """
 Tests for the class representing a link (lnk) or pin file
 """
+import os
+import shutil
+import tempfile
 import unittest
 import mock
 
@@ -108,3 +111,56 @@ class TestLink(unittest.TestCase):
         with self.assertRaises(planex.link.UnsupportedProperty):
             patchqueue = link.patchqueue
         self.assertIsNone(patchqueue)
+
+    def test_patch_sources_numeric_order(self):
+        """ Test that patch sources are ordered by their numbers"""
+
+        link = planex.link.Link('test.lnk', {
+            "SchemaVersion": "2",
+            "Patch10": {"URL": "ten"},
+            "Patch2": {"URL": "two"},
+            "patch1": {"URL": "one"},
+            "PatchQueue3": {"URL": "pq3"},
+            "PatchQueue0": {"URL": "pq0"}})
+        self.assertEqual(list(link.patch_sources),
+                         ["patch1", "Patch2", "Patch10"])
+        self.assertEqual(list(link.patchqueue_sources),
+                         ["PatchQueue0", "PatchQueue3"])
+
+
+class TestLinkIndex(unittest.TestCase):
+    """ Unit tests for the LinkIndex class """
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.link_path = os.path.join(self.tmpdir, "test.lnk")
+        with open(self.link_path, "w") as link:
+            link.write(TestLink.v2_link)
+        self.index_path = os.path.join(self.tmpdir, "links.index")
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_round_trip(self):
+        """ Test that links are read from a saved index"""
+        index = planex.link.LinkIndex()
+        index.add(planex.link.Link(self.link_path))
+        index.save(self.index_path)
+
+        loaded = planex.link.LinkIndex.load(self.index_path)
+        with mock.patch('planex.link.open', create=True) as mock_open:
+            link = loaded.get(self.link_path)
+            self.assertFalse(mock_open.called)
+        self.assertEqual(link.schema_version, 2)
+        self.assertEqual(list(link.patchqueue_sources), ["PatchQueue0"])
+
+    def test_stale_entry(self):
+        """ Test that changed files are read again"""
+        index = planex.link.LinkIndex()
+        index.add(planex.link.Link(self.link_path))
+        index.save(self.index_path)
+        with open(self.link_path, "w") as link:
+            link.write(TestLink.v1_link)
+
+        link = planex.link.LinkIndex.load(self.index_path).get(self.link_path)
+        self.assertEqual(link.schema_version, 1)
@@ -1,11 +1,15 @@
 """Tests for manifest generation"""
 
 import json
+import os
+import shutil
+import tempfile
 import unittest
 import mock
 
 import planex.cmd.manifest
 import planex.link
+import planex.refcache
 import planex.spec
 
 
@@ -13,6 +17,7 @@ class BasicTests(unittest.TestCase):
     """Basic manifest generation tests"""
 
     def setUp(self):
+        planex.refcache.clear()
         path = 'tests/data/manifest/{}.{}'
         self.name_1 = 'branding-xenserver'
         self.name_2 = 'vhostmd'
@@ -87,3 +92,118 @@ class BasicTests(unittest.TestCase):
         )
 
         self.assertEqual(manifest, self.expected_manifest[self.name_3])
+
+
+class GenerateAllTests(unittest.TestCase):
+    """Manifest generation for many packages in one invocation"""
+
+    def setUp(self):
+        planex.refcache.clear()
+        self.tmpdir = tempfile.mkdtemp()
+        with open('tests/data/manifest/git_ls_remote_out.json') as fileh:
+            self.git_ls_remote_out = json.load(fileh)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def ls_remote(self, url, *_, **__):
+        """Return canned ls-remote output for the blktap repositories"""
+        if 'blktap.pg' in url:
+            return self.git_ls_remote_out['blktap'][1]
+        return self.git_ls_remote_out['blktap'][0]
+
+    @mock.patch('planex.git.ls_remote')
+    def test_generate_all(self, mock_git_ls_remote):
+        """Manifests are written for each spec, and not rewritten if
+           unchanged"""
+        mock_git_ls_remote.side_effect = self.ls_remote
+        argv = ['--all', '--output-dir', self.tmpdir,
+                '--pins-dir', os.path.join(self.tmpdir, 'PINS'),
+                'tests/data/manifest/blktap.spec',
+                'tests/data/manifest/blktap.lnk']
+
+        planex.cmd.manifest.main(argv)
+
+        path = os.path.join(self.tmpdir, 'blktap.json')
+        with open(path) as fileh:
+            manifest = json.load(fileh)
+        with open('tests/data/manifest/blktap.json') as fileh:
+            self.assertEqual(manifest, json.load(fileh))
+
+        os.utime(path, (0, 0))
+        planex.cmd.manifest.main(argv)
+        self.assertEqual(os.stat(path).st_mtime, 0)
+        self.assertEqual(mock_git_ls_remote.call_count, 2)
+
+    @mock.patch('planex.git.ls_remote')
+    def test_concurrent_order(self, mock_git_ls_remote):
+        """Concurrently resolved SHA1s are recorded in source order"""
+        mock_git_ls_remote.side_effect = self.ls_remote
+        spec = planex.spec.Spec('tests/data/manifest/blktap.spec')
+        link = planex.link.Link('tests/data/manifest/blktap.lnk')
+        urls = planex.cmd.manifest.manifest_urls(spec, link)
+        resolver = planex.cmd.manifest.SHA1Resolver(urls, jobs=4)
+
+        manifest = planex.cmd.manifest.generate_manifest(spec, link,
+                                                         resolver=resolver)
+        with open('tests/data/manifest/blktap.json') as fileh:
+            self.assertEqual(manifest, json.load(fileh))
+
+    @mock.patch('planex.git.ls_remote')
+    def test_timeout(self, mock_git_ls_remote):
+        """The timeout bounds each query of a remote repository"""
+        mock_git_ls_remote.side_effect = self.ls_remote
+        argv = ['--all', '--output-dir', self.tmpdir, '--timeout', '2.5',
+                '--pins-dir', os.path.join(self.tmpdir, 'PINS'),
+                'tests/data/manifest/blktap.spec',
+                'tests/data/manifest/blktap.lnk']
+        try:
+            planex.cmd.manifest.main(argv)
+        finally:
+            planex.refcache.configure()
+        for _, kwargs in mock_git_ls_remote.call_args_list:
+            self.assertEqual(kwargs, {'timeout': 2.5})
+
+    @mock.patch('planex.git.ls_remote')
+    def test_failed_package(self, mock_git_ls_remote):
+        """A package which cannot be resolved does not stop the others"""
+        def ls_remote(url, *_, **__):
+            """Fail for the patchqueue repository only"""
+            if 'blktap.pg' in url:
+                raise RuntimeError("fatal: repository not found")
+            return self.git_ls_remote_out['blktap'][0]
+        mock_git_ls_remote.side_effect = ls_remote
+        specdir = os.path.join(self.tmpdir, 'SPECS')
+        os.makedirs(specdir)
+        shutil.copy('tests/data/manifest/blktap.spec', specdir)
+        shutil.copy('tests/data/manifest/vhostmd.spec', specdir)
+        argv = ['--all', '--output-dir', self.tmpdir,
+                '--pins-dir', os.path.join(self.tmpdir, 'PINS'),
+                os.path.join(specdir, 'blktap.spec'),
+                os.path.join(specdir, 'vhostmd.spec'),
+                'tests/data/manifest/blktap.lnk']
+
+        with self.assertRaises(SystemExit) as exc:
+            planex.cmd.manifest.main(argv)
+        self.assertIn("blktap", str(exc.exception))
+        self.assertFalse(os.path.exists(
+            os.path.join(self.tmpdir, 'blktap.json')))
+        self.assertTrue(os.path.exists(
+            os.path.join(self.tmpdir, 'vhostmd.json')))
+
+    @mock.patch('planex.cmd.manifest.ThreadPool')
+    @mock.patch('planex.git.ls_remote')
+    def test_pool_size(self, mock_git_ls_remote, mock_pool):
+        """The pool has no more threads than there are URLs to resolve"""
+        mock_git_ls_remote.side_effect = self.ls_remote
+        url = "https://github.com/xapi-project/blktap/archive/master/x.tar.gz"
+        with planex.cmd.manifest.SHA1Resolver([url], jobs=8) as resolver:
+            resolver.sha1(url)
+        self.assertFalse(mock_pool.called)
+
+        with planex.cmd.manifest.SHA1Resolver([url, url + "2", url],
+                                              jobs=8):
+            pass
+        mock_pool.assert_called_once_with(2)
+        mock_pool.return_value.close.assert_called_once_with()
+        mock_pool.return_value.join.assert_called_once_with()
@@ -0,0 +1,90 @@
+"""Tests for the cache of bare mirrors of git remotes"""
+
+import os
+import shutil
+import subprocess
+import tempfile
+import unittest
+
+import planex.mirror
+
+
+def git(repo, *args):
+    """Run a git command in repo, returning its output"""
+    return subprocess.check_output(
+        ["git", "-C", repo, "-c", "user.name=Test",
+         "-c", "user.email=test@example.com"] + list(args))
+
+
+class MirrorCacheTests(unittest.TestCase):
+    """Creating, updating and removing mirrors"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+        self.remote = os.path.join(self.tmpdir, "remote")
+        subprocess.check_call(["git", "init", "--quiet", self.remote])
+        git(self.remote, "commit", "--quiet", "--allow-empty", "-m", "one")
+        self.cache = planex.mirror.MirrorCache(
+            os.path.join(self.tmpdir, "mirrors"))
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    def test_ls_remote_without_mirror(self):
+        """Refs are listed from the remote until a mirror exists"""
+        head = git(self.remote, "rev-parse", "HEAD").strip()
+        self.assertIn(head, self.cache.ls_remote(self.remote))
+        self.assertFalse(os.path.exists(self.cache.path(self.remote)))
+
+    def test_update_when_stale(self):
+        """Mirrors are fetched only once they are older than the TTL"""
+        mirror = self.cache.mirror(self.remote)
+        git(self.remote, "commit", "--quiet", "--allow-empty", "-m", "two")
+        head = git(self.remote, "rev-parse", "HEAD").strip()
+
+        self.assertNotIn(head, self.cache.ls_remote(self.remote))
+        self.cache.ttl = -1
+        self.assertEqual(self.cache.mirror(self.remote), mirror)
+        self.assertIn(head, self.cache.ls_remote(self.remote))
+
+    def test_checkout(self):
+        """Checkouts are made from the mirror but point at the remote"""
+        checkout = os.path.join(self.tmpdir, "checkout")
+        self.cache.checkout(self.remote, checkout)
+        self.assertEqual(
+            git(checkout, "config", "remote.origin.url").strip(),
+            self.remote)
+
+    def test_checkout_borrows(self):
+        """Checkouts borrow objects from a mirror which never prunes"""
+        checkout = os.path.join(self.tmpdir, "checkout")
+        self.cache.checkout(self.remote, checkout)
+        mirror = self.cache.path(self.remote)
+        self.assertTrue(os.path.exists(
+            os.path.join(checkout, ".git", "objects", "info", "alternates")))
+        self.assertEqual(
+            git(mirror, "config", "gc.pruneExpire").strip(), "never")
+
+    def test_checkout_dissociate(self):
+        """Dissociated checkouts do not borrow from the mirror"""
+        checkout = os.path.join(self.tmpdir, "checkout")
+        self.cache.checkout(self.remote, checkout, dissociate=True)
+        self.assertFalse(os.path.exists(
+            os.path.join(checkout, ".git", "objects", "info", "alternates")))
+
+    def test_gc(self):
+        """Only mirrors unused for longer than the maximum age are removed"""
+        mirror = self.cache.mirror(self.remote)
+        self.assertEqual(self.cache.gc(3600), [])
+        os.utime(os.path.join(mirror, planex.mirror.USED_STAMP), (0, 0))
+        self.assertEqual(self.cache.gc(3600), [mirror])
+        self.assertFalse(os.path.exists(mirror))
+
+    def test_gc_keeps_checkouts(self):
+        """Checkouts still work after their mirror has been removed"""
+        checkout = os.path.join(self.tmpdir, "checkout")
+        self.cache.checkout(self.remote, checkout)
+        self.assertEqual(self.cache.gc(-1), [self.cache.path(self.remote)])
+        self.assertFalse(os.path.exists(
+            os.path.join(checkout, ".git", "objects", "info", "alternates")))
+        git(checkout, "fsck", "--full")
@@ -0,0 +1,107 @@
+"""Tests for the mock wrapper's configuration handling"""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import planex.cmd.mock
+
+
+MOCK_CONFIG = """config_opts['root'] = 'test'
+config_opts['yum.conf'] = \"\"\"
+[main]
+cachedir=/var/cache/yum
+\"\"\"
+"""
+
+
+class ConfigCacheTests(unittest.TestCase):
+    """Mock configuration materialisation and caching"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.configdir = os.path.join(self.test_dir, "etc-mock")
+        self.cachedir = os.path.join(self.test_dir, "cache")
+        os.makedirs(self.configdir)
+        for name in ["site-defaults.cfg", "logging.ini", "other.cfg"]:
+            with open(os.path.join(self.configdir, name), "w") as cfg:
+                cfg.write("# %s\n" % name)
+        with open(os.path.join(self.configdir, "default.cfg"), "w") as cfg:
+            cfg.write(MOCK_CONFIG)
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_other_files_are_symlinked(self):
+        """Only the root configuration is rewritten"""
+        config = planex.cmd.mock.cached_mock_config(
+            self.cachedir, self.configdir, "default", "/repo", [])
+
+        for name in ["site-defaults.cfg", "logging.ini", "other.cfg"]:
+            self.assertTrue(os.path.islink(os.path.join(config, name)))
+        root_config = os.path.join(config, "default.cfg")
+        self.assertFalse(os.path.islink(root_config))
+        with open(root_config) as cfg:
+            contents = cfg.read()
+        self.assertIn("[mock-loopback]\n", contents)
+        self.assertIn("baseurl = file:///repo\n", contents)
+
+    def test_mtime_preserved(self):
+        """The rewritten configuration keeps the original mtime"""
+        config = planex.cmd.mock.cached_mock_config(
+            self.cachedir, self.configdir, "default", "/repo", [])
+        # Python 2's os.utime only keeps microseconds
+        self.assertAlmostEqual(
+            os.stat(os.path.join(config, "default.cfg")).st_mtime,
+            os.stat(os.path.join(self.configdir, "default.cfg")).st_mtime,
+            places=5)
+
+    def test_unchanged_inputs_reuse_entry(self):
+        """Identical inputs produce the same cache entry"""
+        first = planex.cmd.mock.cached_mock_config(
+            self.cachedir, self.configdir, "default", "/repo", ["cost=1"])
+        second = planex.cmd.mock.cached_mock_config(
+            self.cachedir, self.configdir, "default", "/repo", ["cost=1"])
+        self.assertEqual(first, second)
+        self.assertEqual(len(os.listdir(self.cachedir)), 1)
+
+    def test_changed_inputs_new_entry(self):
+        """Changing the extra loopback lines produces a new entry"""
+        first = planex.cmd.mock.cached_mock_config(
+            self.cachedir, self.configdir, "default", "/repo", [])
+        second = planex.cmd.mock.cached_mock_config(
+            self.cachedir, self.configdir, "default", "/repo", ["cost=1"])
+        self.assertNotEqual(first, second)
+
+    def test_rendered_per_build(self):
+        """Each build's loopback repository is filled into the template"""
+        template = planex.cmd.mock.cached_mock_config(
+            self.cachedir, self.configdir, "default",
+            planex.cmd.mock.LOOPBACK_PLACEHOLDER, [])
+        config = planex.cmd.mock.render_mock_config(
+            template, "default", "/tmp/build/loopback",
+            os.path.join(self.test_dir, "build"))
+
+        self.assertTrue(os.path.islink(os.path.join(config, "other.cfg")))
+        with open(os.path.join(config, "default.cfg")) as cfg:
+            self.assertIn("baseurl = file:///tmp/build/loopback\n",
+                          cfg.read())
+        self.assertAlmostEqual(
+            os.stat(os.path.join(config, "default.cfg")).st_mtime,
+            os.stat(os.path.join(self.configdir, "default.cfg")).st_mtime,
+            places=5)
+
+
+class JobLabelTests(unittest.TestCase):
+    """Labels for concurrent builds"""
+
+    def test_distinct_labels(self):
+        """SRPMs with the same name get distinct labels"""
+        labels = planex.cmd.mock.job_labels(
+            ["a/foo-1.0-1.src.rpm", "b/bar-1.0-1.src.rpm",
+             "c/foo-1.0-1.src.rpm", "a/foo-1.0-1.src.rpm"])
+        self.assertEqual(labels.items(),
+                         [("a/foo-1.0-1.src.rpm", "foo-1.0-1"),
+                          ("b/bar-1.0-1.src.rpm", "bar-1.0-1"),
+                          ("c/foo-1.0-1.src.rpm", "foo-1.0-1-2")])
@@ -1,14 +1,19 @@
 """Test patchqueue handling"""
 
+import os
 import shutil
+import subprocess
 import tempfile
 import unittest
 
 from hypothesis import given
+import mock
 from nose.plugins.attrib import attr
 
 import tests.strategies as tst
 
+import planex.cmd.patchqueue
+import planex.git
 import planex.patchqueue
 from planex.spec import Spec
 
@@ -149,3 +154,108 @@ class PatchqueueGuardTests(unittest.TestCase):
                         if p.has_positive_guards() and
                         tst.Guard('+', guard) not in p.guards]
         self.assertTrue(all([p not in applied for p in not_expected]))
+
+
+class PatchqueueCacheTests(unittest.TestCase):
+    """Incremental regeneration of cached patchqueues"""
+
+    class FakeLink(object):
+        """Stand-in for the Link of a pinned package"""
+        # pylint: disable=R0903
+        patchqueue = "master"
+        sources = None
+        patches = None
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.repo = os.path.join(self.test_dir, "repo")
+        self.cachedir = os.path.join(self.test_dir, "cache")
+        subprocess.check_call(["git", "init", "--quiet", self.repo])
+        self.start = self.commit("base")
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def commit(self, message):
+        """Commit a change to the repository, returning its SHA1"""
+        with open(os.path.join(self.repo, "file"), "a") as fileh:
+            fileh.write(message + "\n")
+        subprocess.check_call(["git", "-C", self.repo, "add", "file"])
+        subprocess.check_call(
+            ["git", "-C", self.repo, "-c", "user.name=Test",
+             "-c", "user.email=test@example.com", "commit", "--quiet",
+             "--message", message])
+        return planex.git.rev_parse(self.repo, "HEAD")
+
+    def update(self, end):
+        """Update the cached patchqueue, returning its series"""
+        planex.cmd.patchqueue.update_cached_patchqueue(
+            self.cachedir, self.FakeLink, self.repo, self.start, end)
+        with open(os.path.join(self.cachedir, "tree", "master",
+                               "series")) as series:
+            return series.read().split()
+
+    def test_incremental(self):
+        """Only commits added since the last run are formatted"""
+        self.commit("first")
+        self.assertEqual(self.update(self.commit("second")),
+                         ["0001-first.patch", "0002-second.patch"])
+
+        end = self.commit("third")
+        with mock.patch('planex.git.format_patch',
+                        wraps=planex.git.format_patch) as format_patch:
+            self.assertEqual(self.update(end),
+                             ["0001-first.patch", "0002-second.patch",
+                              "0003-third.patch"])
+            self.assertEqual(format_patch.call_count, 1)
+            self.assertEqual(format_patch.call_args[1]["start_number"], 3)
+
+            self.update(end)
+            self.assertEqual(format_patch.call_count, 1)
+
+    def test_same_as_full(self):
+        """Appended patches are identical to those of a full run"""
+        self.commit("first")
+        self.update(self.commit("second"))
+        end = self.commit("third")
+        self.update(end)
+        patchqueue = os.path.join(self.cachedir, "tree", "master")
+        appended = {}
+        for name in os.listdir(patchqueue):
+            with open(os.path.join(patchqueue, name)) as patch:
+                appended[name] = patch.read()
+
+        shutil.rmtree(self.cachedir)
+        self.update(end)
+        for name in os.listdir(patchqueue):
+            with open(os.path.join(patchqueue, name)) as patch:
+                self.assertEqual(patch.read(), appended[name])
+        self.assertItemsEqual(os.listdir(patchqueue), appended.keys())
+
+    def test_interrupted_update(self):
+        """The series is rebuilt from the state after an interruption"""
+        self.commit("first")
+        end = self.commit("second")
+        self.update(end)
+        with open(os.path.join(self.cachedir, "tree", "master",
+                               "series"), "a") as series:
+            series.write("0002-second.patch\n")
+        self.assertEqual(self.update(end),
+                         ["0001-first.patch", "0002-second.patch"])
+
+    def test_different_start(self):
+        """Patches are not appended to a series with a different start"""
+        first = self.commit("first")
+        self.update(self.commit("second"))
+        self.start = first
+        self.assertEqual(self.update(self.commit("third")),
+                         ["0001-second.patch", "0002-third.patch"])
+
+    def test_rewritten_history(self):
+        """The whole range is formatted again if history is rewritten"""
+        self.commit("first")
+        self.update(self.commit("second"))
+        subprocess.check_call(["git", "-C", self.repo, "reset", "--quiet",
+                               "--hard", self.start])
+        self.assertEqual(self.update(self.commit("other")),
+                         ["0001-other.patch"])
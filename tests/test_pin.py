@@ -0,0 +1,97 @@
+"""Tests for pin file generation"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import planex.cmd.pin
+
+
+class PinTests(unittest.TestCase):
+    """Pin content and pin file writing"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('planex.cmd.pin.repository_of')
+    def test_explicit_url_is_lazy(self, mock_repository_of):
+        """Repositories are not queried for values given explicitly"""
+        args = argparse.Namespace(url="repos/foo", commitish="master",
+                                  base=None, base_commitish=None)
+        pin = planex.cmd.pin.get_pin_content(args, "master", mock.Mock(),
+                                             None)
+        self.assertEqual(pin, {"URL": "repos/foo", "commitish": "master",
+                               "patchqueue": "master"})
+        self.assertFalse(mock_repository_of.called)
+
+    def test_write_pins(self):
+        """Only changed pin files are rewritten"""
+        pins = {"foo": {"URL": "repos/foo", "commitish": "master"},
+                "bar": {"URL": "repos/bar", "commitish": "v1.0"}}
+        self.assertEqual(planex.cmd.pin.write_pins(pins, self.tmpdir),
+                         ["bar", "foo"])
+
+        pins["bar"]["commitish"] = "v1.1"
+        self.assertEqual(planex.cmd.pin.write_pins(pins, self.tmpdir),
+                         ["bar"])
+        with open(os.path.join(self.tmpdir, "bar.pin")) as pinfile:
+            self.assertEqual(json.load(pinfile), pins["bar"])
+        self.assertItemsEqual(os.listdir(self.tmpdir),
+                              ["foo.pin", "bar.pin"])
+
+    def test_expand_packages(self):
+        """Globs are matched against the spec files"""
+        os.mkdir(os.path.join(self.tmpdir, "SPECS"))
+        for name in ["ocaml-re", "ocaml-uri", "xen"]:
+            open(os.path.join(self.tmpdir, "SPECS", name + ".spec"),
+                 "w").close()
+        self.assertEqual(
+            planex.cmd.pin.expand_packages(self.tmpdir, ["ocaml-*", "xen"]),
+            ["ocaml-re", "ocaml-uri", "xen"])
+
+    def test_expand_missing_package(self):
+        """Package names without a spec file are rejected"""
+        os.mkdir(os.path.join(self.tmpdir, "SPECS"))
+        open(os.path.join(self.tmpdir, "SPECS", "xen.spec"), "w").close()
+        with self.assertRaises(SystemExit):
+            planex.cmd.pin.expand_packages(self.tmpdir, ["xen", "nosuch"])
+
+    @mock.patch('planex.cmd.pin.get_pin_content')
+    @mock.patch('planex.cmd.pin.spec_and_lnk')
+    def test_pin_many_missing_package(self, mock_spec_and_lnk,
+                                      mock_get_pin_content):
+        """A missing package exits before any repository is queried"""
+        os.mkdir(os.path.join(self.tmpdir, "SPECS"))
+        args = argparse.Namespace(packages=["nosuch"], jobs=4,
+                                  output_dir=self.tmpdir)
+        with self.assertRaises(SystemExit):
+            planex.cmd.pin.pin_many(args, self.tmpdir)
+        self.assertFalse(mock_spec_and_lnk.called)
+        self.assertFalse(mock_get_pin_content.called)
+
+    @mock.patch('planex.cmd.pin.get_pin_content')
+    @mock.patch('planex.cmd.pin.spec_and_lnk')
+    def test_pin_many_worker_error(self, mock_spec_and_lnk,
+                                   mock_get_pin_content):
+        """Errors raised while querying repositories exit cleanly"""
+        os.mkdir(os.path.join(self.tmpdir, "SPECS"))
+        for name in ["ocaml-re", "xen"]:
+            open(os.path.join(self.tmpdir, "SPECS", name + ".spec"),
+                 "w").close()
+        mock_spec_and_lnk.return_value = (mock.Mock(), None)
+        mock_get_pin_content.side_effect = ValueError("no such remote")
+        args = argparse.Namespace(packages=["*"], jobs=4,
+                                  patchqueue="master",
+                                  output_dir=self.tmpdir)
+        with self.assertRaises(SystemExit) as ctx:
+            planex.cmd.pin.pin_many(args, self.tmpdir)
+        self.assertIn("no such remote", str(ctx.exception))
+        self.assertEqual(os.listdir(self.tmpdir), ["SPECS"])
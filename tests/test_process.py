@@ -0,0 +1,106 @@
+"""Tests for running commands through a pty"""
+
+import os
+import shutil
+import signal
+import subprocess
+import tempfile
+import unittest
+from StringIO import StringIO
+
+import mock
+
+import planex.process
+
+
+class PtyProcessTests(unittest.TestCase):
+    """Tests for the multiplexing process runner"""
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.output = StringIO()
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_isatty(self):
+        """Child output is connected to a terminal"""
+        planex.process.run_multiplexed(
+            [("tty", ["sh", "-c", "test -t 1 && echo yes"])],
+            output=self.output)
+        self.assertIn("yes", self.output.getvalue())
+
+    def test_exit_status(self):
+        """Each job's own exit status is returned"""
+        results = planex.process.run_multiplexed(
+            [("ok", ["true"]), ("fail", ["sh", "-c", "exit 3"])],
+            max_jobs=2, output=self.output)
+        self.assertEqual(results, {"ok": 0, "fail": 3})
+
+    def test_check_call_raises(self):
+        """check_call raises an exception on failure"""
+        with self.assertRaises(subprocess.CalledProcessError) as ctx:
+            planex.process.check_call(["sh", "-c", "exit 2"])
+        self.assertEqual(ctx.exception.returncode, 2)
+
+    def test_prefixed_output(self):
+        """Multiplexed output lines are labelled with the job name"""
+        planex.process.run_multiplexed(
+            [("first", ["echo", "hello"]), ("second", ["echo", "world"])],
+            max_jobs=2, output=self.output)
+        lines = self.output.getvalue().splitlines()
+        self.assertIn("[first] hello", lines)
+        self.assertIn("[second] world", lines)
+
+    def test_logfiles(self):
+        """Output is written to a log file per job"""
+        planex.process.run_multiplexed(
+            [("first", ["echo", "hello"]), ("second", ["echo", "world"])],
+            max_jobs=2, output=self.output, logdir=self.test_dir)
+        with open(os.path.join(self.test_dir, "first.log")) as log:
+            self.assertEqual(log.read(), "hello\r\n")
+        with open(os.path.join(self.test_dir, "second.log")) as log:
+            self.assertEqual(log.read(), "world\r\n")
+
+    def test_bounded_tail(self):
+        """Only the last lines of output are kept in memory"""
+        proc = planex.process.PtyProcess(["seq", "1", "100"], tail_lines=5)
+        while proc.read()[0]:
+            pass
+        self.assertEqual(proc.close(), 0)
+        self.assertEqual([line.strip() for line in proc.tail],
+                         ["96", "97", "98", "99", "100"])
+
+    def test_exception_kills_children(self):
+        """Running jobs are killed if an exception escapes"""
+        procs = []
+        real_process = planex.process.PtyProcess
+
+        def record(*args):
+            """Keep each process so its exit status can be checked"""
+            proc = real_process(*args)
+            procs.append(proc)
+            return proc
+
+        class BrokenOutput(object):
+            """Output which cannot be written"""
+            # pylint: disable=no-self-use
+            def writelines(self, _lines):
+                """Fail to write"""
+                raise IOError("broken output")
+
+        with mock.patch("planex.process.PtyProcess", side_effect=record):
+            with self.assertRaises(IOError):
+                planex.process.run_multiplexed(
+                    [("sleep", ["sleep", "30"]), ("echo", ["echo", "hello"])],
+                    max_jobs=2, output=BrokenOutput())
+        self.assertEqual(procs[0].proc.returncode, -signal.SIGKILL)
+
+    def test_failed_start_closes_log(self):
+        """The log file is closed if the command cannot be started"""
+        logfile = os.path.join(self.test_dir, "missing.log")
+        with mock.patch("planex.process.open", create=True) as mock_open:
+            with self.assertRaises(OSError):
+                planex.process.PtyProcess(["/nonexistent/command"],
+                                          logfile=logfile)
+        mock_open.return_value.close.assert_called_once_with()
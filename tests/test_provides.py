@@ -0,0 +1,87 @@
+"""Tests for the provides index"""
+
+import fnmatch
+import unittest
+
+import mock
+import rpm
+
+from planex.provides import ProvidesIndex, split_evr
+
+
+class ProvidesIndexTests(unittest.TestCase):
+    """Resolving requirements against indexed provides"""
+
+    def setUp(self):
+        self.index = ProvidesIndex()
+        self.index.add("ocaml", rpm.RPMSENSE_EQUAL, "4.02.3-1", "ocaml.rpm")
+        self.index.add("pkgconfig(libfoo)", rpm.RPMSENSE_EQUAL, "1:2.0",
+                       "libfoo.rpm")
+        self.index.add("libbar(x86-64)", 0, "", "libbar.rpm")
+        self.index.add_file("/usr/bin/foo", "foo.rpm")
+        self.index.add_file("/usr/lib64/ocaml/uri/*", "uri.rpm")
+
+    def test_split_evr(self):
+        """Epoch defaults to 0 and release to None"""
+        self.assertEqual(split_evr("1.2"), ("0", "1.2", None))
+        self.assertEqual(split_evr("2:1.2-3.el7"), ("2", "1.2", "3.el7"))
+
+    def test_unversioned(self):
+        """Unversioned requirements match any provided version"""
+        self.assertEqual(self.index.resolve("ocaml"), "ocaml.rpm")
+        self.assertEqual(self.index["pkgconfig(libfoo)"], "libfoo.rpm")
+        self.assertNotIn("ocaml-findlib", self.index)
+
+    def test_versioned(self):
+        """Versioned requirements are compared as RPM compares them"""
+        greater_equal = rpm.RPMSENSE_GREATER | rpm.RPMSENSE_EQUAL
+        self.assertEqual(self.index.resolve("ocaml", greater_equal, "4.00"),
+                         "ocaml.rpm")
+        self.assertEqual(self.index.resolve("ocaml", rpm.RPMSENSE_EQUAL,
+                                            "4.02.3"),
+                         "ocaml.rpm")
+        self.assertIsNone(self.index.resolve("ocaml", greater_equal, "4.10"))
+        self.assertIsNone(self.index.resolve("ocaml", rpm.RPMSENSE_LESS,
+                                             "4.02"))
+
+    def test_epoch(self):
+        """Provides with a higher epoch satisfy higher versions"""
+        greater_equal = rpm.RPMSENSE_GREATER | rpm.RPMSENSE_EQUAL
+        self.assertEqual(self.index.resolve("pkgconfig(libfoo)",
+                                            greater_equal, "3.0"),
+                         "libfoo.rpm")
+        self.assertIsNone(self.index.resolve("pkgconfig(libfoo)",
+                                             greater_equal, "2:1.0"))
+
+    def test_arch_suffix(self):
+        """Requirements match with or without an architecture suffix"""
+        self.assertEqual(self.index.resolve("libbar"), "libbar.rpm")
+        self.assertEqual(self.index.resolve("libbar(x86-64)"), "libbar.rpm")
+
+    def test_files(self):
+        """File requirements resolve to the package listing the file"""
+        self.assertEqual(self.index.resolve("/usr/bin/foo"), "foo.rpm")
+        self.assertEqual(self.index.resolve("/usr/lib64/ocaml/uri/uri.cma"),
+                         "uri.rpm")
+        self.assertIsNone(self.index.resolve("/usr/bin/bar"))
+
+    def test_directory_contents(self):
+        """Directories listed without %dir own everything beneath them"""
+        self.index.add_file("/usr/share/foo", "foo-data.rpm")
+        self.index.add_file("/usr/share/bar", "bar.rpm", contents=False)
+        self.assertEqual(self.index.resolve("/usr/share/foo/a/b.txt"),
+                         "foo-data.rpm")
+        self.assertEqual(self.index.resolve("/usr/share/bar"), "bar.rpm")
+        self.assertIsNone(self.index.resolve("/usr/share/bar/b.txt"))
+        self.assertIsNone(self.index.resolve("/usr/share/foobar"))
+
+    def test_pattern_prefix(self):
+        """Only the patterns of a file's parent directories are matched"""
+        self.index.add_file("/usr/lib64/ocaml/re/re*.cm?", "re.rpm")
+        self.assertEqual(sorted(self.index.file_patterns),
+                         ["/usr/lib64/ocaml/re", "/usr/lib64/ocaml/uri"])
+        with mock.patch('fnmatch.fnmatch', wraps=fnmatch.fnmatch) as match:
+            self.assertEqual(
+                self.index.resolve("/usr/lib64/ocaml/re/re_emacs.cmi"),
+                "re.rpm")
+            self.assertEqual(match.call_count, 1)
@@ -0,0 +1,140 @@
+"""Tests for the cache of remote git refs"""
+
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+import mock
+
+import planex.refcache
+
+
+LS_REMOTE_OUT = (
+    "ac9032660c02be11afdb7cc8ad23be2f1aa9b7ce\tHEAD\n"
+    "ac9032660c02be11afdb7cc8ad23be2f1aa9b7ce\trefs/heads/master\n"
+    "db8d9edd203460adba4b9175971c2cfc14ac0f64\trefs/tags/v3.3.0\n"
+    "ddb48b561342d7742ec1dbd6c4987c1f4add9387\trefs/tags/v3.3.0^{}\n"
+    "15ab3b9221b5dbf0831edac6ecb64659d8c66786\trefs/tags/v3.2.0\n"
+)
+URL = "git://example.com/blktap.git"
+
+
+class RefCacheTests(unittest.TestCase):
+    """Ref lookups are served from a single listing per remote"""
+
+    def setUp(self):
+        self.tmpdir = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('planex.git.ls_remote')
+    def test_single_query(self, mock_git_ls_remote):
+        """Each remote is listed only once"""
+        mock_git_ls_remote.return_value = LS_REMOTE_OUT
+        cache = planex.refcache.RefCache()
+
+        self.assertTrue(cache.is_tag(URL, "v3.3.0"))
+        self.assertFalse(cache.is_tag(URL, "master"))
+        self.assertEqual(cache.branch_sha1(URL, "master"),
+                         "ac9032660c02be11afdb7cc8ad23be2f1aa9b7ce")
+        mock_git_ls_remote.assert_called_once_with(URL, timeout=None)
+
+    @mock.patch('planex.git.ls_remote')
+    def test_tag_sha1(self, mock_git_ls_remote):
+        """Annotated tags resolve to the commit, not the tag object"""
+        mock_git_ls_remote.return_value = LS_REMOTE_OUT
+        cache = planex.refcache.RefCache()
+
+        self.assertEqual(cache.tag_sha1(URL, "v3.3.0"),
+                         "ddb48b561342d7742ec1dbd6c4987c1f4add9387")
+        self.assertEqual(cache.tag_sha1(URL, "v3.2.0"),
+                         "15ab3b9221b5dbf0831edac6ecb64659d8c66786")
+        self.assertEqual(cache.tag_sha1(URL, "v9.9.9"), "")
+
+    @mock.patch('planex.git.ls_remote')
+    def test_disk_cache(self, mock_git_ls_remote):
+        """Listings are shared between caches through the disk"""
+        mock_git_ls_remote.return_value = LS_REMOTE_OUT
+        planex.refcache.RefCache(self.tmpdir).refs(URL)
+        planex.refcache.RefCache(self.tmpdir).refs(URL)
+        self.assertEqual(mock_git_ls_remote.call_count, 1)
+
+    @mock.patch('planex.git.ls_remote')
+    def test_disk_cache_expiry(self, mock_git_ls_remote):
+        """Listings older than the TTL are fetched again"""
+        mock_git_ls_remote.return_value = LS_REMOTE_OUT
+        planex.refcache.RefCache(self.tmpdir).refs(URL)
+
+        for name in os.listdir(self.tmpdir):
+            path = os.path.join(self.tmpdir, name)
+            with open(path) as cachefile:
+                entry = json.load(cachefile)
+            entry["time"] -= 1000
+            with open(path, "w") as cachefile:
+                json.dump(entry, cachefile)
+
+        planex.refcache.RefCache(self.tmpdir, ttl=300).refs(URL)
+        self.assertEqual(mock_git_ls_remote.call_count, 2)
+
+
+class LockFileTests(unittest.TestCase):
+    """Lookups recorded in a lock file are reproduced without the network"""
+
+    def setUp(self):
+        planex.refcache.clear()
+        self.tmpdir = tempfile.mkdtemp()
+        self.lock_path = os.path.join(self.tmpdir, "refs.lock")
+
+    def tearDown(self):
+        planex.refcache.configure()
+        planex.refcache.clear()
+        shutil.rmtree(self.tmpdir)
+
+    @mock.patch('planex.git.ls_remote')
+    def test_frozen(self, mock_git_ls_remote):
+        """A frozen cache answers recorded lookups from the lock file"""
+        mock_git_ls_remote.return_value = LS_REMOTE_OUT
+        cache = planex.refcache.REF_CACHE
+        self.assertEqual(cache.tag_sha1(URL, "v3.3.0"),
+                         "ddb48b561342d7742ec1dbd6c4987c1f4add9387")
+        self.assertFalse(cache.is_tag(URL, "master"))
+        planex.refcache.write_lock(self.lock_path)
+
+        with open(self.lock_path) as lock_file:
+            lock = json.load(lock_file)
+        self.assertNotIn("refs/tags/v3.2.0", lock["refs"][URL])
+        self.assertIsNone(lock["refs"][URL]["refs/tags/master"])
+
+        planex.refcache.clear()
+        planex.refcache.freeze(self.lock_path)
+        mock_git_ls_remote.side_effect = AssertionError("network used")
+        self.assertEqual(cache.tag_sha1(URL, "v3.3.0"),
+                         "ddb48b561342d7742ec1dbd6c4987c1f4add9387")
+        self.assertFalse(cache.is_tag(URL, "master"))
+
+    @mock.patch('planex.git.ls_remote')
+    def test_frozen_unrecorded_ref(self, mock_git_ls_remote):
+        """Refs which were never looked up are errors, not absent"""
+        mock_git_ls_remote.return_value = LS_REMOTE_OUT
+        cache = planex.refcache.REF_CACHE
+        self.assertTrue(cache.is_tag(URL, "v3.3.0"))
+        planex.refcache.write_lock(self.lock_path)
+
+        planex.refcache.clear()
+        planex.refcache.freeze(self.lock_path)
+        self.assertTrue(cache.is_tag(URL, "v3.3.0"))
+        with self.assertRaises(planex.refcache.FrozenError):
+            cache.is_tag(URL, "v3.2.0")
+
+    @mock.patch('planex.git.ls_remote')
+    def test_frozen_missing(self, mock_git_ls_remote):
+        """Remotes which are not in the lock file are errors"""
+        with open(self.lock_path, "w") as lock_file:
+            json.dump({"refs": {}, "commits": {}}, lock_file)
+        planex.refcache.freeze(self.lock_path)
+        with self.assertRaises(planex.refcache.FrozenError):
+            planex.refcache.REF_CACHE.branch_sha1(URL, "master")
+        self.assertFalse(mock_git_ls_remote.called)
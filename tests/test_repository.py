@@ -1,20 +1,27 @@
 """Tests for repository URL parsers"""
 
 import json
+import os
+import shutil
+import tempfile
 import unittest
 import mock
+import requests
 
+import planex.refcache
 import planex.repository
+from tests.httpstub import StubHTTPServer
 
 
 class BasicTests(unittest.TestCase):
     """Basic BitBucket URL parser tests"""
 
     def setUp(self):
+        planex.refcache.clear()
         with open("tests/data/bitbucket-repo.json") as fileh:
             self.data = json.load(fileh)
 
-    @mock.patch('planex.repository.requests.get')
+    @mock.patch.object(planex.refcache.COMMIT_CACHE.session, 'get')
     @mock.patch('planex.git.ls_remote')
     def test_urls(self, mock_git_ls_remote, mock_requests_get):
         """Well-formed BitBucket URLs are parsed correctly"""
@@ -31,10 +38,70 @@ class BasicTests(unittest.TestCase):
             self.assertEqual(repo.sha1, tcase['sha1'])
 
 
+class BitBucketAPITests(unittest.TestCase):
+    """Resolution of BitBucket commitishes through the REST API"""
+
+    URL = ("https://code.citrite.net/rest/archive/latest/projects/XS/repos/"
+           "linux-4.x.pg/archive?at=%s&format=tar#/kernel.patches.tar")
+    API_PATH = "/rest/api/1.0/projects/XS/repos/linux-4.x.pg/commits/%s"
+    SHA1 = "b17a2301da054897d134bd20b66a0c70ed5bc5a5"
+
+    def setUp(self):
+        planex.refcache.clear()
+        self.tmpdir = tempfile.mkdtemp()
+        planex.refcache.configure(self.tmpdir)
+
+    def tearDown(self):
+        planex.refcache.configure()
+        planex.refcache.clear()
+        shutil.rmtree(self.tmpdir)
+
+    def resolve(self, server, commitish):
+        """Resolve commitish on the stub server, with an empty memory cache"""
+        planex.refcache.clear()
+        with mock.patch.object(planex.repository.Repository, 'bitbucket_api',
+                               server.url):
+            return planex.repository.Repository(self.URL % commitish).sha1
+
+    def test_full_sha1_cached(self):
+        """Full SHA1s are fetched once and then served from disk"""
+        responses = {self.API_PATH % self.SHA1: json.dumps({"id": self.SHA1})}
+        with StubHTTPServer(responses) as server:
+            self.assertEqual(self.resolve(server, self.SHA1), self.SHA1)
+            self.assertEqual(self.resolve(server, self.SHA1), self.SHA1)
+            self.assertEqual(len(server.requests), 1)
+
+    def test_abbreviated_sha1_expires(self):
+        """Abbreviated SHA1s are fetched again once their entry expires"""
+        responses = {self.API_PATH % "b17a230": json.dumps({"id": self.SHA1})}
+        with StubHTTPServer(responses) as server:
+            self.assertEqual(self.resolve(server, "b17a230"), self.SHA1)
+            self.assertEqual(self.resolve(server, "b17a230"), self.SHA1)
+            self.assertEqual(len(server.requests), 1)
+
+            for name in os.listdir(self.tmpdir):
+                path = os.path.join(self.tmpdir, name)
+                with open(path) as cachefile:
+                    entry = json.load(cachefile)
+                entry["time"] -= 1000
+                with open(path, "w") as cachefile:
+                    json.dump(entry, cachefile)
+
+            self.assertEqual(self.resolve(server, "b17a230"), self.SHA1)
+            self.assertEqual(len(server.requests), 2)
+
+    def test_unknown_commitish(self):
+        """Commitishes the server does not know about are errors"""
+        with StubHTTPServer() as server:
+            with self.assertRaises(requests.HTTPError):
+                self.resolve(server, "deadbeef")
+
+
 class GitHubTests(unittest.TestCase):
     """Basic GitHub URL parser tests"""
 
     def setUp(self):
+        planex.refcache.clear()
         with open("tests/data/github-repo.json") as fileh:
             self.data = json.load(fileh)
 
@@ -54,6 +121,7 @@ class GitWebTests(unittest.TestCase):
     """Basic GitWeb URL parser tests"""
 
     def setUp(self):
+        planex.refcache.clear()
         with open("tests/data/gitweb-repo.json") as fileh:
             self.data = json.load(fileh)
 
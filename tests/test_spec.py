@@ -1,7 +1,15 @@
 """Tests for Spec class"""
 
+import glob
+import os
+import shutil
+import tempfile
 import unittest
 import platform
+
+import mock
+import rpm
+
 import planex.spec
 
 
@@ -31,6 +39,16 @@ class RpmTests(unittest.TestCase):
         """Package name is correct"""
         self.assertEqual(self.spec.name(), "ocaml-cohttp")
 
+    def test_files_on_request(self):
+        """The %files sections are only read when asked for"""
+        self.assertIsNone(self.spec.summary.file_provides)
+        spec = planex.spec.Spec("tests/data/ocaml-cohttp.spec",
+                                defines=[("dist", ".el6")], with_files=True)
+        self.assertEqual(len(spec.file_provides()), 1)
+        self.assertTrue(
+            spec.file_provides()[0].endswith("/ocaml/cohttp/*"))
+        self.assertEqual(spec.dir_provides(), [])
+
     def test_specpath(self):
         """Path to spec file on disk is correct"""
         self.assertEqual(self.spec.specpath(), "tests/data/ocaml-cohttp.spec")
@@ -127,3 +145,144 @@ class RpmTests(unittest.TestCase):
             ["cohttp0.patch",
              "cohttp1.patch"]
         )
+
+    def test_summary_immutable(self):
+        """The spec summary cannot be modified"""
+        with self.assertRaises(AttributeError):
+            self.spec.summary.name = "other"
+
+    def test_summary_memoised(self):
+        """Accessors do not call librpm after the spec has been parsed"""
+        with mock.patch("rpm.expandMacro") as expand_macro:
+            self.spec.sources()
+            self.spec.binary_package_paths()
+            self.spec.source_package_path()
+            self.spec.provides()
+            self.assertFalse(expand_macro.called)
+
+
+class MacroTests(unittest.TestCase):
+    """Isolation of librpm's macro table"""
+
+    def test_defines_do_not_leak(self):
+        """One spec's defines are not visible when parsing another"""
+        first = planex.spec.Spec("tests/data/ocaml-uri.spec",
+                                 defines=[("_topdir", "first"),
+                                          ("planex_test", "first")])
+        second = planex.spec.Spec("tests/data/ocaml-cstruct.spec")
+        self.assertEqual(first.expand_macro("%{?planex_test}"), "first")
+        self.assertEqual(second.expand_macro("%{?planex_test}"), "")
+        self.assertTrue(first.source_package_path().startswith("first/"))
+        self.assertFalse(second.source_package_path().startswith("first/"))
+
+    def test_spec_macros_do_not_leak(self):
+        """Macros which one spec %globals are not visible to the next"""
+        tmpdir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(tmpdir, "planex-global.spec")
+            with open(path, "w") as spec:
+                spec.write("%global planex_global leaked\n"
+                           "Name: planex-global\n"
+                           "Version: 1.0\n"
+                           "Release: 1\n"
+                           "Summary: Test\n"
+                           "License: GPL\n"
+                           "%description\n"
+                           "Test\n")
+            first = planex.spec.Spec(path)
+            second = planex.spec.Spec("tests/data/ocaml-uri.spec")
+        finally:
+            shutil.rmtree(tmpdir)
+        self.assertEqual(first.name(), "planex-global")
+        self.assertEqual(second.expand_macro("%{?planex_global}"), "")
+        self.assertEqual(rpm.expandMacro("%{?planex_global}"), "")
+
+    def test_macros_removed_on_exception(self):
+        """Macros are removed even if the body raises an exception"""
+        with self.assertRaises(RuntimeError):
+            with planex.spec.rpm_macros({"planex_test": "value"}):
+                raise RuntimeError()
+        self.assertEqual(rpm.expandMacro("%{?planex_test}"), "")
+
+    def test_parse_concurrently(self):
+        """Specs parsed in a thread pool match those parsed serially"""
+        paths = sorted(glob.glob("tests/data/ocaml-*.spec")) * 4
+        defines = [("dist", ".el6"), ("_topdir", "_build")]
+        serial = planex.spec.parse_specs(paths, defines=defines)
+        concurrent = planex.spec.parse_specs(paths, jobs=8, defines=defines)
+        self.assertEqual(
+            [(spec.name(), spec.binary_package_paths(), spec.sources())
+             for spec in concurrent],
+            [(spec.name(), spec.binary_package_paths(), spec.sources())
+             for spec in serial])
+
+
+class ScanTests(unittest.TestCase):
+    """The pure-Python spec scanner agrees with librpm"""
+
+    def test_scan_matches_librpm(self):
+        """Scanned metadata matches librpm's for every test spec"""
+        paths = (glob.glob("tests/data/*.spec") +
+                 glob.glob("tests/data/*/*.spec") +
+                 glob.glob("tests/specs/SPECS/*.spec"))
+        self.assertTrue(paths)
+        for path in paths:
+            scanned = planex.spec.scan_spec(path, check_package_name=False,
+                                            defines=[("dist", ".el6")])
+            spec = planex.spec.Spec(path, check_package_name=False,
+                                    defines=[("dist", ".el6")])
+            self.assertEqual(scanned.name, spec.name(), path)
+            self.assertEqual(scanned.version, spec.version(), path)
+            self.assertItemsEqual(scanned.sources, spec.spec.sources, path)
+
+    def test_name_mismatch(self):
+        """Scanning checks the package name like Spec"""
+        with self.assertRaises(planex.spec.SpecNameMismatch):
+            planex.spec.scan_spec("tests/data/bad-name.spec")
+
+    def test_fallback(self):
+        """Specs using unsupported constructs are parsed by librpm"""
+        with open("tests/data/ocaml-uri.spec") as spec:
+            text = spec.read()
+        conditional = "%if 0%{?rhel}\n%define extra 1\n%endif\n" + text
+        with mock.patch("planex.spec.open",
+                        mock.mock_open(read_data=conditional), create=True):
+            with self.assertRaises(planex.spec.SpecScanUnsupported):
+                planex.spec.scan_spec("tests/data/ocaml-uri.spec")
+
+        with mock.patch("planex.spec.scan_spec",
+                        side_effect=planex.spec.SpecScanUnsupported):
+            metadata = planex.spec.spec_metadata("tests/data/ocaml-uri.spec")
+        self.assertEqual(metadata.name, "ocaml-uri")
+        self.assertEqual(metadata.urls(),
+                         ["https://github.com/mirage/ocaml-uri/archive/"
+                          "v1.6.0/ocaml-uri-1.6.0.tar.gz"])
+
+
+class QuietParseTests(unittest.TestCase):
+    """Parsing specs without librpm's diagnostics"""
+
+    def test_no_redirection(self):
+        """Specs which parse are not parsed with stderr redirected"""
+        with mock.patch("os.dup2") as dup2:
+            planex.spec.parse_spec_quietly("tests/data/ocaml-uri.spec")
+        self.assertFalse(dup2.called)
+
+    def test_verbosity_restored(self):
+        """The log level set through set_verbosity is restored"""
+        planex.spec.set_verbosity(rpm.RPMLOG_DEBUG)
+        try:
+            with mock.patch("rpm.setVerbosity") as set_verbosity:
+                planex.spec.parse_spec_quietly("tests/data/ocaml-uri.spec")
+            set_verbosity.assert_called_with(rpm.RPMLOG_DEBUG)
+        finally:
+            planex.spec.set_verbosity(rpm.RPMLOG_NOTICE)
+
+    def test_errors_reported(self):
+        """Errors are reported if a spec cannot be parsed"""
+        with tempfile.NamedTemporaryFile(suffix=".spec") as spec:
+            spec.write("Name: broken\n%description\n")
+            spec.flush()
+            with self.assertRaises(ValueError) as context:
+                planex.spec.parse_spec_quietly(spec.name)
+        self.assertTrue(context.exception.args[0].endswith(spec.name))